@@ -1,25 +1,103 @@
-from PyQt5.QtWidgets import QWidget, QApplication, QVBoxLayout, QPushButton, QLabel, QHBoxLayout, QSlider, QScrollArea, QLineEdit, QSpinBox, QMessageBox, QMainWindow, QMdiArea, QMdiSubWindow
-from PyQt5.QtCore import Qt
-from mirror_command_plot import PlotView
-import struct
-import csv
+from PyQt5.QtWidgets import QWidget, QApplication, QVBoxLayout, QPushButton, QLabel, QHBoxLayout, QSlider, QScrollArea, QLineEdit, QSpinBox, QMessageBox, QMainWindow, QMdiArea, QMdiSubWindow, QCheckBox, QFileDialog, QDialog, QDialogButtonBox, QFormLayout, QComboBox
+from PyQt5.QtCore import Qt, QTimer, QEvent
+from z2c_store import load_z2c, zernike_to_actuators
+from dm_server import connect_or_open
+from dm_worker import DMWorker
+from zernike_decompose import load_decomposer, load_actuator_file
+from zernike_modes import Noll_Zernikes
+from dm_journal import DMJournal, session_path, SOURCE_GUI, SOURCE_UNDO
+import instrumentation
+import os
 import sys
+import time
+import threading
+import argparse
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.patches import Rectangle
-from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
-from matplotlib.backends.backend_qtagg import NavigationToolbar2QT as NavigationToolbar
-
-Noll_Zernikes = ["Tilt Y", "Tilt X", "Power", "Astig 45", "Astig X", "Coma X", "Coma Y", "Trefoil Y", "Trefoil 45", "Primary Spherical", "Secondary Astig Y", "Secondary Astig 45", "Quadrafoil Y", "Quadrafoil 45", "Secondary Coma X", "Secondary Coma Y", "Secondary Trefoil 45", "Secondary Trefoil Y", "Pentafoil 45", "Pentafoil Y", "Secondary Spherical", "Tertiary Astig 45", "Tertiary Astig Y"]
-Noll_Zernikes.extend([f"Mode {i+24}" for i in range(96 - len(Noll_Zernikes))])
-
-### Add '/Lib' or '/Lib64' to path 
-if (8 * struct.calcsize("P")) == 32:
-    print("Use x86 libraries.")
-    from Lib.asdk import DM
-else:
-    print("Use x86_64 libraries.")
-    from Lib64.asdk import DM
+#matplotlib is the slowest import by far, it is only pulled in once a window is actually built
+
+SLIDER_MIN = -100
+SLIDER_MAX = 100
+
+class SliderRow(QWidget):
+    #one label/slider/value box row from the pool, rebound to whichever mode is scrolled into its place;
+    #its signals are connected once here and report the mode it currently shows
+    def __init__(self, panel):
+        super().__init__(panel.canvas)
+        self.panel = panel
+        self.index = -1
+        self.modeLabel = QLabel()
+        self.modeLabel.setAlignment(Qt.AlignLeft)
+        maxLabel = QLabel(str(SLIDER_MAX))
+        maxLabel.setAlignment(Qt.AlignRight)
+        self.slider = QSlider(Qt.Horizontal)
+        self.slider.setRange(SLIDER_MIN, SLIDER_MAX)
+        self.slider.valueChanged.connect(self.sliderMoved)
+        #value box in case a typed value is easier than dragging
+        self.lineEdit = QLineEdit("0")
+        self.lineEdit.setFixedWidth(50)
+        self.lineEdit.setAlignment(Qt.AlignCenter)
+        self.lineEdit.editingFinished.connect(self.lineEditChanged)
+        layout = QVBoxLayout(self)
+        layout.addWidget(self.modeLabel)
+        layout.addWidget(maxLabel)
+        layout.addWidget(self.slider)
+        layout.addWidget(self.lineEdit)
+        self.hide()
+
+    def bind(self, index, value):
+        self.index = index
+        self.modeLabel.setText(Noll_Zernikes[index])
+        self.setValue(value)
+
+    def setValue(self, value):
+        self.slider.blockSignals(True)
+        self.slider.setValue(value)
+        self.slider.blockSignals(False)
+        self.lineEdit.setText(str(value))
+
+    def sliderMoved(self, value):
+        self.lineEdit.setText(str(value))
+        self.panel.rowChanged(self.index, value)
+
+    def lineEditChanged(self):
+        #values out of range are clamped by the slider, text that isn't a number is put back
+        try:
+            self.slider.setValue(int(self.lineEdit.text()))
+        except ValueError:
+            pass
+        self.lineEdit.setText(str(self.slider.value()))
+
+class OptimiserDialog(QDialog):
+    #settings for zernike_optimizer; the channel comes from the analog reader's shared ring (--share-clock)
+    def __init__(self, count, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Optimise shape")
+        self.algorithm = QComboBox()
+        self.algorithm.addItems(["nelder-mead", "spgd", "sweep"])
+        self.goal = QComboBox()
+        self.goal.addItems(["Maximise", "Minimise"])
+        self.channel = QSpinBox()
+        self.channel.setRange(0, 15)
+        self.modes = QLineEdit(f"2-{count}" if count > 1 else "1") #Noll indices, piston left out
+        self.settle = QLineEdit("20")
+        self.samples = QSpinBox()
+        self.samples.setRange(1, 100000)
+        self.samples.setValue(10)
+        self.iterations = QLineEdit("") #empty: the algorithm's default
+        self.step = QLineEdit("0.2")
+        button_box = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel, parent=self)
+        button_box.accepted.connect(self.accept)
+        button_box.rejected.connect(self.reject)
+        form = QFormLayout(self)
+        form.addRow("Algorithm", self.algorithm)
+        form.addRow("Goal", self.goal)
+        form.addRow("Analog channel", self.channel)
+        form.addRow("Modes (Noll)", self.modes)
+        form.addRow("Settle (ms)", self.settle)
+        form.addRow("Samples per point", self.samples)
+        form.addRow("Iterations / passes", self.iterations)
+        form.addRow("Step", self.step)
+        form.addRow(button_box)
 
 class ZernikeSliders(QWidget):
     def __init__(self, window):
@@ -29,9 +107,13 @@ class ZernikeSliders(QWidget):
         self.zernikeCount = QSpinBox()
         self.zernikeCount.setRange(1, 96)
         self.zernikeCount.setValue(8)
-        self.zernikeSliders = []
-        self.zernikeLineEdits = []
-        self.zernikeMaxLabels = []
+        #slider positions for every mode live here, the widgets only show the ones scrolled into view
+        self.modeValues = np.zeros(len(Noll_Zernikes), dtype=np.int64)
+        self.count = self.zernikeCount.value()
+        self.rows = []
+        self.undoIndex = None #journal record the last undo went back to
+        self.undoing = False
+        self.optimiser = None #running search, its thread and stop flag
 
         self.initUI()
 
@@ -40,9 +122,13 @@ class ZernikeSliders(QWidget):
         #make area scrollable when there isn't enough room for all sliders
         self.scrollArea = QScrollArea()
         self.scrollArea.setWidgetResizable(True)
-        self.scrollWidget = QWidget()
-        self.scrollLayout = QVBoxLayout(self.scrollWidget)
-        self.scrollArea.setWidget(self.scrollWidget)
+        self.canvas = QWidget()
+        self.scrollArea.setWidget(self.canvas)
+        #every row has the same height, the first pooled row measures it
+        self.rows.append(SliderRow(self))
+        self.rowHeight = self.rows[0].sizeHint().height()
+        self.scrollArea.verticalScrollBar().valueChanged.connect(self.layoutRows)
+        self.scrollArea.viewport().installEventFilter(self)
         #call function for the amount of zernike modes chosen so that the sliders also represent that
         self.updateSliders(self.zernikeCount.value())
         #create reset button
@@ -51,143 +137,283 @@ class ZernikeSliders(QWidget):
         #create a send value button to DM
         sendvalueButton = QPushButton("Send to DM")
         sendvalueButton.clicked.connect(self.sendValues)
+        #live mode streams every slider change to the mirror through the DM worker
+        self.liveCheckbox = QCheckBox("Live")
+        self.liveCheckbox.toggled.connect(self.liveToggled)
+        #decompose a saved or measured actuator command back onto the sliders
+        loadCommandButton = QPushButton("Load command")
+        loadCommandButton.clicked.connect(self.loadCommand)
+        #go back to the mirror state before the last command, from the session journal
+        undoButton = QPushButton("Undo")
+        undoButton.clicked.connect(self.undoCommand)
+        #search for the coefficients that maximise or minimise an analog channel, then load them here
+        self.optimiseButton = QPushButton("Optimise")
+        self.optimiseButton.clicked.connect(self.optimiseShape)
+        self.dmStatus = QLabel("")
         #set up the layout to put all these things in a horizontal layout
         zernike_controlLayout = QHBoxLayout()
         zernike_controlLayout.addWidget(QLabel("Zernike Modes: "))
         zernike_controlLayout.addWidget(self.zernikeCount)
         zernike_controlLayout.addWidget(sendvalueButton)
+        zernike_controlLayout.addWidget(self.liveCheckbox)
+        zernike_controlLayout.addWidget(loadCommandButton)
+        zernike_controlLayout.addWidget(undoButton)
+        zernike_controlLayout.addWidget(self.optimiseButton)
         #put all the widgets in one layout
         layout = QVBoxLayout()
         layout.addLayout(zernike_controlLayout)
         layout.addWidget(self.scrollArea)
         layout.addWidget(resetSliderButton)
+        layout.addWidget(self.dmStatus)
         self.setLayout(layout)
+        #everything that could send to the mirror while the optimiser owns it
+        self.sendControls = [self.scrollArea, self.zernikeCount, sendvalueButton, self.liveCheckbox, loadCommandButton, undoButton, resetSliderButton]
         self.zernikeCount.valueChanged.connect(self.zernikeCountChanged)
+        self.statusTimer = QTimer(self, timeout=self.updateDMStatus, interval=500)
+        self.statusTimer.start()
         
     def zernikeCountChanged(self):
         self.count = self.zernikeCount.value()
         self.updateSliders(self.count)
 
     def updateSliders(self, count):
-        sliderMin = -100
-        sliderMax = 100
-        for i in reversed(range(self.scrollLayout.count())):
-            widget = self.scrollLayout.itemAt(i).widget()
-            if widget is not None: #so scrollable area stays normal and not leave dead space
-                widget.deleteLater()
-        #set up all the empties for all the sliders, value boxes, and labels
-        self.zernikeSliders = []
-        self.zernikeLineEdits = []
-        self.zernikeMaxLabels = []
-        self.zernikeModeLabel = []
-
-        for i in range(count):
-            #create a max label on the top of each slider
-            modeLabel = QLabel(str(Noll_Zernikes[i]))
-            modeLabel.setAlignment(Qt.AlignLeft)
-            self.zernikeModeLabel.append(modeLabel)
-            maxLabel = QLabel(str(sliderMax))
-            maxLabel.setAlignment(Qt.AlignRight)
-            self.zernikeMaxLabels.append(maxLabel)
-            #create a slider for each of the zernikes in the spinbox
-            slider = QSlider(Qt.Horizontal)
-            slider.setRange(sliderMin, sliderMax)
-            slider.setValue(0)
-            slider.valueChanged.connect(self.sliderChanged)
-            #create value boxes on the bottom just in case if need to be an inputted value instead of a scrollable one
-            lineEdit = QLineEdit()
-            lineEdit.setFixedWidth(50)
-            lineEdit.setAlignment(Qt.AlignCenter)
-            lineEdit.setText("0")
-            lineEdit.editingFinished.connect(lambda le=lineEdit, sl=slider: self.lineEditChanged(le, sl))
-            #connect that if you scroll it it also shows up in the value box
-            slider.valueChanged.connect(lambda value, le=lineEdit: le.setText(str(value)))
-            #create a vertical layout to put each label, slider, and value box in
-            individual_slider_layout = QVBoxLayout()
-            individual_slider_layout.addWidget(modeLabel)
-            individual_slider_layout.addWidget(maxLabel)
-            individual_slider_layout.addWidget(slider)
-            individual_slider_layout.addWidget(lineEdit)
-            #put each vertical slider layout into another widget
-            container = QWidget()
-            container.setLayout(individual_slider_layout)
-            #make sure that the widget is scrollable
-            self.scrollLayout.addWidget(container)
-            self.zernikeSliders.append(slider)
-            self.zernikeLineEdits.append(lineEdit)
-
-        self.scrollWidget.adjustSize()
+        #only the model changes size: modes that drop off go back to zero, the ones that stay keep their values,
+        #and the rows on screen are rebound instead of rebuilt
+        self.modeValues[count:] = 0
+        self.count = count
+        self.canvas.setMinimumHeight(count * self.rowHeight)
+        self.layoutRows()
+
+    def layoutRows(self):
+        #virtualised list: only the modes inside the scroll area's viewport get a row from the pool
+        top = self.scrollArea.verticalScrollBar().value()
+        height = self.scrollArea.viewport().height()
+        first = min(top // self.rowHeight, self.count)
+        last = min(self.count, (top + height) // self.rowHeight + 1)
+        while len(self.rows) < last - first:
+            self.rows.append(SliderRow(self))
+        width = self.canvas.width()
+        for k, row in enumerate(self.rows):
+            index = first + k
+            if index < last:
+                if row.index != index:
+                    row.bind(index, int(self.modeValues[index]))
+                row.setGeometry(0, index * self.rowHeight, width, self.rowHeight)
+                row.show()
+            else:
+                row.index = -1
+                row.hide()
+
+    def refreshRows(self):
+        for row in self.rows:
+            if row.index >= 0:
+                row.setValue(int(self.modeValues[row.index]))
+
+    def eventFilter(self, watched, event):
+        if watched is self.scrollArea.viewport() and event.type() == QEvent.Resize:
+            self.layoutRows()
+        return super().eventFilter(watched, event)
+
+    def currentValues(self):
+        return [int(value) for value in self.modeValues[:self.count]]
+
+    def rowChanged(self, index, value):
+        self.modeValues[index] = value
+        self.sliderChanged()
 
     def resetSliders(self):
         #make all sliders go back to zero
-        for slider in self.zernikeSliders:
-            slider.setValue(0)
+        self.modeValues[:] = 0
+        self.refreshRows()
         self.sliderChanged()
         self.update_square_colors()
 
     def sliderChanged(self):
         #change the zernikes values to be the value that each slider says for each specific slider and corresponding zernike
-        zernike_values = [slider.value() for slider in self.zernikeSliders]
+        zernike_values = self.currentValues()
+        if not self.undoing:
+            self.undoIndex = None
         #changes the bar chart values as well
         self.window.barchart_tab.updateBarChart(zernike_values)
         self.update_square_colors()
 
-    def lineEditChanged(self, lineEdit, slider):
-        #try,except statement for editing the zernike values in case of value entered that is not within range
+    def setZernikeValues(self, values):
+        #set every mode in the model, refresh the rows on screen, then refresh the views once
+        n = min(len(values), self.count)
+        self.modeValues[:n] = np.clip(np.round(np.asarray(values[:n], dtype=np.float64)), SLIDER_MIN, SLIDER_MAX)
+        self.refreshRows()
+        self.sliderChanged()
+
+    def loadCommand(self):
+        fileName, _ = QFileDialog.getOpenFileName(self, "Load actuator command", ".", "Actuator commands (*.npy *.csv *.txt)")
+        if not fileName:
+            return
         try:
-            value = int(lineEdit.text())
-            slider.setValue(value)
-        except ValueError:
-            lineEdit.setText(str(slider.value()))
+            decomposer = load_decomposer(self.window.serialName, self.count)
+            actuators = np.atleast_2d(load_actuator_file(fileName))
+            if actuators.size == 0:
+                raise ValueError(f"{fileName} holds no actuator values")
+            if actuators.ndim != 2 or actuators.shape[-1] != decomposer.nAct:
+                raise ValueError(f"{fileName} has {actuators.shape[-1]} values per command, the mirror has {decomposer.nAct} actuators")
+        except (OSError, ValueError) as error:
+            QMessageBox.critical(self, "File Error", str(error))
+            return
+        #a batch of commands decomposes in one product, the sliders show the last one
+        coefficients = decomposer.decompose(actuators)[-1]
+        self.setZernikeValues(coefficients * 100)
+
+    def undoCommand(self):
+        journal = self.window.journal
+        if journal is None:
+            self.dmStatus.setText("Undo needs the session journal")
+            return
+        #step back over the states undo itself sent, so repeated clicks keep going further back
+        k = (journal.written - 1 if self.undoIndex is None else self.undoIndex) - 1
+        first = max(0, journal.written - journal.capacity)
+        while k >= first and journal.sources[journal.index(k)] == SOURCE_UNDO:
+            k -= 1
+        if k < first:
+            self.dmStatus.setText("Nothing to undo")
+            return
+        self.undoIndex = k
+        record = journal.entry(k)
+        modes = int(record["modes"])
+        actuators = record["actuators"].astype(np.float64)
+        if modes:
+            coefficients = record["coefficients"][:modes].astype(np.float64)
+            if modes != self.zernikeCount.value():
+                self.zernikeCount.setValue(modes)
+        else:
+            #a raw actuator command, show its nearest Zernike fit on the sliders
+            coefficients = load_decomposer(self.window.serialName, self.count).decompose(actuators)
+        self.undoing = True
+        try:
+            self.setZernikeValues(coefficients * 100)
+        finally:
+            self.undoing = False
+        #the journaled actuators go out as they were, not recomputed from the rounded slider positions
+        self.window.plot_view.update_colors(actuators)
+        self.window.dmWorker.submit(actuators.tolist(), coefficients, SOURCE_UNDO)
+        self.dmStatus.setText(f"Restored command {k} from {time.strftime('%H:%M:%S', time.localtime(record['time']))}")
 
     def calculate_colors_from_zernike(self):
         serialName = self.window.serialName
-        zernike_values = np.array([slider.value() / 100.0 for slider in self.zernikeSliders])
-        Z2C = []
+        zernike_values = self.modeValues[:self.count] / 100.0
+        self.zernikeValues = zernike_values
 
         try:
-            with open('./config/'+serialName+'-Z2C.csv', newline='') as csvfile:
-                csvrows = csv.reader(csvfile, delimiter=' ')
-                for row in csvrows:
-                    x = row[0].split(",")
-                    Z2C.append([float(value) for value in x])
+            #parsed once per serial and cached, only re-read when the csv changes on disk
+            Z2C = load_z2c(serialName)
         except FileNotFoundError:
             QMessageBox.critical(self, "File Error", "Configuration file not found")
             return
 
-        Z2C = np.array(Z2C)
-        #takes the rows and transposes them so that they can all be multiplied by their specific zernike values from the sliders
-        actuator_values = Z2C[:len(zernike_values)].T @ zernike_values
-        if (np.max(actuator_values)>1) or (np.min(actuator_values) < -1):
-            actuator_values = (actuator_values - actuator_values.min()) / (actuator_values.max() - actuator_values.min())  #scales to [0,1]
-            actuator_values = 2 * actuator_values - 1  #scales to [-1,1]
-        self.colors = actuator_values
+        self.colors = zernike_to_actuators(Z2C, zernike_values)
 
     def update_square_colors(self):
         self.calculate_colors_from_zernike()
-        self.window.plot_view.ax.clear()
-        positions = PlotView.generate_square_positions(self)
-        norm = plt.Normalize(vmin=min(self.colors), vmax=max(self.colors))
-        colormap = plt.cm.viridis
-        for pos, color_value in zip(positions, self.colors):
-            normalized_color = norm(color_value)
-            color = colormap(normalized_color)
-            square = Rectangle((pos[0] - 0.5, pos[1] - 0.5), 1, 1, facecolor=color)
-            self.window.plot_view.ax.add_patch(square)
-        self.window.plot_view.ax.set_aspect('equal')
-        self.window.plot_view.ax.set_xlim((-7,7))
-        self.window.plot_view.ax.set_ylim((-1,13))
-        self.window.plot_view.ax.set_xticks([])
-        self.window.plot_view.ax.set_yticks([])
-        self.window.plot_view.canvas.draw()
+        #only the colors of the persistent actuator squares change, the plot view blits them
+        self.window.plot_view.update_colors(self.colors)
+        if self.liveCheckbox.isChecked() and not self.undoing:
+            self.window.dmWorker.submit(self.colors.tolist(), self.zernikeValues, SOURCE_GUI)
+
+    def liveToggled(self, checked):
+        if checked:
+            self.update_square_colors()
 
     def sendValues(self):
         self.calculate_colors_from_zernike()
-        dm = self.window.dm
         actuator_values = self.colors
         print(actuator_values, np.max(actuator_values), np.min(actuator_values), np.mean(actuator_values), np.std(actuator_values))
-        dm.Send(actuator_values.tolist())
-        QMessageBox.information(self, "Success", "Values sent to DM")
+        #the worker does the actual dm.Send, the GUI never waits on the driver
+        self.window.dmWorker.submit(actuator_values.tolist(), self.zernikeValues, SOURCE_GUI)
+        self.dmStatus.setText("Values sent to DM")
+
+    def optimiseShape(self):
+        if self.optimiser is not None:
+            self.optimiser["stop"] = True
+            return
+        dialog = OptimiserDialog(self.count, self)
+        if not dialog.exec_():
+            return
+        from zernike_optimizer import ChannelObjective, Search, parse_modes
+        from sync_capture import SharedRing, ANALOG_RING
+        try:
+            modes = parse_modes(dialog.modes.text(), self.count)
+            settle = float(dialog.settle.text())
+            iterations = int(dialog.iterations.text()) if dialog.iterations.text().strip() else None
+            step = float(dialog.step.text())
+            Z2C = load_z2c(self.window.serialName)
+        except ValueError as error:
+            QMessageBox.critical(self, "Optimiser", str(error))
+            return
+        except FileNotFoundError:
+            QMessageBox.critical(self, "File Error", "Configuration file not found")
+            return
+        try:
+            analogRing = SharedRing(ANALOG_RING)
+        except FileNotFoundError:
+            QMessageBox.critical(self, "Optimiser", "No analog samples: start the analog reader with --share-clock")
+            return
+        #the worker stays idle while the search sends to the mirror itself: the frame it may still hold goes out
+        #first, then it is paused, so only one thread is ever inside dm.Send
+        self.liveCheckbox.setChecked(False)
+        for control in self.sendControls:
+            control.setEnabled(False)
+        self.window.dmWorker.pause()
+        optimiser = {"ring": analogRing, "stop": False, "report": None, "error": None}
+        #the stop flag is also checked while a candidate settles or waits for samples, so Stop and closing are prompt
+        objective = ChannelObjective(self.window.dm, analogRing, dialog.channel.value(), settle, dialog.samples.value(),
+                                     self.window.dmWorker.journal, stop=lambda: optimiser["stop"])
+        optimiser["search"] = Search(Z2C, objective, self.modeValues[:self.count] / 100.0, modes, dialog.goal.currentIndex() == 0)
+        self.optimiser = optimiser
+        thread = threading.Thread(target=self.runOptimiser, args=(dialog.algorithm.currentText(), iterations, step), name="optimiser", daemon=True)
+        self.optimiser["thread"] = thread
+        self.optimiseButton.setText("Stop")
+        thread.start()
+
+    def runOptimiser(self, algorithm, iterations, step):
+        #optimiser thread: no widgets touched here, updateDMStatus picks the result up on the GUI thread
+        from zernike_optimizer import optimise
+        optimiser = self.optimiser
+        try:
+            optimiser["report"] = optimise(optimiser["search"], algorithm, iterations, step, stop=lambda: optimiser["stop"])
+        except Exception as error:
+            optimiser["error"] = error
+
+    def finishOptimiser(self):
+        optimiser, self.optimiser = self.optimiser, None
+        optimiser["ring"].close()
+        self.window.dmWorker.resume()
+        for control in self.sendControls:
+            control.setEnabled(True)
+        self.optimiseButton.setText("Optimise")
+        if optimiser["error"] is not None:
+            QMessageBox.critical(self, "Optimiser", str(optimiser["error"]))
+            return
+        report = optimiser["report"]
+        print(f"Optimiser: {report['evaluations']} evaluations in {report['seconds']:.2f} s, best {report['best_value']:.6g}, coefficients {report['best_coefficients']}")
+        self.dmStatus.setText(f"Optimised: {report['evaluations']} evaluations ({report['evaluations_per_s']:.1f}/s), best {report['best_value']:.6g}")
+        #the mirror is already on the best shape, the sliders follow (rounded to whole percent)
+        self.setZernikeValues(np.asarray(report["best_coefficients"]) * 100)
+
+    def updateDMStatus(self):
+        if self.optimiser is not None:
+            if not self.optimiser["thread"].is_alive():
+                self.finishOptimiser()
+                return
+            search = self.optimiser["search"]
+            elapsed = time.perf_counter() - search.start
+            best = search.sign * search.bestScore
+            self.dmStatus.setText(f"Optimising: {search.evaluations} evaluations ({search.evaluations / max(elapsed, 1e-9):.1f}/s), best {best:.6g}")
+            return
+        worker = self.window.dmWorker
+        if worker.error is not None:
+            self.dmStatus.setText(f"DM error ({worker.failed} frames lost): {worker.error}")
+            return
+        if worker.sent == 0:
+            return
+        self.dmStatus.setText(f"DM: {worker.rate():.1f} Hz, send {worker.meanLatency * 1e3:.2f} ms (last {worker.lastLatency * 1e3:.2f} ms), {worker.coalesced()} frames coalesced")
 
 class ZernikeBarChart(QWidget):
     def __init__(self):
@@ -195,9 +421,13 @@ class ZernikeBarChart(QWidget):
         self.initUI()
 
     def initUI(self):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
+        from matplotlib.backends.backend_qtagg import NavigationToolbar2QT as NavigationToolbar
         self.setWindowTitle("Zernike Bar Chart")
         #make the barchart figure
-        self.barchartFig, self.barchartAx = plt.subplots()
+        self.barchartFig = Figure()
+        self.barchartAx = self.barchartFig.subplots()
         self.barchartCanvas = FigureCanvas(self.barchartFig)
         #make the slider for the barchart
         self.yAxisSlider = QSlider(Qt.Vertical)
@@ -224,34 +454,80 @@ class ZernikeBarChart(QWidget):
         layout.addLayout(sliderLayout)
         self.barchartFig.subplots_adjust(bottom=0.2)
         self.setLayout(layout)
+        #bars and value labels are kept between updates and blitted over this background
+        self.bars = None
+        self.barTexts = []
+        self.zeroLine = None
+        self.background = None
+        self.barchartCanvas.mpl_connect('draw_event', self.onDraw)
 
     def updateYAxisRange_BarChart(self):
         #create y min and y max so that it matches the slider, set up graph as well
         y_max = self.yAxisSlider.value()
         self.barchartAx.set_ylim([-y_max, y_max])
-        self.barchartAx.axhline(0, color='darkgrey', linewidth=0.5, zorder = 0)
-        self.barchartAx.grid(color='lightgrey', linestyle='-', linewidth=0.5, zorder=1)
         self.barchartAx.set_yticks(np.linspace(-y_max, y_max, 5))
+        #the zero line and grid are made once, a range change only needs a full redraw
+        if self.zeroLine is None:
+            self.zeroLine = self.barchartAx.axhline(0, color='darkgrey', linewidth=0.5, zorder = 0)
+            self.barchartAx.grid(color='lightgrey', linestyle='-', linewidth=0.5, zorder=1)
         self.barchartCanvas.draw()
 
+    def rebuildBars(self, count):
+        #only runs when the number of modes changes, values are pushed into these artists afterwards
+        if self.bars is not None:
+            self.bars.remove()
+            for text in self.barTexts:
+                text.remove()
+        self.bars = self.barchartAx.bar(range(1, count + 1), [0] * count, color='red', zorder=2, animated=True)
+        self.barTexts = [self.barchartAx.text(i + 1, 0, "0", ha='center', va='bottom', animated=True) for i in range(count)]
+        self.barchartAx.set_xlim(0.5, count + 0.5)
+        self.barchartAx.set_xticks(range(1, count + 1))
+        self.barchartAx.set_xticklabels(Noll_Zernikes[:count], rotation=35, ha='right', wrap = True)
+
+    def onDraw(self, event):
+        self.background = self.barchartCanvas.copy_from_bbox(self.barchartAx.bbox)
+        self.drawBars()
+
+    def drawBars(self):
+        if self.bars is None:
+            return
+        for bar in self.bars:
+            self.barchartAx.draw_artist(bar)
+        for text in self.barTexts:
+            self.barchartAx.draw_artist(text)
+
     def updateBarChart(self, data):
         #update bar chart using data from the zernike sliders values
-        self.barchartAx.clear()
-        self.barchartAx.bar(range(1, len(data) + 1), data, color='red', zorder=2)
-        self.barchartAx.set_xlim(0.5, len(data) + 0.5) 
-        self.barchartAx.set_xticks(range(1, len(data) + 1))
-        self.barchartAx.set_xticklabels(Noll_Zernikes[:len(data)], rotation=35, ha='right', wrap = True)
-        for i, coeff in enumerate(data):
-            self.barchartAx.text(i + 1, coeff + 0.1 * max(data), str(coeff), ha='center', va='bottom')
+        start = instrumentation.now() if instrumentation.ENABLED else 0
+        rebuilt = self.bars is None or len(self.bars) != len(data)
+        if rebuilt:
+            self.rebuildBars(len(data))
+        offset = 0.1 * max(data)
+        for bar, text, coeff in zip(self.bars, self.barTexts, data):
+            bar.set_height(coeff)
+            text.set_y(coeff + offset)
+            text.set_text(str(coeff))
 
-        self.updateYAxisRange_BarChart()
+        if rebuilt or self.background is None:
+            self.updateYAxisRange_BarChart()
+        else:
+            self.barchartCanvas.restore_region(self.background)
+            self.drawBars()
+            self.barchartCanvas.blit(self.barchartAx.bbox)
+        if start:
+            instrumentation.record("render.bar_chart", start)
 
 
 class DMControl(QMainWindow):
-    def __init__(self, dm, serialName):
+    def __init__(self, dm, serialName, framePeriod=0.005, journal=None):
         super().__init__()
         self.dm = dm
         self.serialName = serialName
+        self.journal = journal
+        #every send to the mirror goes through this thread, at most one per hardware frame;
+        #a journal only opened for reading (the DM server's) is used for undo but never appended to
+        self.dmWorker = DMWorker(dm, framePeriod, journal if journal is not None and journal.writable else None)
+        self.dmWorker.start()
         #allow the tabs to be moveable
         self.mdi = QMdiArea()
         self.setCentralWidget(self.mdi)
@@ -271,28 +547,80 @@ class DMControl(QMainWindow):
         self.mdi.addSubWindow(barchart_sub)
         #plot view tab
         plotview_sub = QMdiSubWindow()
+        from mirror_command_plot import PlotView
         self.plot_view = PlotView()
         plotview_sub.setWidget(self.plot_view)
         self.mdi.addSubWindow(plotview_sub)
+        if instrumentation.ENABLED:
+            from stats_panel import StatsPanel
+            stats_sub = QMdiSubWindow()
+            self.stats_panel = StatsPanel()
+            stats_sub.setWidget(self.stats_panel)
+            self.mdi.addSubWindow(stats_sub)
         #set the window itself
         self.setGeometry(100, 100, 800, 600)
         self.setWindowTitle("DM Control")
         self.show()
 
+    def closeEvent(self, event):
+        optimiser = self.zernike_tab.optimiser
+        if optimiser is not None:
+            optimiser["stop"] = True
+            optimiser["thread"].join()
+            self.zernike_tab.finishOptimiser()
+        self.dmWorker.stop()
+        if self.journal is not None:
+            self.journal.flush()
+        super().closeEvent(event)
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Zernike slider control for the ALPAO DM")
+    parser.add_argument("--frame-period", type=float, default=0.005, help="shortest time between two sends to the mirror in seconds")
+    parser.add_argument("--simulate", action="store_true", help="use the simulated DM instead of the hardware")
+    parser.add_argument("--instrument", action="store_true", help="record per-stage latency histograms, written to json on exit")
+    parser.add_argument("--journal", help="session journal file (default journal/<serial>-<date>.djr)")
+    parser.add_argument("--no-journal", action="store_true", help="don't record the commands sent to the mirror")
+    parser.add_argument("--share-clock", action="store_true", help="stamp every send with monotonic time in shared memory for sync_capture")
+    return parser.parse_known_args(args[1:])[0]
+
 def main(args):
+    options = parse_args(args)
     print("Please enter the S/N within the following format BXXYYY (see DM backside): ")
     serialName = sys.stdin.readline().rstrip()
     print("Connect the mirror")
-    dm = DM(serialName)
+    #with a DM server running for this mirror the GUI is just one of its clients
+    dm = connect_or_open(serialName, name="gui", priority=10)
+    server = hasattr(dm, "send_batch")
+    dmRing = None
+    if options.share_clock and server:
+        print("Sends go through the DM server, start it with --share-clock to stamp them")
+    elif options.share_clock:
+        from sync_capture import SharedRing, TimedDM, DM_RING
+        dmRing = SharedRing(DM_RING, 2, 1 << 16, create=True)
+        dm = TimedDM(dm, dmRing)
     print("Retrieve number of actuators")
     nbAct = int(dm.Get('NBOfActuator'))
     print("Number of actuator for " + serialName + ": " + str(nbAct))
     print("Send 0 on each actuators")
     values = [0.] * nbAct
     dm.Send(values)
+    journal = None
+    if server:
+        #the server journals every frame it sends, the GUI reads that journal back for undo
+        if dm.journalPath and os.path.exists(dm.journalPath):
+            journal = DMJournal(dm.journalPath)
+            print(f"Journal (DM server): {journal.path}")
+    elif not options.no_journal:
+        journal = DMJournal(options.journal or session_path(serialName), nbAct, serialName=serialName)
+        print(f"Journal: {journal.path}")
     app = QApplication(sys.argv)
-    window = DMControl(dm, serialName)
-    sys.exit(app.exec_())
+    window = DMControl(dm, serialName, options.frame_period, journal)
+    status = app.exec_()
+    if dmRing is not None:
+        dmRing.close()
+    if hasattr(dm, "close"):
+        dm.close()
+    sys.exit(status)
 
 if __name__ == "__main__":
     main(sys.argv)
@@ -0,0 +1,153 @@
+import time
+import threading
+import numpy as np
+import instrumentation
+
+class SampleRing:
+    #one writer (the acquisition thread) and any number of readers, no locks:
+    #the writer fills a slot and only then bumps `written`, readers copy and check they weren't lapped
+    def __init__(self, nChannels, capacity):
+        self.capacity = capacity
+        self.nChannels = nChannels
+        self.times = np.full(capacity, np.nan)
+        self.values = np.full((capacity, nChannels), np.nan)
+        self.written = 0 #total number of samples ever pushed
+
+    def push(self, t, row):
+        i = self.written % self.capacity
+        self.times[i] = t
+        self.values[i] = row
+        self.written += 1
+
+    def extend(self, times, rows):
+        #block version of push; only the last `capacity` rows can survive, so only those are copied
+        n = min(len(times), self.capacity)
+        idx = (self.written + len(times) - n + np.arange(n)) % self.capacity
+        self.times[idx] = times[len(times) - n:]
+        self.values[idx] = rows[len(rows) - n:]
+        self.written += len(times)
+
+    def _copy(self, start, stop):
+        #copies samples [start, stop) counted from the beginning of the run, oldest first
+        idx = np.arange(start, stop) % self.capacity
+        return self.times[idx], self.values[idx]
+
+    def latest(self, n):
+        written = self.written
+        n = min(n, written, self.capacity)
+        return self._copy(written - n, written)
+
+    def read_from(self, cursor):
+        #returns everything pushed since `cursor`, the new cursor and how many samples were overwritten unread
+        written = self.written
+        lost = max(0, written - cursor - self.capacity)
+        start = cursor + lost
+        times, values = self._copy(start, written)
+        #if the writer lapped us while copying, the oldest rows may be torn, drop them; push fills slot
+        #`written % capacity` before it counts it, so the slot being written right now goes too
+        overrun = min(len(times), max(0, self.written - start - self.capacity + 1))
+        if overrun:
+            times, values = times[overrun:], values[overrun:]
+            lost += overrun
+        return times, values, written, lost
+
+class ChannelCache:
+    #newest value, read latency and sample count per channel, written by the acquisition thread
+    #and handed to subscribers (e.g. the monitor window) from the GUI thread through notify()
+    def __init__(self, nChannels):
+        self.latest = np.full(nChannels, np.nan)
+        self.latency = np.zeros(nChannels)
+        self.counts = np.zeros(nChannels, dtype=np.int64)
+        self.subscribers = []
+
+    def update(self, row, latency):
+        np.copyto(self.latest, row)
+        np.copyto(self.latency, latency)
+        self.counts += 1
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        if callback in self.subscribers:
+            self.subscribers.remove(callback)
+
+    def notify(self):
+        for callback in list(self.subscribers):
+            callback(self)
+
+class AcquisitionEngine:
+    def __init__(self, device, nChannels=16, rate=100.0, capacity=1 << 16):
+        self.device = device
+        self.nChannels = nChannels
+        self.rate = rate
+        self.ring = SampleRing(nChannels, capacity)
+        self.cache = ChannelCache(nChannels)
+        self.latency = np.zeros(nChannels)
+        self.dropped = 0 #sample periods skipped because a read ran over its slot
+        self.clock = time.perf_counter
+        self.startTime = self.clock()
+        self.sharedRing = None #optional sync_capture.SharedRing, fed with monotonic ns stamps shared with other processes
+        self._thread = None
+        self._running = False
+        #use a bulk read when the backend has one, otherwise read the channels one by one on the worker
+        if hasattr(device, 'analog_read_all'):
+            self.read_channels = self._read_bulk
+        else:
+            self.read_channels = self._read_each
+
+    def _read_bulk(self, row):
+        start = self.clock()
+        row[:] = self.device.analog_read_all()[:self.nChannels]
+        self.latency.fill(self.clock() - start)
+
+    def _read_each(self, row):
+        read = self.device.analog_read
+        clock = self.clock
+        latency = self.latency
+        for iChannel in range(self.nChannels):
+            start = clock()
+            row[iChannel] = read(iChannel)
+            latency[iChannel] = clock() - start
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="acquisition", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        period = 1.0 / self.rate
+        row = np.empty(self.nChannels)
+        clock = self.clock
+        deadline = clock()
+        while self._running:
+            t = clock()
+            tShared = time.monotonic_ns()
+            self.read_channels(row)
+            if instrumentation.ENABLED:
+                instrumentation.histogram("daq.read").record(int((clock() - t) * 1e9))
+            self.ring.push(t - self.startTime, row)
+            if self.sharedRing is not None:
+                self.sharedRing.push(tShared, row)
+            self.cache.update(row, self.latency)
+            deadline += period
+            now = clock()
+            if now > deadline:
+                #fell behind, skip the missed slots instead of bursting to catch up
+                missed = int((now - deadline) / period) + 1
+                self.dropped += missed
+                deadline += missed * period
+            else:
+                time.sleep(deadline - now)
+
+    def achieved_rate(self):
+        elapsed = self.clock() - self.startTime
+        return self.ring.written / elapsed if elapsed > 0 else 0.0
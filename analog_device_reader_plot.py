@@ -1,14 +1,18 @@
 import time
 import sys
-import pickle
+import argparse
 import numpy as np
-from PyQt5.QtWidgets import QApplication, QMainWindow,  QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QDialog, QLabel, QCheckBox, QDialogButtonBox, QFileDialog
-from PyQt5.QtCore import QFileInfo, QTimer
+from PyQt5.QtWidgets import QApplication, QMainWindow,  QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QDialog, QLabel, QCheckBox, QDialogButtonBox, QFileDialog, QFormLayout, QComboBox, QLineEdit
+from PyQt5.QtCore import QFileInfo
 from matplotlib.backends.backend_qtagg import FigureCanvas
 from matplotlib.backends.backend_qtagg import NavigationToolbar2QT as NavigationToolbar
 from matplotlib.figure import Figure
-from dashboard.device import Device
+from devices import daq_device_class
 from psu_ctrl import MainWindow
+from acquisition import AcquisitionEngine
+from recorder import StreamRecorder
+from trigger import Trigger, TriggerEngine, KINDS, EDGES
+from history_pyramid import MinMaxPyramid
 
 nPoints = 240
 channelLabels = ["Channel 0", "Channel 1", "Channel 2", "Channel 3", "Channel 4", "Channel 5", "Channel 6", "Channel 7",
@@ -18,12 +22,18 @@ _pickradius = 5  # Points (Pt). How close the click needs to be to trigger an ev
 _map_legend_to_ax = {}  # Will map legend lines to original lines.
 
 class MonitorWindow(QWidget):
-    def __init__(self, device):
+    def __init__(self, cache):
         super(MonitorWindow, self).__init__()
         self.values = []
+        self.stats = []
+        self.shownValues = [None] * 16
+        self.shownStats = [None] * 16
         self.setupMeters()
-        self.windowTimer = QTimer(self, timeout=self.updateValue, interval=100)
-        self.windowTimer.start()
+        #no reads of its own, the acquisition thread's cache is pushed here once per display frame
+        self.cache = cache
+        self.lastCounts = cache.counts.copy()
+        self.lastTime = time.perf_counter()
+        self.cache.subscribe(self.updateValue)
     def setupMeters(self):
         layout = QVBoxLayout()
         for i in range(16):
@@ -33,12 +43,33 @@ class MonitorWindow(QWidget):
             value = QLabel(f"{0.0:f} V")
             hLayout.addWidget(value)
             self.values.append(value)
+            stat = QLabel("")
+            hLayout.addWidget(stat)
+            self.stats.append(stat)
             layout.addLayout(hLayout)
         self.setLayout(layout)
         self.setWindowTitle("PSU Monitor")
-    def updateValue(self):
+    def updateValue(self, cache):
+        now = time.perf_counter()
+        elapsed = now - self.lastTime
+        refreshStats = elapsed >= 1.0 #rates need a longer window than a single frame to mean anything
         for i in range(16):
-            self.values[i].setText(f"{device.analog_read(i):2.4f} V")
+            text = f"{cache.latest[i]:2.4f} V"
+            #setText triggers a relayout and repaint, skip it when the shown value hasn't changed
+            if text != self.shownValues[i]:
+                self.values[i].setText(text)
+                self.shownValues[i] = text
+            if refreshStats:
+                stat = f"{(cache.counts[i] - self.lastCounts[i]) / elapsed:7.1f} Hz  {cache.latency[i] * 1e6:7.1f} us"
+                if stat != self.shownStats[i]:
+                    self.stats[i].setText(stat)
+                    self.shownStats[i] = stat
+        if refreshStats:
+            self.lastCounts = cache.counts.copy()
+            self.lastTime = now
+    def closeEvent(self, event):
+        self.cache.unsubscribe(self.updateValue)
+        super(MonitorWindow, self).closeEvent(event)
 
 class RecordDialog(QDialog):
     def __init__(self, parent=None):
@@ -65,21 +96,74 @@ class RecordDialog(QDialog):
             mainLayout.addWidget(self.channelCheckboxes[channelLabel])
         mainLayout.addWidget(button_box)
 
+class TriggerDialog(QDialog):
+    def __init__(self, parent=None):
+        super(TriggerDialog, self).__init__(parent)
+        self.setWindowTitle("Triggered capture")
+        self.kind = QComboBox()
+        self.kind.addItems(KINDS)
+        self.channel = QComboBox()
+        self.channel.addItems(["All channels"] + channelLabels)
+        self.edge = QComboBox()
+        self.edge.addItems(EDGES)
+        self.level = QLineEdit("0.5") #level and edge threshold, or the allowed deviation in volts
+        self.low = QLineEdit("-1.0")
+        self.high = QLineEdit("1.0")
+        self.window = QLineEdit("1000") #samples in the rolling mean
+        self.sigma = QLineEdit("") #empty: deviation is compared with the level instead
+        self.pre = QLineEdit("1.0")
+        self.post = QLineEdit("1.0")
+        self.holdoff = QLineEdit("0.0")
+
+        button_box = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel, parent=self)
+        button_box.accepted.connect(self.accept)
+        button_box.rejected.connect(self.reject)
+
+        form = QFormLayout()
+        form.addRow("Trigger", self.kind)
+        form.addRow("Channel", self.channel)
+        form.addRow("Edge", self.edge)
+        form.addRow("Level (V)", self.level)
+        form.addRow("Window low (V)", self.low)
+        form.addRow("Window high (V)", self.high)
+        form.addRow("Rolling mean (samples)", self.window)
+        form.addRow("Deviation (sigma)", self.sigma)
+        form.addRow("Pre-trigger (s)", self.pre)
+        form.addRow("Post-trigger (s)", self.post)
+        form.addRow("Holdoff (s)", self.holdoff)
+        mainLayout = QVBoxLayout(self)
+        mainLayout.addLayout(form)
+        mainLayout.addWidget(button_box)
+
+    def triggers(self):
+        #one trigger per channel when "All channels" is chosen
+        channels = range(len(channelLabels)) if self.channel.currentIndex() == 0 else [self.channel.currentIndex() - 1]
+        sigma = float(self.sigma.text()) if self.sigma.text().strip() else None
+        return [Trigger(self.kind.currentText(), c, level=float(self.level.text()), low=float(self.low.text()),
+                        high=float(self.high.text()), edge=self.edge.currentText(), window=int(self.window.text()), sigma=sigma)
+                for c in channels]
+
 class ApplicationWindow(QMainWindow):
-    def __init__(self, device):
+    def __init__(self, device, rate=100.0, fps=20.0, history=3600.0):
         super(ApplicationWindow, self).__init__()
         self.setWindowTitle("PSU Monitor") #adds a title to the window
+        self.device = device
+        self.fps = fps
+        #sampling runs on its own thread at its own rate, the canvas only shows the newest samples
+        self.engine = AcquisitionEngine(device, len(channelLabels), rate)
+        #everything acquired goes into a min/max pyramid so hours of history plot at screen resolution
+        self.history = MinMaxPyramid(len(channelLabels), int(history * rate))
+        self.historyCursor = 0
+        self.follow = True
+        self.followSpan = nPoints / rate
+        self.settingLimits = False
         self.mainWidget = self.setupMain()
         self.setCentralWidget(self.mainWidget)
-        self.device = device
+        self.engine.start()
 
     def setupMain(self):
-        self.isSaving = False
-        self.index = 0
-        self.version = 0
-        self.startTime = time.time()
-        self.voltage_values = np.full((len(channelLabels),nPoints), fill_value=np.nan)
-        self.time_values = np.full((nPoints), fill_value=np.nan)
+        self.recorder = None
+        self.trigger = None
 
         self.canvas = FigureCanvas(Figure(figsize=(5, 3)))
         toolbar = NavigationToolbar(self.canvas, self)
@@ -91,9 +175,9 @@ class ApplicationWindow(QMainWindow):
         self.lines = []
         self.colors = ["deeppink", "magenta", "darkviolet", "indigo", "darkslateblue", "midnightblue", "blue", "dodgerblue", "lightskyblue", "lightblue", "teal",  "mediumseagreen", "darkgreen", "darkolivegreen", "yellowgreen", "khaki"]
         for iChannel in range(len(channelLabels)):
-            line, = axis.plot(self.time_values,self.voltage_values[iChannel], linestyle = 'none', label=channelLabels[iChannel], color = self.colors[iChannel], marker='.')
+            line, = axis.plot([], [], linestyle = 'none', label=channelLabels[iChannel], color = self.colors[iChannel], marker='.')
             self.lines.append(line)
-        self.canvasTimer = self.canvas.new_timer()
+        self.canvasTimer = self.canvas.new_timer(interval=int(1000 / self.fps))
         self.canvasTimer.add_callback(self.updateCanvas)
         self.canvasTimer.start()
         legend = axis.legend(loc = 'upper right', fontsize = 7, ncols = 2)
@@ -102,6 +186,9 @@ class ApplicationWindow(QMainWindow):
             _map_legend_to_ax[legendLine] = axLine
 
         self.canvas.mpl_connect('pick_event', self.onLegendPick)
+        #toolbar zoom/pan stops following the newest samples and refetches the new range
+        axis.set_autoscalex_on(False)
+        axis.callbacks.connect('xlim_changed', self.onXLimChanged)
 
         recordStop_button = QPushButton("Record") #create button called Record that opens second window
         recordStop_button.clicked.connect(self.startRecording)
@@ -112,6 +199,12 @@ class ApplicationWindow(QMainWindow):
         monitor_button = QPushButton("Monitor")
         monitor_button.clicked.connect(self.monitor)
 
+        trigger_button = QPushButton("Trigger") #writes only pre + post-trigger segments around each event
+        trigger_button.clicked.connect(self.startTrigger)
+
+        stats_button = QPushButton("Stats") #latency histograms, only filled with --instrument
+        stats_button.clicked.connect(self.showStats)
+
         # ---- layout ----
         widget = QWidget()
         vBoxLayout = QVBoxLayout()
@@ -119,39 +212,44 @@ class ApplicationWindow(QMainWindow):
         vBoxLayout.addWidget(self.canvas)
         hBoxLayout.addWidget(toolbar)
         hBoxLayout.addWidget(recordStop_button)
+        hBoxLayout.addWidget(trigger_button)
         hBoxLayout.addWidget(findLines_button)
         hBoxLayout.addWidget(monitor_button)
+        hBoxLayout.addWidget(stats_button)
         vBoxLayout.addLayout(hBoxLayout)
         widget.setLayout(vBoxLayout)
         widget.recordStop_button = recordStop_button
+        widget.trigger_button = trigger_button
 
         return widget
     
     def updateCanvas(self):
-        self.index += 1 #start incrementing to index
-        self.index = self.index%nPoints
-        self.time_values[self.index] = time.time() - self.startTime
-        for iChannel in range(len(channelLabels)):
-            self.voltage_values[iChannel, self.index] = device.analog_read(iChannel)
-            if self.lines[iChannel].get_visible():
-                self.lines[iChannel].set_data(self.time_values, self.voltage_values[iChannel])
-            self.lines[iChannel].figure.canvas.draw()
-        if self.isSaving:
-            if self.index == nPoints-1:
-                self.data = np.vstack((self.time_values.transpose(), self.voltage_values[self.checks, :]))
-                self.fileName = f"{self.fileInfo.absolutePath()}/{self.fileInfo.baseName()}_{self.version:03d}.pkl"
-                self.version += 1
-                with open(self.fileName, 'wb') as file:
-                    pickle.dump(self.data, file)
-                print("saved file" + self.fileName)
+        #move whatever the acquisition thread pushed since the last frame into the history pyramid
+        times, values, self.historyCursor, _ = self.engine.ring.read_from(self.historyCursor)
+        if len(times):
+            self.history.append(times, values)
+        if self.follow:
+            first, last = self.history.time_range()
+            if not np.isnan(last):
+                self.settingLimits = True
+                self.canvas.figure.get_axes()[0].set_xlim(max(first, last - self.followSpan), last)
+                self.settingLimits = False
+        self.refreshLines()
+        self.canvas.draw_idle()
+        self.engine.cache.notify()
+        status = f"Acquisition {self.engine.achieved_rate():.1f} Hz, dropped {self.engine.dropped}"
+        if self.recorder is not None:
+            status += f" | recording {self.recorder.rows} samples, lost {self.recorder.lost}"
+        if self.trigger is not None:
+            status += f" | armed, {len(self.trigger.captures)} captures"
+        self.statusBar().showMessage(status)
 
     def stopRecording(self):
         self.mainWidget.recordStop_button.clicked.disconnect()
-        self.isSaving = False
-        with open(f"{self.fileInfo.absolutePath()}/{self.fileInfo.baseName()}_{(self.version + 1):03d}.pkl", 'wb') as file:
-            pickle.dump(np.vstack((self.time_values.transpose(), self.voltage_values[self.checks, :])), file)
-        print("saved file : " + f"{self.fileInfo.absolutePath()}/{self.fileInfo.baseName()}_{(self.version+1):03d}.pkl")
-        self.version = 0 #reset for next trial if window still open
+        #the writer thread drains whatever is still in the ring before the file is closed
+        self.recorder.stop()
+        print(f"saved file : {self.recorder.path} ({self.recorder.rows} samples, {self.recorder.lost} lost)")
+        self.recorder = None
         self.mainWidget.recordStop_button.setText("Record")
         self.mainWidget.recordStop_button.clicked.connect(self.startRecording)
         
@@ -161,24 +259,78 @@ class ApplicationWindow(QMainWindow):
         if result == QDialog.Accepted:
             options = QFileDialog.Options()
             options |= QFileDialog.DontUseNativeDialog
-            defaultFileType = "Pickle File (*.pkl)"
+            defaultFileType = "PSU Recording (*.rec)"
             _fileName, _ = QFileDialog.getSaveFileName(self, "Save data", ".", defaultFileType, options=options)
             if _fileName:
-                self.fileInfo = QFileInfo(_fileName)
-                self.isSaving = True
-                self.checks = [checkbox.isChecked() for checkbox in recordDialog.channelCheckboxes]
+                fileInfo = QFileInfo(_fileName)
+                fileName = f"{fileInfo.absolutePath()}/{fileInfo.completeBaseName()}.rec"
+                channels = [i for i, checkbox in enumerate(recordDialog.channelCheckboxes) if checkbox.isChecked()]
+                #one append-only file per run, fed straight from the acquisition ring on a writer thread
+                self.recorder = StreamRecorder(fileName, self.engine.ring, channels, self.engine.rate)
+                self.recorder.start()
                 self.mainWidget.recordStop_button.clicked.disconnect()
                 self.mainWidget.recordStop_button.setText("Stop")
                 self.mainWidget.recordStop_button.clicked.connect(self.stopRecording)
 
+    def refreshLines(self):
+        #only fetch about one point (or min/max pair) per horizontal pixel for the visible range
+        axis = self.canvas.figure.get_axes()[0]
+        x0, x1 = axis.get_xlim()
+        times, values = self.history.query(x0, x1, max(int(axis.bbox.width), 1))
+        for iChannel in range(len(channelLabels)):
+            if self.lines[iChannel].get_visible():
+                self.lines[iChannel].set_data(times, values[:, iChannel])
+
+    def onXLimChanged(self, axis):
+        if self.settingLimits:
+            return
+        self.follow = False
+        self.refreshLines()
+
+    def startTrigger(self):
+        dialog = TriggerDialog(self)
+        if not dialog.exec_():
+            return
+        try:
+            triggers = dialog.triggers()
+            pre, post, holdoff = float(dialog.pre.text()), float(dialog.post.text()), float(dialog.holdoff.text())
+        except ValueError as error:
+            print(f"Invalid trigger settings: {error}")
+            return
+        folder = QFileDialog.getExistingDirectory(self, "Folder for the triggered captures")
+        if not folder:
+            return
+        self.trigger = TriggerEngine(self.engine.ring, triggers, self.engine.rate, folder, pre, post, holdoff,
+                                     onCapture=lambda t, trigger, path: print(f"trigger at {t:.3f} s ({trigger.describe()}): {path}"))
+        self.trigger.start()
+        self.mainWidget.trigger_button.clicked.disconnect()
+        self.mainWidget.trigger_button.setText("Disarm")
+        self.mainWidget.trigger_button.clicked.connect(self.stopTrigger)
+
+    def stopTrigger(self):
+        self.mainWidget.trigger_button.clicked.disconnect()
+        self.trigger.stop()
+        print(f"{len(self.trigger.captures)} captures in {self.trigger.folder}, {self.trigger.lost} samples lost")
+        self.trigger = None
+        self.mainWidget.trigger_button.setText("Trigger")
+        self.mainWidget.trigger_button.clicked.connect(self.startTrigger)
+
     def findLines(self):
         axis = self.canvas.figure.get_axes()[0]
-        xmin, xmax = np.nanmin(self.time_values), np.nanmax(self.time_values)
-        ymin, ymax = np.nanmin(self.voltage_values), np.nanmax(self.voltage_values)
+        #show the whole history and keep following it, y range comes from the pyramid's extrema
+        xmin, xmax = self.history.time_range()
+        visible = [i for i, line in enumerate(self.lines) if line.get_visible()]
+        ymin, ymax = self.history.extrema(visible or None)
         if not xmin == xmax:
+            self.follow = True
+            self.followSpan = xmax - xmin
+            self.settingLimits = True
             axis.set_xlim(xmin, xmax)
+            self.settingLimits = False
         if not ymin == ymax:
             axis.set_ylim(ymin, ymax)
+        self.refreshLines()
+        self.canvas.draw_idle()
 
     def onLegendPick(self, event):
         # On the pick event, find the original line corresponding to the legend proxy line, and toggle its visibility.
@@ -193,12 +345,45 @@ class ApplicationWindow(QMainWindow):
         legendLine.set_alpha(1.0 if visible else 0.2)
         self.canvas.draw()
     def monitor(self):
-        self.second_window = MonitorWindow(self.device)
+        self.second_window = MonitorWindow(self.engine.cache)
         self.second_window.show()
+    def showStats(self):
+        from stats_panel import StatsPanel
+        self.stats_panel = StatsPanel()
+        self.stats_panel.show()
+
+    def closeEvent(self, event):
+        self.canvasTimer.stop()
+        if self.recorder is not None:
+            self.stopRecording()
+        if self.trigger is not None:
+            self.stopTrigger()
+        self.engine.stop()
+        super(ApplicationWindow, self).closeEvent(event)
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Plot and record the comedi analog channels")
+    parser.add_argument("--rate", type=float, default=100.0, help="acquisition rate in samples per second")
+    parser.add_argument("--fps", type=float, default=20.0, help="display refresh rate in frames per second")
+    parser.add_argument("--history", type=float, default=3600.0, help="seconds of history kept for zooming out")
+    parser.add_argument("--simulate", action="store_true", help="use the simulated DAQ instead of /dev/comedi0")
+    parser.add_argument("--instrument", action="store_true", help="record per-stage latency histograms, written to json on exit")
+    parser.add_argument("--share-clock", action="store_true", help="publish samples with monotonic time stamps to shared memory for sync_capture")
+    return parser.parse_known_args(args[1:])[0]
 
 if __name__ == "__main__":
-    device = Device('/dev/comedi0')
+    options = parse_args(sys.argv)
+    device = daq_device_class()('/dev/comedi0')
     app = QApplication(sys.argv)
-    app_window = ApplicationWindow(device)
+    app_window = ApplicationWindow(device, options.rate, options.fps, options.history)
+    sharedRing = None
+    if options.share_clock:
+        from sync_capture import SharedRing, ANALOG_RING
+        sharedRing = SharedRing(ANALOG_RING, len(channelLabels), 1 << 18, create=True)
+        app_window.engine.sharedRing = sharedRing
     app_window.show()
-    sys.exit(app.exec_())
+    status = app.exec_()
+    if sharedRing is not None:
+        app_window.engine.stop()
+        sharedRing.close()
+    sys.exit(status)
@@ -0,0 +1,50 @@
+import os
+import sys
+import json
+import subprocess
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#library modules first, they must not pull in anything in HEAVY; the GUI modules only pay for Qt at import
+MODULES = ["zernike_modes", "z2c_store", "zernike_decompose", "dm_pattern", "dm_worker", "acquisition", "recorder",
+           "recording_reader", "history_pyramid", "sync_capture", "hexapod_scan", "hexapod_controller",
+           "AlpaoDMZernikeControl", "mirror_command_plot"]
+HEAVY = ["PyQt5", "matplotlib", "pandas", "Lib.asdk", "Lib64.asdk", "pipython", "dashboard"]
+
+PROBE = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"ms": elapsed * 1e3, "heavy": [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+def import_time(module, repeats=5):
+    #every import in a fresh interpreter so nothing is already cached in sys.modules
+    env = dict(os.environ, SUMMER_SIMULATE="1", QT_QPA_PLATFORM="offscreen")
+    times = []
+    heavy = []
+    for _ in range(repeats):
+        result = subprocess.run([sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY)], cwd=ROOT, env=env,
+                                capture_output=True, text=True)
+        if result.returncode != 0:
+            return {"error": result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "failed"}
+        probe = json.loads(result.stdout.strip().splitlines()[-1])
+        times.append(probe["ms"])
+        heavy = probe["heavy"]
+    return {"median_ms": float(np.median(times)), "min_ms": float(np.min(times)), "heavy": heavy}
+
+def run(repeats=5):
+    results = {}
+    for module in MODULES:
+        results[module] = import_time(module, repeats)
+        result = results[module]
+        if "error" in result:
+            print(f"{module:>24}: {result['error']}")
+        else:
+            print(f"{module:>24}: {result['median_ms']:8.1f} ms  {', '.join(result['heavy']) or '-'}")
+    return results
+
+if __name__ == "__main__":
+    run()
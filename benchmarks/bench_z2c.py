@@ -0,0 +1,60 @@
+import os
+import sys
+import csv
+import time
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from z2c_store import load_z2c, zernike_to_actuators, clear_cache
+
+nModes = 96
+nAct = 97
+nUpdates = 500
+
+def write_fake_z2c(configDir, serialName):
+    rng = np.random.default_rng(0)
+    Z2C = rng.normal(scale=0.1, size=(nModes, nAct))
+    with open(os.path.join(configDir, serialName + '-Z2C.csv'), 'w', newline='') as csvfile:
+        for row in Z2C:
+            csvfile.write(",".join(f"{value:.9f}" for value in row) + "\n")
+
+def old_update(configDir, serialName, zernike_values):
+    #copy of the per-slider-tick path before the Z2C store existed
+    Z2C = []
+    with open(os.path.join(configDir, serialName + '-Z2C.csv'), newline='') as csvfile:
+        csvrows = csv.reader(csvfile, delimiter=' ')
+        for row in csvrows:
+            x = row[0].split(",")
+            Z2C.append([float(value) for value in x])
+    Z2C = np.array(Z2C)
+    return zernike_to_actuators(Z2C, zernike_values)
+
+def new_update(configDir, serialName, zernike_values):
+    return zernike_to_actuators(load_z2c(serialName, configDir), zernike_values)
+
+def time_updates(update, configDir, serialName):
+    rng = np.random.default_rng(1)
+    samples = rng.uniform(-1, 1, size=(nUpdates, nModes))
+    durations = np.empty(nUpdates)
+    for i in range(nUpdates):
+        start = time.perf_counter()
+        update(configDir, serialName, samples[i])
+        durations[i] = time.perf_counter() - start
+    return durations
+
+def run():
+    results = {}
+    with tempfile.TemporaryDirectory() as configDir:
+        serialName = "BENCH01"
+        write_fake_z2c(configDir, serialName)
+        clear_cache()
+        for name, update in (("csv per update", old_update), ("cached store", new_update)):
+            durations = time_updates(update, configDir, serialName)
+            results[name] = {"median_us": float(np.median(durations) * 1e6), "p99_us": float(np.percentile(durations, 99) * 1e6)}
+        clear_cache()
+    return results
+
+if __name__ == "__main__":
+    for name, stats in run().items():
+        print(f"{name:>15}: median {stats['median_us']:9.1f} us   p99 {stats['p99_us']:9.1f} us")
@@ -0,0 +1,184 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import numpy as np
+
+#everything here runs against the simulated backends, so this has to be set before the tools are imported
+os.environ.setdefault("SUMMER_SIMULATE", "1")
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from simulated_devices import SimulatedDM, SimulatedDevice, SimulatedGCSDevice
+
+def percentiles_us(durations):
+    durations = np.asarray(durations)
+    return {"median_us": float(np.median(durations) * 1e6), "p99_us": float(np.percentile(durations, 99) * 1e6)}
+
+def bench_z2c(options):
+    import bench_z2c
+    return bench_z2c.run()
+
+def bench_startup(options):
+    import bench_startup
+    results = bench_startup.run()
+    #only the numbers go into the results file, the list of heavy modules is printed by the benchmark itself
+    return {module: {key: value for key, value in result.items() if key != "heavy"} for module, result in results.items()}
+
+def bench_dm_send(options):
+    from dm_pattern import compile_pattern_bank, DMSequencer
+    rng = np.random.default_rng(0)
+    Z2C = rng.normal(scale=0.1, size=(96, 97))
+    percentages = rng.uniform(-1, 1, size=(options.frames, 20))
+    start = time.perf_counter()
+    frames = compile_pattern_bank(Z2C, percentages)
+    compileTime = time.perf_counter() - start
+    dm = SimulatedDM("BENCH01", latency=options.dm_latency, jitter=options.dm_jitter)
+    #unthrottled loop first, to see what the driver call itself allows
+    durations = np.empty(len(frames))
+    for i in range(len(frames)):
+        t = time.perf_counter()
+        dm.Send(frames[i])
+        durations[i] = time.perf_counter() - t
+    result = {"compile_frames_per_s": len(frames) / compileTime, "send": percentiles_us(durations),
+              "max_send_rate": float(len(frames) / durations.sum())}
+    result["sequencer"] = DMSequencer(dm, options.dm_rate).play(frames)
+    return result
+
+def bench_mirror_map(options):
+    from PyQt5.QtWidgets import QApplication
+    app = QApplication.instance() or QApplication([])
+    from mirror_command_plot import PlotView
+    from AlpaoDMZernikeControl import ZernikeBarChart
+    rng = np.random.default_rng(0)
+    view = PlotView()
+    view.resize(500, 500)
+    view.show()
+    app.processEvents()
+    view.canvas.draw()
+    durations = []
+    for _ in range(options.redraws):
+        t = time.perf_counter()
+        view.update_colors(rng.uniform(-1, 1, 97))
+        durations.append(time.perf_counter() - t)
+    chart = ZernikeBarChart()
+    chart.resize(800, 400)
+    chart.show()
+    app.processEvents()
+    chart.updateBarChart([0] * 96)
+    barDurations = []
+    values = [0] * 96
+    for i in range(options.redraws):
+        #a slider drag changes one mode at a time
+        values[i % 96] = int(rng.integers(-100, 100))
+        t = time.perf_counter()
+        chart.updateBarChart(values)
+        barDurations.append(time.perf_counter() - t)
+    view.close()
+    chart.close()
+    return {"mirror_map": percentiles_us(durations), "bar_chart_96": percentiles_us(barDurations)}
+
+def bench_acquisition(options):
+    from acquisition import AcquisitionEngine
+    from recorder import StreamRecorder
+    device = SimulatedDevice("/dev/comedi0", latency=options.daq_latency, jitter=options.daq_jitter)
+    engine = AcquisitionEngine(device, 16, options.daq_rate)
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "bench.rec")
+        recorder = StreamRecorder(path, engine.ring, list(range(16)), options.daq_rate)
+        engine.start()
+        recorder.start()
+        time.sleep(options.seconds)
+        engine.stop()
+        recorder.stop()
+        size = os.path.getsize(path)
+    return {"target_rate": options.daq_rate, "achieved_rate": engine.achieved_rate(), "dropped": engine.dropped,
+            "recorded_samples": recorder.rows, "recorder_lost": recorder.lost, "recorded_MB": size / 1e6,
+            "read_latency_us": float(np.mean(engine.cache.latency) * 1e6)}
+
+def bench_hexapod(options):
+    from hexapod_controller import JogEngine
+    pidevice = SimulatedGCSDevice(latency=options.gcs_latency, jitter=options.gcs_jitter)
+    jog = JogEngine(pidevice, maxRate=options.jog_rate, refreshInterval=0.5, verbose=False)
+    jog.start()
+    jog.select_axis("X")
+    start = time.perf_counter()
+    jog.press(1)
+    time.sleep(options.seconds)
+    jog.release(1)
+    elapsed = time.perf_counter() - start
+    jog.stop()
+    count, total, worst = jog.latency["MOV"]
+    return {"target_rate": options.jog_rate, "moves_per_s": count / elapsed,
+            "mov_mean_us": total / count * 1e6 if count else 0.0, "mov_max_us": worst * 1e6}
+
+BENCHMARKS = {
+    "z2c": bench_z2c,
+    "startup": bench_startup,
+    "dm_send": bench_dm_send,
+    "mirror_map": bench_mirror_map,
+    "acquisition": bench_acquisition,
+    "hexapod": bench_hexapod,
+}
+
+def flatten(result, prefix=""):
+    for key, value in result.items():
+        if isinstance(value, dict):
+            yield from flatten(value, f"{prefix}{key}.")
+        elif isinstance(value, (int, float)):
+            yield f"{prefix}{key}", value
+
+def compare(results, previousPath):
+    with open(previousPath) as file:
+        previous = dict(flatten(json.load(file)["results"]))
+    for key, value in flatten(results):
+        if key in previous and previous[key]:
+            print(f"{key:>45}: {previous[key]:12.2f} -> {value:12.2f} ({value / previous[key]:6.2f}x)")
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Benchmark the hot paths against the simulated hardware")
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), help="run only these benchmarks")
+    parser.add_argument("--output", help="json file for the results (default benchmarks/results/<date>.json)")
+    parser.add_argument("--compare", help="earlier results json to compare against")
+    parser.add_argument("--seconds", type=float, default=2.0, help="duration of the timed acquisition and jog runs")
+    parser.add_argument("--frames", type=int, default=2000)
+    parser.add_argument("--redraws", type=int, default=200)
+    parser.add_argument("--dm-rate", type=float, default=1000.0)
+    parser.add_argument("--dm-latency", type=float, default=0.0001)
+    parser.add_argument("--dm-jitter", type=float, default=0.00002)
+    parser.add_argument("--daq-rate", type=float, default=1000.0)
+    parser.add_argument("--daq-latency", type=float, default=0.00002)
+    parser.add_argument("--daq-jitter", type=float, default=0.000005)
+    parser.add_argument("--jog-rate", type=float, default=50.0)
+    parser.add_argument("--gcs-latency", type=float, default=0.002)
+    parser.add_argument("--gcs-jitter", type=float, default=0.0005)
+    return parser.parse_args(args[1:])
+
+def main(args):
+    options = parse_args(args)
+    results = {}
+    for name in options.only or BENCHMARKS:
+        print(f"running {name} ...")
+        try:
+            results[name] = BENCHMARKS[name](options)
+        except ImportError as error:
+            #e.g. no PyQt5 on a headless build box, the other benchmarks still count
+            results[name] = {"skipped": str(error)}
+        for key, value in flatten(results[name]):
+            print(f"  {key:>40}: {value:.2f}")
+    output = options.output or os.path.join(ROOT, "benchmarks", "results", time.strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump({"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+                   "machine": platform.machine(), "options": vars(options), "results": results}, file, indent=2)
+    print(f"saved {output}")
+    if options.compare:
+        compare(results, options.compare)
+
+if __name__ == "__main__":
+    main(sys.argv)
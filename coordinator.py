@@ -0,0 +1,288 @@
+import sys
+import csv
+import time
+import asyncio
+import argparse
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from devices import gcs_device_class, daq_device_class
+from dm_journal import DMJournal, session_path, SOURCE_SCRIPT
+import instrumentation
+
+#one asyncio loop drives the DM, the hexapod and the DAQ together: every device gets a bounded queue of
+#pending calls served in order by one task, and its blocking vendor calls run on that device's own small
+#executor, so a slow qONT never holds up a DM send and scripts can overlap the three with plain awaits
+
+class DeviceChannel:
+    def __init__(self, name, maxPending=64, workers=1):
+        #workers=1 keeps calls to one device serialised, the vendor libraries are not thread safe
+        self.name = name
+        self.queue = asyncio.Queue(maxPending)
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix=name)
+        self.calls = 0
+        self.cancelled = 0
+        self.waited = 0.0 #seconds calls spent queued before they ran
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._serve(), name=self.name)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        #anything still queued is abandoned with the loop
+        while not self.queue.empty():
+            future, _, _, _ = self.queue.get_nowait()
+            future.cancel()
+        self.executor.shutdown(wait=True)
+
+    async def call(self, func, *args):
+        #waits for a free slot when the queue is full (back-pressure), then for the result;
+        #cancelling the caller drops the call if it hasn't started, a call already on the thread runs to the end
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((future, func, args, time.perf_counter()))
+        return await future
+
+    def call_nowait(self, func, *args):
+        #raises asyncio.QueueFull instead of waiting, for producers that would rather skip than stall
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((future, func, args, time.perf_counter()))
+        return future
+
+    async def _serve(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            future, func, args, queued = await self.queue.get()
+            if future.cancelled():
+                self.cancelled += 1
+                continue
+            self.waited += time.perf_counter() - queued
+            try:
+                result = await loop.run_in_executor(self.executor, func, *args)
+            except Exception as error:
+                if not future.cancelled():
+                    future.set_exception(error)
+            else:
+                if not future.cancelled():
+                    future.set_result(result)
+            self.calls += 1
+
+    def stats(self):
+        return {"device": self.name, "calls": self.calls, "cancelled": self.cancelled, "pending": self.queue.qsize(),
+                "mean_wait_ms": 1e3 * self.waited / self.calls if self.calls else 0.0}
+
+class AsyncDM:
+    #asdk.DM (or a dm_server client) behind a channel
+    def __init__(self, dm, maxPending=64, journal=None):
+        self.dm = dm
+        self.channel = DeviceChannel("dm", maxPending)
+        self.send_blocking = instrumentation.timed("dm.send", dm.Send)
+        self.journal = journal
+
+    async def actuators(self):
+        return int(await self.channel.call(self.dm.Get, 'NBOfActuator'))
+
+    def _send(self, values, coefficients, source):
+        self.send_blocking(values)
+        if self.journal is not None:
+            self.journal.append(source, values, coefficients)
+
+    async def send(self, values, coefficients=None, source=SOURCE_SCRIPT):
+        await self.channel.call(self._send, np.asarray(values, dtype=np.float64), coefficients, source)
+
+    async def reset(self):
+        await self.channel.call(self.dm.Reset)
+
+class AsyncHexapod:
+    #pipython GCSDevice behind a channel; settling polls with asyncio sleeps, so the loop is free meanwhile
+    def __init__(self, pidevice, maxPending=16, minPoll=0.001, maxPoll=0.05, backoff=1.5, settleTimeout=30.0):
+        self.pidevice = pidevice
+        self.channel = DeviceChannel("hexapod", maxPending)
+        self.MOV = instrumentation.timed("hexapod.MOV", pidevice.MOV)
+        self.qPOS = instrumentation.timed("hexapod.qPOS", pidevice.qPOS)
+        self.qONT = instrumentation.timed("hexapod.qONT", pidevice.qONT)
+        self.minPoll = minPoll
+        self.maxPoll = maxPoll
+        self.backoff = backoff
+        self.settleTimeout = settleTimeout
+
+    async def position(self, axes=None):
+        return dict(await self.channel.call(self.qPOS, axes))
+
+    async def on_target(self, axes=None):
+        return all((await self.channel.call(self.qONT, axes)).values())
+
+    async def move(self, target):
+        #target: {axis: value}, sent as one combined MOV
+        axes = list(target)
+        await self.channel.call(self.MOV, axes, [target[axis] for axis in axes])
+
+    async def wait_on_target(self, axes=None):
+        #same backed-off polling as hexapod_scan.ScanEngine, with the sleeps handed back to the loop
+        start = time.perf_counter()
+        interval = self.minPoll
+        while not await self.on_target(axes):
+            if time.perf_counter() - start > self.settleTimeout:
+                raise TimeoutError(f"Axes {axes} not on target after {self.settleTimeout} s")
+            await asyncio.sleep(interval)
+            interval = min(interval * self.backoff, self.maxPoll)
+        return time.perf_counter() - start
+
+    async def move_and_settle(self, target):
+        await self.move(target)
+        return await self.wait_on_target(list(target))
+
+class AsyncDAQ:
+    #dashboard.device.Device behind a channel; a whole averaged read runs as one call on the executor,
+    #its timing loop stays on the device thread instead of being paced by the event loop
+    def __init__(self, device, nChannels=16, maxPending=16):
+        self.device = device
+        self.nChannels = nChannels
+        self.channel = DeviceChannel("daq", maxPending)
+
+    def _read_row(self):
+        if hasattr(self.device, 'analog_read_all'):
+            return np.asarray(self.device.analog_read_all()[:self.nChannels], dtype=np.float64)
+        return np.array([self.device.analog_read(i) for i in range(self.nChannels)])
+
+    def _read_rows(self, samples, rate):
+        rows = np.empty((samples, self.nChannels))
+        period = 1.0 / rate if rate else 0.0
+        deadline = time.perf_counter()
+        for i in range(samples):
+            start = instrumentation.now() if instrumentation.ENABLED else 0
+            rows[i] = self._read_row()
+            if start:
+                instrumentation.record("daq.read", start)
+            deadline += period
+            remaining = deadline - time.perf_counter()
+            if remaining > 0:
+                time.sleep(remaining)
+        return rows
+
+    async def read(self):
+        return await self.channel.call(self._read_row)
+
+    async def acquire(self, samples, rate=0.0):
+        #(samples, channels), rate 0 reads back to back
+        return await self.channel.call(self._read_rows, samples, rate)
+
+    async def average(self, samples, rate=0.0):
+        return (await self.acquire(samples, rate)).mean(axis=0)
+
+class Coordinator:
+    #async context that starts the device channels and shuts their executors down again:
+    #    async with Coordinator(dm=AsyncDM(dm), hexapod=AsyncHexapod(pidevice)) as devices: ...
+    def __init__(self, dm=None, hexapod=None, daq=None):
+        self.dm = dm
+        self.hexapod = hexapod
+        self.daq = daq
+
+    def adapters(self):
+        return [adapter for adapter in (self.dm, self.hexapod, self.daq) if adapter is not None]
+
+    async def __aenter__(self):
+        for adapter in self.adapters():
+            adapter.channel.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        for adapter in self.adapters():
+            await adapter.channel.stop()
+
+    def stats(self):
+        return [adapter.channel.stats() for adapter in self.adapters()]
+
+async def scan(devices, waypoints, frames, samples=10, rate=0.0, dwell=0.0, log=None):
+    #for every waypoint: start the hexapod move, send the matching DM frame while it settles,
+    #then read the DAQ once both are done
+    results = []
+    start = time.perf_counter()
+    for index, waypoint in enumerate(waypoints):
+        tasks = [devices.hexapod.move_and_settle(waypoint)]
+        if frames is not None and len(frames):
+            tasks.append(devices.dm.send(frames[index % len(frames)]))
+        settled = await asyncio.gather(*tasks)
+        if dwell:
+            await asyncio.sleep(dwell)
+        values = await devices.daq.average(samples, rate) if devices.daq is not None else np.empty(0)
+        results.append((time.perf_counter() - start, index, settled[0], waypoint, values))
+        if log is not None:
+            log.writerow([f"{results[-1][0]:.6f}", index, f"{settled[0]:.4f}"] + [f"{waypoint.get(a, '')}" for a in "XYZUVW"]
+                         + [f"{v:.6g}" for v in values])
+    return results
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Step the hexapod through waypoints, sending a DM frame and reading the DAQ at each one")
+    parser.add_argument("--waypoints", help="csv of waypoints with X,Y,Z,U,V,W columns")
+    parser.add_argument("--raster", nargs="+", metavar="AXIS=START:STOP:STEPS", help="raster axes, the first one is the slowest")
+    parser.add_argument("--frames", help="DM frames: compiled bank .npy, journal .djr or a pattern (with --serial)")
+    parser.add_argument("--serial", default="BAX758", help="mirror serial")
+    parser.add_argument("--config", default="./config", help="folder with the <serial>-Z2C.csv files")
+    parser.add_argument("--samples", type=int, default=10, help="DAQ rows averaged at each waypoint")
+    parser.add_argument("--rate", type=float, default=0.0, help="DAQ rows per second, 0 for back to back")
+    parser.add_argument("--dwell", type=float, default=0.0, help="seconds to wait once on target before reading")
+    parser.add_argument("--output", default="coordinated_scan.csv", help="csv with settle times and averaged channels")
+    parser.add_argument("--journal", help="journal file for the DM frames sent (default journal/<serial>-<date>.djr)")
+    parser.add_argument("--no-journal", action="store_true", help="don't record the frames sent to the mirror")
+    parser.add_argument("--simulate", action="store_true", help="use the simulated devices")
+    parser.add_argument("--instrument", action="store_true", help="record per-stage latency histograms, written to json on exit")
+    return parser.parse_args(args[1:])
+
+async def run(options, waypoints, frames):
+    from dm_server import connect_or_open
+    pidevice = gcs_device_class()('C-887')
+    pidevice.InterfaceSetupDlg()
+    dm = connect_or_open(options.serial, name="coordinator") if frames is not None else None
+    journal = None
+    #through a DM server the frames land in the server's journal instead
+    if dm is not None and not options.no_journal and not hasattr(dm, "send_batch"):
+        journal = DMJournal(options.journal or session_path(options.serial), int(dm.Get('NBOfActuator')), serialName=options.serial)
+    devices = Coordinator(dm=AsyncDM(dm, journal=journal) if dm is not None else None, hexapod=AsyncHexapod(pidevice),
+                          daq=AsyncDAQ(daq_device_class()('/dev/comedi0')))
+    try:
+        with open(options.output, 'w', newline='') as file:
+            log = csv.writer(file)
+            log.writerow(["time", "index", "settle_s"] + [f"target_{a}" for a in "XYZUVW"] + [f"channel_{i}" for i in range(16)])
+            async with devices:
+                start = time.perf_counter()
+                await scan(devices, waypoints, frames, options.samples, options.rate, options.dwell, log)
+                elapsed = time.perf_counter() - start
+                stats = devices.stats()
+    finally:
+        if journal is not None:
+            journal.close()
+            print(f"Journal: {journal.path}")
+        if dm is not None and hasattr(dm, "close"):
+            dm.close()
+    print(f"{len(waypoints)} waypoints in {elapsed:.2f} s ({len(waypoints) / elapsed:.2f} per second), log in {options.output}")
+    for line in stats:
+        print(f"{line['device']:>8}: {line['calls']} calls, {line['cancelled']} cancelled, mean wait {line['mean_wait_ms']:.2f} ms")
+
+def main(args):
+    from hexapod_scan import load_waypoints, parse_raster, raster_waypoints
+    options = parse_args(args)
+    if options.waypoints:
+        waypoints = load_waypoints(options.waypoints)
+    elif options.raster:
+        waypoints = raster_waypoints(parse_raster(options.raster))
+    else:
+        print("Give --waypoints or --raster")
+        return
+    if len(waypoints) == 0:
+        print("No waypoints to visit")
+        return
+    frames = None
+    if options.frames:
+        from mirror_render import load_frames
+        frames = np.asarray(load_frames(options.frames, options.serial, options.config), dtype=np.float64)
+    asyncio.run(run(options, waypoints, frames))
+
+if __name__ == "__main__":
+    main(sys.argv)
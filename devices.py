@@ -0,0 +1,34 @@
+import os
+import sys
+import struct
+
+#pick the real vendor backends or the simulated stand-ins, with SUMMER_SIMULATE=1 or --simulate
+def simulated():
+    return os.environ.get("SUMMER_SIMULATE", "") not in ("", "0") or "--simulate" in sys.argv
+
+def dm_class():
+    if simulated():
+        from simulated_devices import SimulatedDM
+        return SimulatedDM
+    # Add '/Lib' or '/Lib64' to path
+    if (8 * struct.calcsize("P")) == 32:
+        print("Use x86 libraries.")
+        from Lib.asdk import DM
+    else:
+        print("Use x86_64 libraries.")
+        from Lib64.asdk import DM
+    return DM
+
+def daq_device_class():
+    if simulated():
+        from simulated_devices import SimulatedDevice
+        return SimulatedDevice
+    from dashboard.device import Device
+    return Device
+
+def gcs_device_class():
+    if simulated():
+        from simulated_devices import SimulatedGCSDevice
+        return SimulatedGCSDevice
+    from pipython import GCSDevice
+    return GCSDevice
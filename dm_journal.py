@@ -0,0 +1,223 @@
+import os
+import sys
+import json
+import time
+import struct
+import argparse
+import numpy as np
+
+#journal file layout: 8 byte magic, uint32 header size, 4 spare bytes, int64 count of records ever written,
+#json metadata padded to the header size, then `capacity` fixed-size records used as a ring; the file is
+#preallocated and memory-mapped, so appending a command only writes into pages that already exist
+MAGIC = b"DMJRNL1\0"
+HEADER_SIZE = 4096
+WRITTEN_OFFSET = 16
+META_OFFSET = 24
+
+SOURCES = ["gui", "pattern", "replay", "undo", "script"]
+SOURCE_GUI, SOURCE_PATTERN, SOURCE_REPLAY, SOURCE_UNDO, SOURCE_SCRIPT = range(len(SOURCES))
+
+def record_dtype(nAct, maxModes=96):
+    return np.dtype([
+        ("time", "<f8"), #wall clock, so entries line up with lab notes and other logs
+        ("source", "u1"),
+        ("modes", "<u2"), #number of valid coefficients, 0 when the command had none
+        ("coefficients", "<f4", (maxModes,)),
+        ("actuators", "<f4", (nAct,)),
+    ])
+
+def session_path(serialName, folder="./journal"):
+    return os.path.join(folder, f"{serialName}-{time.strftime('%Y%m%d-%H%M%S')}.djr")
+
+class DMJournal:
+    def __init__(self, path, nAct=None, capacity=1 << 16, maxModes=96, serialName=""):
+        #a new journal when nAct is given, otherwise an existing one is opened for reading
+        self.path = path
+        if nAct is not None:
+            meta = {"version": 1, "nAct": int(nAct), "maxModes": int(maxModes), "capacity": int(capacity),
+                    "serial": serialName, "sources": SOURCES, "created": time.strftime("%Y-%m-%dT%H:%M:%S")}
+            dtype = record_dtype(nAct, maxModes)
+            folder = os.path.dirname(os.path.abspath(path))
+            os.makedirs(folder, exist_ok=True)
+            with open(path, 'wb') as file:
+                encoded = json.dumps(meta).encode()
+                file.write(MAGIC + struct.pack("<I", HEADER_SIZE) + bytes(4) + struct.pack("<q", 0) + encoded.ljust(HEADER_SIZE - META_OFFSET))
+                #sparse preallocation: the size is reserved now, the disk only fills as records are written
+                file.truncate(HEADER_SIZE + capacity * dtype.itemsize)
+            mode = 'r+'
+        else:
+            mode = 'r'
+        with open(path, 'rb') as file:
+            if file.read(8) != MAGIC:
+                raise ValueError("Not a DM journal")
+            headerSize, = struct.unpack("<I", file.read(4))
+            file.seek(META_OFFSET)
+            self.meta = json.loads(file.read(headerSize - META_OFFSET).decode())
+        self.nAct = self.meta["nAct"]
+        self.maxModes = self.meta["maxModes"]
+        self.capacity = self.meta["capacity"]
+        self.dtype = record_dtype(self.nAct, self.maxModes)
+        self.writable = mode == 'r+' #False when reading another process's journal, e.g. the DM server's
+        self.counter = np.memmap(path, dtype="<i8", mode=mode, offset=WRITTEN_OFFSET, shape=(1,))
+        self.records = np.memmap(path, dtype=self.dtype, mode=mode, offset=headerSize, shape=(self.capacity,))
+        #field views made once, appending writes straight through them
+        self.times = self.records["time"]
+        self.sources = self.records["source"]
+        self.modes = self.records["modes"]
+        self.coefficients = self.records["coefficients"]
+        self.actuators = self.records["actuators"]
+
+    @property
+    def written(self):
+        return int(self.counter[0])
+
+    def __len__(self):
+        return min(self.written, self.capacity)
+
+    def append(self, source, actuators, coefficients=None, stamp=None):
+        written = int(self.counter[0])
+        i = written % self.capacity
+        self.times[i] = time.time() if stamp is None else stamp
+        self.sources[i] = source
+        self.actuators[i] = actuators
+        if coefficients is None:
+            self.modes[i] = 0
+        else:
+            n = min(len(coefficients), self.maxModes)
+            self.modes[i] = n
+            self.coefficients[i, :n] = coefficients[:n]
+        #the count goes last, so a reader never sees a half written record as valid
+        self.counter[0] = written + 1
+
+    def index(self, k):
+        #ring slot of the k-th record ever written
+        return k % self.capacity
+
+    def entry(self, k):
+        i = self.index(k)
+        return self.records[i].copy()
+
+    def ordered(self, start=None, stop=None):
+        #records [start, stop) counted from the first ever written, oldest first, as a copy
+        written = self.written
+        first = max(0, written - self.capacity)
+        start = first if start is None else max(start, first)
+        stop = written if stop is None else min(stop, written)
+        return self.records[np.arange(start, stop) % self.capacity]
+
+    def time_range(self, t0=None, t1=None):
+        records = self.ordered()
+        keep = np.ones(len(records), dtype=bool)
+        if t0 is not None:
+            keep &= records["time"] >= t0
+        if t1 is not None:
+            keep &= records["time"] <= t1
+        return records[keep]
+
+    def flush(self):
+        if not self.writable:
+            return
+        self.records.flush()
+        self.counter.flush()
+
+    def close(self):
+        self.flush()
+        del self.times, self.sources, self.modes, self.coefficients, self.actuators
+        del self.records, self.counter
+
+def export(records, path):
+    #.npy keeps the structured records as they are, .csv gets one column per coefficient and actuator
+    if path.endswith(".npy"):
+        np.save(path, records)
+        return
+    maxModes = records.dtype["coefficients"].shape[0]
+    nAct = records.dtype["actuators"].shape[0]
+    with open(path, 'w') as file:
+        file.write(",".join(["time", "source", "modes"] + [f"c{i + 1}" for i in range(maxModes)] + [f"a{i}" for i in range(nAct)]) + "\n")
+        for record in records:
+            file.write(f"{record['time']:.6f},{SOURCES[record['source']]},{record['modes']},")
+            file.write(",".join(f"{v:.7g}" for v in record["coefficients"]) + ",")
+            file.write(",".join(f"{v:.7g}" for v in record["actuators"]) + "\n")
+
+def replay(records, dm, speed=1.0, journal=None, spinTime=0.002):
+    #sends the commands again with their original spacing divided by speed; speed 0 sends back to back
+    if len(records) == 0:
+        return 0
+    times = records["time"] - records["time"][0]
+    actuators = np.ascontiguousarray(records["actuators"], dtype=np.float64)
+    clock = time.perf_counter
+    start = clock()
+    for i in range(len(records)):
+        if speed > 0:
+            deadline = start + times[i] / speed
+            remaining = deadline - clock()
+            if remaining > spinTime:
+                time.sleep(remaining - spinTime)
+            while clock() < deadline:
+                pass
+        dm.Send(actuators[i])
+        if journal is not None:
+            record = records[i]
+            journal.append(SOURCE_REPLAY, actuators[i], record["coefficients"][:record["modes"]] if record["modes"] else None)
+    return len(records)
+
+def parse_time(text):
+    #seconds since the epoch, or HH:MM:SS on the day the journal was created
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+def select(journal, options):
+    records = journal.ordered()
+    if options.start is not None or options.end is not None:
+        day = time.strftime("%Y-%m-%d", time.localtime(records["time"][0])) if len(records) else time.strftime("%Y-%m-%d")
+        bounds = []
+        for text in (options.start, options.end):
+            if text is None:
+                bounds.append(None)
+            elif parse_time(text) is not None:
+                bounds.append(parse_time(text))
+            else:
+                bounds.append(time.mktime(time.strptime(f"{day} {text}", "%Y-%m-%d %H:%M:%S")))
+        records = journal.time_range(*bounds)
+    if options.source:
+        records = records[np.isin(records["source"], [SOURCES.index(s) for s in options.source])]
+    return records
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Inspect, export and replay DM command journals")
+    parser.add_argument("command", choices=["info", "export", "replay"])
+    parser.add_argument("journal", help=".djr journal file")
+    parser.add_argument("--start", help="first time to include, epoch seconds or HH:MM:SS")
+    parser.add_argument("--end", help="last time to include, epoch seconds or HH:MM:SS")
+    parser.add_argument("--source", nargs="+", choices=SOURCES, help="only commands from these sources")
+    parser.add_argument("--output", help="export file, .npy or .csv")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed factor, 0 for as fast as the mirror takes them")
+    parser.add_argument("--simulate", action="store_true", help="replay on the simulated DM")
+    return parser.parse_args(args[1:])
+
+def main(args):
+    options = parse_args(args)
+    journal = DMJournal(options.journal)
+    records = select(journal, options)
+    if options.command == "info":
+        print(f"{journal.meta['serial']}: {journal.written} commands written, {len(journal)} kept, {journal.nAct} actuators")
+        if len(records):
+            print(f"{time.ctime(records['time'][0])} -> {time.ctime(records['time'][-1])}")
+            for source, name in enumerate(SOURCES):
+                print(f"{name:>8}: {np.count_nonzero(records['source'] == source)}")
+    elif options.command == "export":
+        output = options.output or os.path.splitext(options.journal)[0] + ".npy"
+        export(records, output)
+        print(f"{len(records)} commands exported to {output}")
+    else:
+        from devices import dm_class
+        dm = dm_class()(journal.meta["serial"] or "replay")
+        start = time.perf_counter()
+        sent = replay(records, dm, options.speed)
+        print(f"Replayed {sent} commands in {time.perf_counter() - start:.2f} s")
+        dm.Reset()
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -1,71 +1,240 @@
 import sys
 import time
-import struct
+import argparse
 import numpy as np
-import pandas as pd
-import csv
+from z2c_store import load_z2c
+from dm_server import connect_or_open
+import instrumentation
+from zernike_modes import load_pattern_percentages
+from pattern_stream import iter_pattern_blocks, iter_actuator_blocks, prefetch
+from dm_journal import DMJournal, session_path, SOURCE_PATTERN
 
-# Add '/Lib' or '/Lib64' to path
-if (8 * struct.calcsize("P")) == 32:
-    print("Use x86 libraries.")
-    from Lib.asdk import DM
-else:
-    print("Use x86_64 libraries.")
-    from Lib64.asdk import DM
+def compile_pattern_bank(Z2C, zernike_percentages, bankPath=None, chunkRows=4096):
+    #project every pattern row at once into a contiguous (frames x actuators) float64 array
+    zernike_percentages = np.asarray(zernike_percentages, dtype=np.float64)
+    nFrames, nModes = zernike_percentages.shape
+    modes = Z2C[:nModes]
+    nAct = modes.shape[1]
+    if bankPath:
+        frames = np.lib.format.open_memmap(bankPath, mode='w+', dtype=np.float64, shape=(nFrames, nAct))
+    else:
+        frames = np.empty((nFrames, nAct), dtype=np.float64)
+    #work through the table in blocks so temporaries stay small for very long sequences
+    for start in range(0, nFrames, chunkRows):
+        block = frames[start:start + chunkRows]
+        np.matmul(zernike_percentages[start:start + chunkRows], modes, out=block)
+        #same [-1,1] rescale as zernike_to_actuators, applied only to the rows that need it
+        blockMax = block.max(axis=1)
+        blockMin = block.min(axis=1)
+        outOfRange = (blockMax > 1) | (blockMin < -1)
+        if outOfRange.any():
+            span = (blockMax - blockMin)[outOfRange, None]
+            block[outOfRange] = 2 * (block[outOfRange] - blockMin[outOfRange, None]) / span - 1
+    if bankPath:
+        frames.flush()
+    return frames
 
-file_path = r""
-zernike_data = pd.read_csv(file_path, header=None)
+def load_pattern_bank(bankPath):
+    return np.load(bankPath, mmap_mode='r')
 
-def convert_to_percentages(zernike_data):
-    ranges = zernike_data.iloc[1, :].str.extract(r'\[(-?\d+),(-?\d+)\]')
-    ranges.columns = ['min', 'max']
-    ranges = ranges.astype(float)
-    values = zernike_data.iloc[2:, :].astype(float).values
-    max_vals = ranges['max'].values
-    percentages = (values / max_vals)
-    return percentages
+class DMSequencer:
+    def __init__(self, dm, rate, spinTime=0.002, journal=None):
+        self.dm = dm
+        self.journal = journal #every frame sent is appended to this dm_journal.DMJournal when given
+        self.period = 1.0 / rate
+        #sleep until this long before each deadline, then spin so the send lands on time
+        self.spinTime = spinTime
+        #a dm_server client takes whole blocks and the server keeps the deadlines, instead of one socket
+        #round-trip per frame; the server journals what it sends, so the sequencer doesn't
+        self.batched = hasattr(dm, "send_batch")
+        if self.batched:
+            self.journal = None
+
+    def _send(self, frames, start, k, sendTimes, coefficients=None):
+        send = instrumentation.timed("dm.send", self.dm.Send)
+        journal = self.journal
+        period = self.period
+        spinTime = self.spinTime
+        clock = time.perf_counter
+        for i in range(len(frames)):
+            #deadlines are absolute from the start, so a late frame never shifts the ones after it
+            deadline = start + (k + i) * period
+            remaining = deadline - clock()
+            if remaining > spinTime:
+                time.sleep(remaining - spinTime)
+            while clock() < deadline:
+                pass
+            sendTimes[i] = clock()
+            send(frames[i])
+            if journal is not None:
+                journal.append(SOURCE_PATTERN, frames[i], None if coefficients is None else coefficients[i])
+        return k + len(frames)
+
+    def _send_batches(self, blocks):
+        #timing comes back from the server: lateness against each batch's own period grid
+        totals = {"frames": 0, "first": None, "last": None, "late_sum": 0.0, "late_sq": 0.0, "late_max": 0.0, "missed": 0}
+        for block in blocks:
+            reply = self.dm.send_batch(block, period=self.period, source=SOURCE_PATTERN)
+            totals["frames"] += reply["sent"]
+            for key in ("late_sum", "late_sq", "missed"):
+                totals[key] += reply[key]
+            totals["late_max"] = max(totals["late_max"], reply["late_max"])
+            if totals["first"] is None:
+                totals["first"] = reply["first"]
+            totals["last"] = reply["last"]
+        k = totals["frames"]
+        mean = totals["late_sum"] / k if k else 0.0
+        elapsed = (totals["last"] - totals["first"]) if k else 0.0
+        return {
+            "frames": k,
+            "target_rate": 1.0 / self.period,
+            "achieved_rate": float((k - 1) / elapsed) if elapsed > 0 else 0.0,
+            "jitter_ms": float(np.sqrt(max(0.0, totals["late_sq"] / k - mean * mean)) * 1e3) if k else 0.0,
+            "max_late_ms": float(totals["late_max"] * 1e3),
+            "missed_deadlines": totals["missed"],
+        }
+
+    def play(self, frames, repeat=1, coefficients=None):
+        if self.batched:
+            return self._send_batches(frames for _ in range(repeat))
+        nFrames = len(frames)
+        #preallocated so the send loop itself doesn't create python objects per frame
+        sendTimes = np.empty(nFrames * repeat, dtype=np.float64)
+        start = time.perf_counter() + self.period
+        k = 0
+        for _ in range(repeat):
+            k = self._send(frames, start, k, sendTimes[k:k + nFrames], coefficients)
+        return self.report(sendTimes, start)
+
+    def play_stream(self, blocks):
+        #blocks of actuator frames from a generator (see pattern_stream), played on one continuous deadline
+        #grid; only running lateness sums are kept so memory doesn't grow with the sequence
+        if self.batched:
+            return self._send_batches(blocks)
+        start = None
+        k = 0
+        total = totalSq = 0.0
+        worst = -np.inf
+        missed = 0
+        first = last = 0.0
+        for block in blocks:
+            if start is None:
+                start = time.perf_counter() + self.period
+            sendTimes = np.empty(len(block), dtype=np.float64)
+            self._send(block, start, k, sendTimes)
+            lateness = sendTimes - (start + (k + np.arange(len(block))) * self.period)
+            if k == 0:
+                first = sendTimes[0]
+            last = sendTimes[-1]
+            k += len(block)
+            total += lateness.sum()
+            totalSq += np.square(lateness).sum()
+            worst = max(worst, lateness.max())
+            missed += int(np.count_nonzero(lateness > self.period / 2))
+        mean = total / k if k else 0.0
+        elapsed = last - first
+        return {
+            "frames": k,
+            "target_rate": 1.0 / self.period,
+            "achieved_rate": float((k - 1) / elapsed) if elapsed > 0 else 0.0,
+            "jitter_ms": float(np.sqrt(max(0.0, totalSq / k - mean * mean)) * 1e3) if k else 0.0,
+            "max_late_ms": float(worst * 1e3) if k else 0.0,
+            "missed_deadlines": missed,
+        }
+
+    def report(self, sendTimes, start):
+        lateness = sendTimes - (start + np.arange(len(sendTimes)) * self.period)
+        elapsed = sendTimes[-1] - sendTimes[0] if len(sendTimes) > 1 else 0.0
+        return {
+            "frames": len(sendTimes),
+            "target_rate": 1.0 / self.period,
+            "achieved_rate": float((len(sendTimes) - 1) / elapsed) if elapsed > 0 else 0.0,
+            "jitter_ms": float(np.std(lateness) * 1e3),
+            "max_late_ms": float(np.max(lateness) * 1e3),
+            #a deadline counts as missed when the send went out more than half a period late
+            "missed_deadlines": int(np.count_nonzero(lateness > self.period / 2)),
+        }
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Play a Zernike pattern table on the DM")
+    parser.add_argument("pattern", nargs="?", help="pattern csv (row 2 holds the [min,max] ranges) or binary .zpat")
+    parser.add_argument("--rate", type=float, default=0.2, help="frames per second (mirror can go to around 200)")
+    parser.add_argument("--repeat", type=int, default=1, help="number of times to play the whole table")
+    parser.add_argument("--bank", help="save the compiled frames to this .npy bank, or play it directly if no pattern is given")
+    parser.add_argument("--journal", help="journal file for the frames sent (default journal/<serial>-<date>.djr)")
+    parser.add_argument("--no-journal", action="store_true", help="don't record the frames sent to the mirror")
+    parser.add_argument("--stream", action="store_true", help="parse and project the pattern block by block while playing, for very long sequences")
+    parser.add_argument("--simulate", action="store_true", help="use the simulated DM instead of the hardware")
+    parser.add_argument("--instrument", action="store_true", help="record per-stage latency histograms, written to json on exit")
+    parser.add_argument("--share-clock", action="store_true", help="stamp every send with monotonic time in shared memory for sync_capture")
+    return parser.parse_args(args[1:])
 
 def main(args):
+    options = parse_args(args)
+    if options.pattern is None and options.bank is None:
+        print("Give a pattern file or a compiled --bank to play")
+        return
     print("Please enter the S/N within the following format BXXYYY (see DM backside): ")
     serialName = input().strip()
+    Z2C = None
+    if options.pattern is not None:
+        #before the mirror, the ring or the journal are opened, a missing file leaves nothing behind
+        try:
+            Z2C = load_z2c(serialName)
+        except FileNotFoundError:
+            print("File Error", "Configuration file not found")
+            return
     print("Connect the mirror")
-    dm = DM(serialName)
-    print("Retrieve number of actuators")
-    nbAct = int(dm.Get('NBOfActuator'))
-    print(f"Number of actuators for {serialName}: {nbAct}")
-    print("Send 0 on each actuator")
-    values = [0.] * nbAct
-    dm.Send(values)
-
-    zernike_percentages = convert_to_percentages(zernike_data)
-    Z2C = []
+    device = dm = connect_or_open(serialName, name="pattern")
+    dmRing = None
+    journal = None
     try:
-        with open('./config/' + serialName + '-Z2C.csv', newline='') as csvfile:
-            csvrows = csv.reader(csvfile, delimiter=' ')
-            for row in csvrows:
-                x = row[0].split(",")
-                Z2C.append([float(value) for value in x])
-    except FileNotFoundError:
-        print("File Error", "Configuration file not found")
-    Z2C = np.array(Z2C)
-
-    counter = 0
-    counter_max = 5 #maximum of iterations to go through
-    while counter < counter_max:
-        for i in range(counter_max):
-            zernike_values = Z2C[:len(zernike_percentages[i])].T @ zernike_percentages[i]
+        if options.share_clock and hasattr(dm, "send_batch"):
+            print("Sends go through the DM server, start it with --share-clock to stamp them")
+        elif options.share_clock:
+            from sync_capture import SharedRing, TimedDM, DM_RING
+            dmRing = SharedRing(DM_RING, 2, 1 << 16, create=True)
+            dm = TimedDM(dm, dmRing)
+        print("Retrieve number of actuators")
+        nbAct = int(dm.Get('NBOfActuator'))
+        print(f"Number of actuators for {serialName}: {nbAct}")
+        print("Send 0 on each actuator")
+        values = [0.] * nbAct
+        dm.Send(values)
 
-            if (np.max(zernike_values)>1) or (np.min(zernike_values) < -1):
-                zernike_values = (zernike_values - zernike_values.min()) / (zernike_values.max() - zernike_values.min())  #scales to [0,1]
-                zernike_values = 2 * zernike_values - 1  #scales to [-1,1]
-            
-            dm.Send(zernike_values)
-            time.sleep(5) #time in between patterns, can go to around 0.005 seconds
-            counter += 1
-            if counter > counter_max:
-                break
-    print("Send 0 on all actuators")
-    dm.Reset()
+        if hasattr(dm, "framePeriod") and dm.framePeriod > 1.0 / options.rate:
+            print(f"The DM server sends at most one frame every {dm.framePeriod * 1e3:g} ms, start it with a smaller --frame-period for {options.rate:g} Hz")
+        #through a DM server the frames land in the server's journal instead
+        if not options.no_journal and not hasattr(dm, "send_batch"):
+            journal = DMJournal(options.journal or session_path(serialName), nbAct, serialName=serialName)
+        sequencer = DMSequencer(dm, options.rate, journal=journal)
+        if options.pattern is not None and options.stream:
+            #the first block plays as soon as it is parsed, the rest is read ahead on a helper thread
+            print(f"Streaming {options.pattern} at {options.rate:g} Hz")
+            blocks = (block for _ in range(options.repeat) for block in iter_actuator_blocks(Z2C, iter_pattern_blocks(options.pattern)))
+            stats = sequencer.play_stream(prefetch(blocks))
+        else:
+            zernike_percentages = None
+            if options.pattern is not None:
+                zernike_percentages = load_pattern_percentages(options.pattern)
+                frames = compile_pattern_bank(Z2C, zernike_percentages, options.bank)
+            else:
+                frames = load_pattern_bank(options.bank)
+            print(f"Playing {len(frames)} patterns at {options.rate:g} Hz")
+            stats = sequencer.play(frames, options.repeat, zernike_percentages)
+        print(f"Achieved {stats['achieved_rate']:.2f} Hz, jitter {stats['jitter_ms']:.3f} ms, "
+              f"{stats['missed_deadlines']} missed deadlines out of {stats['frames']} frames")
+        print("Send 0 on all actuators")
+        dm.Reset()
+    finally:
+        #same cleanup whether playback finished or failed part way
+        if dmRing is not None:
+            dmRing.close()
+        if journal is not None:
+            journal.close()
+            print(f"Journal: {journal.path}")
+        if hasattr(device, "close"):
+            device.close()
 
 if __name__ == "__main__":
     main(sys.argv)
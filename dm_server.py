@@ -0,0 +1,477 @@
+import os
+import sys
+import json
+import time
+import heapq
+import socket
+import argparse
+import threading
+import numpy as np
+from multiprocessing import shared_memory
+import instrumentation
+from devices import dm_class
+from sync_capture import attach_shared_memory
+from dm_journal import DMJournal, session_path, SOURCE_GUI, SOURCE_SCRIPT
+
+#one process owns the mirror and every other tool talks to it over a unix socket: requests are short json
+#lines, actuator frames never go through the socket, they are written into a shared-memory block the server
+#creates for each client and the request only says which slots to send
+def socket_path(serialName):
+    return os.path.join("/tmp", f"summer-dm-{serialName}.sock")
+
+class _Job:
+    def __init__(self, client, frames, coefficients, period, priority, seq, source=None):
+        self.client = client
+        self.frames = frames
+        self.coefficients = coefficients
+        self.source = source #dm_journal source the client asked for, otherwise taken from its name
+        self.period = period
+        self.priority = priority
+        self.seq = seq
+        self.index = 0
+        self.start = None
+        self.last = None
+        #lateness against the job's own period grid, returned with the reply
+        self.lateSum = 0.0
+        self.lateSq = 0.0
+        self.lateMax = 0.0
+        self.missed = 0
+        self.received = time.perf_counter()
+        self.cancelled = False
+        self.error = None #set when the driver failed on one of the job's frames
+        self.done = threading.Event()
+
+    def __lt__(self, other):
+        #higher priority first, then first come first served
+        return (-self.priority, self.seq) < (-other.priority, other.seq)
+
+class _Client:
+    def __init__(self, server, connection, clientId):
+        self.server = server
+        self.connection = connection
+        self.id = clientId
+        self.name = f"client {clientId}"
+        self.priority = 0
+        self.shm = None
+        self.frames = None
+        self.connected = time.perf_counter()
+        self.batches = 0
+        self.sent = 0
+        self.busy = 0 #requests turned away because the queue was full
+        self.totalLatency = 0.0
+        self.maxLatency = 0.0
+        self.totalWait = 0.0
+
+    def stats(self):
+        elapsed = time.perf_counter() - self.connected
+        return {
+            "name": self.name,
+            "priority": self.priority,
+            "batches": self.batches,
+            "frames": self.sent,
+            "frames_per_s": self.sent / elapsed if elapsed > 0 else 0.0,
+            "mean_latency_ms": self.totalLatency / self.batches * 1e3 if self.batches else 0.0,
+            "max_latency_ms": self.maxLatency * 1e3,
+            "mean_queue_wait_ms": self.totalWait / self.batches * 1e3 if self.batches else 0.0,
+            "busy": self.busy,
+        }
+
+class DMServer:
+    def __init__(self, dm, path, framePeriod=0.005, maxPending=4096, slots=1024, journal=None):
+        self.dm = dm
+        self.path = path
+        self.framePeriod = framePeriod
+        self.maxPending = maxPending #frames queued over all clients before new batches have to wait
+        self.slots = slots
+        self.journal = journal
+        self.nAct = int(dm.Get('NBOfActuator'))
+        self.cond = threading.Condition()
+        self.dmLock = threading.Lock() #the driver is only ever called by one thread at a time
+        self.jobs = []
+        self.pending = 0
+        self.seq = 0
+        self.clients = {}
+        self.nextId = 0
+        self.running = False
+        self.sent = 0
+        self.failed = 0 #jobs given up because the driver raised
+        self.send = instrumentation.timed("dm.send", dm.Send)
+
+    def start(self):
+        if os.path.exists(self.path):
+            #a socket file left by a server that died, nothing can be listening on it if connect fails
+            try:
+                probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                probe.connect(self.path)
+                probe.close()
+                raise RuntimeError(f"A DM server is already running on {self.path}")
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.unlink(self.path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.path)
+        self.listener.listen()
+        self.running = True
+        self.sender = threading.Thread(target=self.run_sender, name="dm server sender", daemon=True)
+        self.sender.start()
+        self.acceptor = threading.Thread(target=self.run_accept, name="dm server accept", daemon=True)
+        self.acceptor.start()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        try:
+            self.listener.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.listener.close()
+        self.sender.join()
+        for client in list(self.clients.values()):
+            try:
+                client.connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def run_accept(self):
+        while self.running:
+            try:
+                connection, _ = self.listener.accept()
+            except OSError:
+                break
+            with self.cond:
+                client = _Client(self, connection, self.nextId)
+                self.nextId += 1
+                self.clients[client.id] = client
+            threading.Thread(target=self.serve, args=(client,), name=f"dm server {client.id}", daemon=True).start()
+
+    def serve(self, client):
+        stream = client.connection.makefile('rwb')
+        try:
+            for line in stream:
+                request = json.loads(line)
+                try:
+                    reply = self.handle(client, request)
+                except (KeyError, ValueError, IndexError) as error:
+                    reply = {"ok": False, "error": str(error)}
+                stream.write(json.dumps(reply).encode() + b"\n")
+                stream.flush()
+                if request.get("op") == "bye":
+                    break
+        except (OSError, ValueError):
+            pass
+        finally:
+            self.disconnect(client)
+            stream.close()
+            client.connection.close()
+
+    def disconnect(self, client):
+        with self.cond:
+            self.clients.pop(client.id, None)
+            for job in self.jobs:
+                if job.client is client:
+                    job.cancelled = True
+            self.cond.notify_all()
+        if client.shm is not None:
+            client.frames = None
+            client.shm.unlink()
+            try:
+                client.shm.close()
+            except BufferError:
+                #a cancelled batch still holds a view, the mapping goes away with it
+                pass
+
+    def handle(self, client, request):
+        op = request["op"]
+        if op == "hello":
+            client.name = request.get("name", client.name)
+            client.priority = int(request.get("priority", 0))
+            slots = min(int(request.get("slots", self.slots)), self.slots)
+            client.shm = shared_memory.SharedMemory(create=True, size=slots * self.nAct * 8)
+            client.frames = np.ndarray((slots, self.nAct), dtype=np.float64, buffer=client.shm.buf)
+            return {"ok": True, "nAct": self.nAct, "shm": client.shm.name, "slots": slots, "frame_period": self.framePeriod,
+                    "journal": os.path.abspath(self.journal.path) if self.journal is not None else None}
+        if op == "send":
+            return self.submit(client, request)
+        if op == "get":
+            with self.dmLock:
+                value = self.dm.Get(request["key"])
+            return {"ok": True, "value": float(value) if isinstance(value, (int, float, np.floating)) else value}
+        if op == "reset":
+            with self.dmLock:
+                self.dm.Reset()
+            return {"ok": True}
+        if op == "stats":
+            with self.cond:
+                clients = {str(c.id): c.stats() for c in self.clients.values()}
+                return {"ok": True, "clients": clients, "sent": self.sent, "failed": self.failed, "pending": self.pending}
+        if op == "bye":
+            return {"ok": True}
+        raise ValueError(f"Unknown request {op}")
+
+    def submit(self, client, request):
+        start = int(request.get("start", 0))
+        count = int(request["count"])
+        if client.frames is None or start < 0 or start + count > len(client.frames):
+            raise ValueError("Frames outside the client's shared buffer")
+        coefficients = request.get("coefficients")
+        priority = int(request.get("priority", client.priority))
+        with self.cond:
+            #back-pressure: a full queue either parks the caller or turns it away
+            while self.running and self.pending + count > self.maxPending and self.pending > 0:
+                if not request.get("block", True):
+                    client.busy += 1
+                    return {"ok": False, "error": "busy", "pending": self.pending}
+                self.cond.wait()
+            job = _Job(client, client.frames[start:start + count], coefficients, float(request.get("period", 0.0)), priority, self.seq,
+                       request.get("source"))
+            self.seq += 1
+            heapq.heappush(self.jobs, job)
+            self.pending += count
+            self.cond.notify_all()
+        #the reply only goes back once the last frame is out, so the client can reuse its slots straight away
+        job.done.wait()
+        if job.cancelled:
+            return {"ok": False, "error": "cancelled"}
+        if job.error is not None:
+            return {"ok": False, "error": job.error, "sent": job.index}
+        latency = time.perf_counter() - job.received
+        client.batches += 1
+        client.sent += count
+        client.totalLatency += latency
+        client.maxLatency = max(client.maxLatency, latency)
+        client.totalWait += job.start - job.received
+        return {"ok": True, "sent": count, "latency": latency, "first": job.start, "last": job.last,
+                "late_sum": job.lateSum, "late_sq": job.lateSq, "late_max": job.lateMax, "missed": job.missed}
+
+    def run_sender(self):
+        lastSend = 0.0
+        clock = time.perf_counter
+        while True:
+            with self.cond:
+                while self.running and not self.jobs:
+                    self.cond.wait()
+                if not self.running:
+                    for job in self.jobs:
+                        job.cancelled = True
+                        job.done.set()
+                    return
+                job = self.jobs[0]
+                if job.cancelled:
+                    heapq.heappop(self.jobs)
+                    self.pending -= len(job.frames) - job.index
+                    job.done.set()
+                    self.cond.notify_all()
+                    continue
+                due = lastSend + self.framePeriod
+                if job.start is not None and job.period > 0:
+                    due = max(due, job.start + job.index * job.period)
+                wait = due - clock()
+                if wait > 0.002:
+                    #sleep on the condition, so a higher priority batch arriving meanwhile goes first
+                    self.cond.wait(wait - 0.002)
+                    continue
+            while clock() < due:
+                pass
+            frame = job.frames[job.index]
+            now = clock()
+            if job.start is None:
+                job.start = now
+            try:
+                with self.dmLock:
+                    self.send(frame)
+            except Exception as error:
+                #the rest of the job is dropped and its client told, the sender carries on with the other jobs
+                with self.cond:
+                    job.error = f"DM send failed on frame {job.index}: {error}"
+                    self.failed += 1
+                    self.pending -= len(job.frames) - job.index
+                    self._remove(job)
+                    job.done.set()
+                    self.cond.notify_all()
+                print(job.error)
+                continue
+            lastSend = now
+            job.last = now
+            if job.period > 0:
+                late = now - (job.start + job.index * job.period)
+                job.lateSum += late
+                job.lateSq += late * late
+                job.lateMax = max(job.lateMax, late)
+                #same rule as DMSequencer: more than half a period late is a missed deadline
+                if late > job.period / 2:
+                    job.missed += 1
+            self.sent += 1
+            if self.journal is not None:
+                source = job.source if job.source is not None else SOURCE_GUI if job.client.name == "gui" else SOURCE_SCRIPT
+                self.journal.append(source, frame, job.coefficients if len(job.frames) == 1 else None)
+            with self.cond:
+                job.index += 1
+                self.pending -= 1
+                if job.index == len(job.frames):
+                    self._remove(job)
+                    job.done.set()
+                self.cond.notify_all()
+
+    def _remove(self, job):
+        #by identity: the lock is dropped while a frame goes out, so a higher priority job may be on top by now
+        if self.jobs[0] is job:
+            heapq.heappop(self.jobs)
+        else:
+            self.jobs.remove(job)
+            heapq.heapify(self.jobs)
+
+class DMClient:
+    #stands in for asdk.DM (Get, Send, Reset), so the GUI and scripts run unchanged on top of the server
+    def __init__(self, path, name="client", priority=0, slots=1024):
+        self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.connection.connect(path)
+        self.stream = self.connection.makefile('rwb')
+        self.lock = threading.Lock()
+        reply = self.request(op="hello", name=name, priority=priority, slots=slots)
+        self.nAct = reply["nAct"]
+        self.framePeriod = reply.get("frame_period", 0.0)
+        self.journalPath = reply.get("journal") #the server journals every frame it sends
+        self.shm = attach_shared_memory(reply["shm"])
+        self.frames = np.ndarray((reply["slots"], self.nAct), dtype=np.float64, buffer=self.shm.buf)
+
+    def request(self, **message):
+        with self.lock:
+            return self._request(message)
+
+    def _request(self, message):
+        self.stream.write(json.dumps(message).encode() + b"\n")
+        self.stream.flush()
+        line = self.stream.readline()
+        if not line:
+            raise ConnectionError("DM server closed the connection")
+        reply = json.loads(line)
+        if not reply["ok"]:
+            if reply["error"] == "busy":
+                raise BlockingIOError("DM server queue is full")
+            raise RuntimeError(reply["error"])
+        return reply
+
+    def Get(self, key):
+        return self.request(op="get", key=key)["value"]
+
+    def Send(self, values, coefficients=None, source=None):
+        with self.lock:
+            self.frames[0] = values
+            message = {"op": "send", "start": 0, "count": 1}
+            if coefficients is not None:
+                message["coefficients"] = [float(c) for c in coefficients]
+            if source is not None:
+                message["source"] = int(source)
+            return self._request(message)
+
+    def Reset(self):
+        self.request(op="reset")
+
+    def send_batch(self, frames, period=0.0, priority=None, block=True, source=None):
+        #frames go into shared memory slot by slot, one request per buffer full; the server plays them `period` apart
+        #and reports their timing on its own clock, summed here over the requests
+        frames = np.asarray(frames, dtype=np.float64)
+        totals = {"sent": 0, "latency": 0.0, "first": None, "last": None, "late_sum": 0.0, "late_sq": 0.0, "late_max": 0.0, "missed": 0}
+        slots = len(self.frames)
+        for start in range(0, len(frames), slots):
+            chunk = frames[start:start + slots]
+            with self.lock:
+                self.frames[:len(chunk)] = chunk
+                message = {"op": "send", "start": 0, "count": len(chunk), "period": period, "block": block}
+                if priority is not None:
+                    message["priority"] = priority
+                if source is not None:
+                    message["source"] = int(source)
+                reply = self._request(message)
+            for key in ("sent", "latency", "late_sum", "late_sq", "missed"):
+                totals[key] += reply[key]
+            totals["late_max"] = max(totals["late_max"], reply["late_max"])
+            if totals["first"] is None:
+                totals["first"] = reply["first"]
+            totals["last"] = reply["last"]
+        return totals
+
+    def stats(self):
+        return self.request(op="stats")
+
+    def close(self):
+        try:
+            self.request(op="bye")
+        except (OSError, ConnectionError, RuntimeError):
+            pass
+        self.frames = None
+        self.shm.close()
+        try:
+            self.stream.close()
+        except OSError:
+            pass #the server is already gone, the unsent bye has nowhere to go
+        self.connection.close()
+
+def connect_or_open(serialName, name="client", priority=0):
+    #join a running server for this mirror if there is one, otherwise hold the mirror directly as before
+    path = socket_path(serialName)
+    if os.path.exists(path):
+        try:
+            client = DMClient(path, name, priority)
+            print(f"Connected to the DM server on {path}")
+            return client
+        except (ConnectionRefusedError, FileNotFoundError):
+            pass
+    return dm_class()(serialName)
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Own the DM and serve commands to local clients over a unix socket")
+    parser.add_argument("--socket", help="socket path (default /tmp/summer-dm-<serial>.sock)")
+    parser.add_argument("--frame-period", type=float, default=0.005, help="shortest time between two sends to the mirror in seconds")
+    parser.add_argument("--max-pending", type=int, default=4096, help="frames queued over all clients before submissions wait")
+    parser.add_argument("--journal", help="journal file for the frames sent (default journal/<serial>-<date>.djr)")
+    parser.add_argument("--no-journal", action="store_true", help="don't record the frames sent to the mirror")
+    parser.add_argument("--stats", type=float, default=10.0, help="seconds between per-client stats lines, 0 for none")
+    parser.add_argument("--share-clock", action="store_true", help="stamp every send with monotonic time in shared memory for sync_capture")
+    parser.add_argument("--simulate", action="store_true", help="use the simulated DM instead of the hardware")
+    parser.add_argument("--instrument", action="store_true", help="record per-stage latency histograms, written to json on exit")
+    return parser.parse_args(args[1:])
+
+def main(args):
+    options = parse_args(args)
+    print("Please enter the S/N within the following format BXXYYY (see DM backside): ")
+    serialName = input().strip()
+    print("Connect the mirror")
+    dm = dm_class()(serialName)
+    dmRing = None
+    if options.share_clock:
+        #the server is the one process that really sends, so its stamps cover every client
+        from sync_capture import SharedRing, TimedDM, DM_RING
+        dmRing = SharedRing(DM_RING, 2, 1 << 16, create=True)
+        dm = TimedDM(dm, dmRing)
+    nbAct = int(dm.Get('NBOfActuator'))
+    print("Send 0 on each actuator")
+    dm.Send([0.] * nbAct)
+    journal = None
+    if not options.no_journal:
+        journal = DMJournal(options.journal or session_path(serialName), nbAct, serialName=serialName)
+    server = DMServer(dm, options.socket or socket_path(serialName), options.frame_period, options.max_pending, journal=journal)
+    server.start()
+    print(f"Serving {serialName} ({nbAct} actuators) on {server.path}")
+    try:
+        while True:
+            time.sleep(options.stats or 3600)
+            if options.stats:
+                with server.cond:
+                    stats = [client.stats() for client in server.clients.values()]
+                for s in stats:
+                    print(f"{s['name']:>12}: {s['frames_per_s']:8.1f} frames/s, {s['mean_latency_ms']:7.2f} ms mean, "
+                          f"{s['max_latency_ms']:7.2f} ms max, {s['busy']} busy")
+    except KeyboardInterrupt:
+        pass
+    server.stop()
+    dm.Reset()
+    if journal is not None:
+        journal.close()
+    if dmRing is not None:
+        dmRing.close()
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,114 @@
+import time
+import threading
+import instrumentation
+
+class DMWorker:
+    #owns every dm.Send for the GUI: callers drop the newest actuator vector into a single slot and return
+    #immediately, the worker sends whatever is newest at most once per frame period, stale frames are overwritten
+    def __init__(self, dm, framePeriod=0.005, journal=None):
+        self.dm = dm
+        self.framePeriod = framePeriod
+        self.journal = journal #dm_journal.DMJournal, every command that actually goes out is appended
+        #a dm_server client passes the coefficients and source on, and the server journals the frame
+        self.forward = hasattr(dm, "send_batch")
+        if self.forward:
+            self.journal = None
+        self.cond = threading.Condition()
+        self.pending = None
+        self.paused = False #set while someone else (the optimiser) drives the mirror directly
+        self.busy = False #a frame has been taken from the slot and is being sent
+        self.running = False
+        self.thread = None
+        self.submitted = 0
+        self.sent = 0
+        self.failed = 0
+        self.error = None #message of the last failed send, cleared by the next one that goes out
+        self.lastLatency = 0.0
+        self.meanLatency = 0.0
+        self.sendTimes = []
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="dm worker", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def submit(self, values, coefficients=None, source=0):
+        with self.cond:
+            self.pending = (values, coefficients, source)
+            self.submitted += 1
+            self.cond.notify_all()
+
+    def pause(self):
+        #let the frame in the slot (and any send in progress) finish, then hold off until resume(),
+        #so the caller can use dm.Send without two threads inside the driver
+        with self.cond:
+            while self.running and (self.pending is not None or self.busy):
+                self.cond.wait()
+            self.paused = True
+
+    def resume(self):
+        with self.cond:
+            self.paused = False
+            self.cond.notify_all()
+
+    def run(self):
+        nextFrame = 0.0
+        while True:
+            with self.cond:
+                while self.running and (self.pending is None or self.paused):
+                    self.cond.wait()
+                if not self.running:
+                    return
+            wait = nextFrame - time.perf_counter()
+            if wait > 0:
+                #anything submitted while we wait replaces the slot, so only the newest frame goes out
+                time.sleep(wait)
+            with self.cond:
+                (values, coefficients, source), self.pending = self.pending, None
+                self.busy = True
+            start = time.perf_counter()
+            try:
+                if self.forward:
+                    self.dm.Send(values, coefficients, source)
+                else:
+                    self.dm.Send(values)
+                end = time.perf_counter()
+                if self.journal is not None:
+                    self.journal.append(source, values, coefficients)
+            except Exception as error:
+                #driver or DM server error: the frame is lost, the worker stays up for the next one
+                self.failed += 1
+                self.error = f"{type(error).__name__}: {error}"
+                nextFrame = start + self.framePeriod
+                continue
+            finally:
+                #busy only drops once the journal is written too, pause() hands both over to the caller
+                with self.cond:
+                    self.busy = False
+                    self.cond.notify_all()
+            self.error = None
+            nextFrame = start + self.framePeriod
+            self.lastLatency = end - start
+            self.meanLatency += 0.1 * (self.lastLatency - self.meanLatency)
+            self.sent += 1
+            if instrumentation.ENABLED:
+                instrumentation.histogram("dm.send").record(int(self.lastLatency * 1e9))
+            self.sendTimes.append(end)
+            if len(self.sendTimes) > 256:
+                del self.sendTimes[:128]
+
+    def rate(self, window=1.0):
+        now = time.perf_counter()
+        recent = [t for t in self.sendTimes[-256:] if now - t <= window]
+        return len(recent) / window
+
+    def coalesced(self):
+        return self.submitted - self.sent - (1 if self.pending is not None else 0)
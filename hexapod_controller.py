@@ -1,17 +1,116 @@
-from pipython import GCSDevice
-import keyboard
+import sys
+import time
+import argparse
+import threading
 from rich import print
+from devices import gcs_device_class
+import instrumentation
 
-pidevice = GCSDevice('C-887')
-pidevice.InterfaceSetupDlg()
-print(pidevice.qIDN())
-print(pidevice.qPOS())
-print("[yellow]Use the up & down arrows to change the hexapod, hit the right and left arrows to change the increment, hit spacebar to reset and choose a new axis.[/yellow]")
+class JogEngine:
+    def __init__(self, pidevice, maxRate=20.0, refreshInterval=1.0, inc=0.001, verbose=True, tolerance=1e-4):
+        self.pidevice = pidevice
+        self.verbose = verbose
+        self.minInterval = 1.0 / maxRate #held keys turn into at most this many MOVs per second
+        self.refreshInterval = refreshInterval #background qPOS while idle
+        self.tolerance = tolerance #idle positions further than this from the target were moved by someone else
+        self.inc = inc
+        self.axis = None
+        self.direction = 0 #+1 while up is held, -1 while down is held
+        self.target = {}
+        self.position = {}
+        self.lock = threading.Lock() #GCS calls come from the jog thread and the main thread
+        self.wake = threading.Event()
+        self.reselect = threading.Event()
+        self.running = False
+        self.latency = {"MOV": [0, 0.0, 0.0], "qPOS": [0, 0.0, 0.0]} #count, total, max in seconds
 
-def hexfunc():
+    def timed(self, name, call, *args):
+        start = time.perf_counter()
+        with self.lock:
+            result = call(*args)
+        elapsed = time.perf_counter() - start
+        stats = self.latency[name]
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] = max(stats[2], elapsed)
+        if instrumentation.ENABLED:
+            instrumentation.histogram("hexapod." + name).record(int(elapsed * 1e9))
+        return result
+
+    def select_axis(self, axis):
+        #one query when the axis is picked, after that moves are computed from the tracked target
+        self.axis = axis
+        self.direction = 0
+        self.position = dict(self.timed("qPOS", self.pidevice.qPOS))
+        self.target = dict(self.position)
+
+    def start(self):
+        self.running = True
+        threading.Thread(target=self.run, name="hexapod jog", daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        self.wake.set()
+
+    def run(self):
+        lastMove = 0.0
+        while self.running:
+            if self.direction == 0 or self.axis is None:
+                #nothing held: sleep until a key wakes us, refreshing the position at a low rate meanwhile
+                if not self.wake.wait(self.refreshInterval) and self.axis is not None:
+                    self.position = dict(self.timed("qPOS", self.pidevice.qPOS))
+                    if time.perf_counter() - lastMove >= self.refreshInterval:
+                        self.resync()
+                self.wake.clear()
+                continue
+            wait = lastMove + self.minInterval - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+                continue
+            direction = self.direction
+            if direction == 0:
+                continue
+            self.target[self.axis] += direction * self.inc
+            lastMove = time.perf_counter()
+            self.timed("MOV", self.pidevice.MOV, self.axis, self.target[self.axis])
+            if self.verbose:
+                print(self.target)
+
+    def resync(self):
+        #our last MOV has long settled, so a different position means another program (or the controller)
+        #moved the hexapod; jog on from where it really is instead of jumping back to the old target
+        moved = [axis for axis, value in self.position.items()
+                 if axis in self.target and abs(value - self.target[axis]) > self.tolerance]
+        if moved:
+            self.target.update(self.position)
+            print(f"[grey]Position changed outside the jog ({', '.join(moved)}), target now {self.target}[/grey]")
+
+    def press(self, direction):
+        #key repeats only re-set the held direction, the jog thread decides when the next MOV goes out
+        if self.direction != direction:
+            self.direction = direction
+            self.wake.set()
+
+    def release(self, direction):
+        if self.direction == direction:
+            self.direction = 0
+
+    def change_increment(self, delta):
+        self.inc += delta
+        print(f"[grey]Increment: {self.inc}[/grey]")
+
+    def report(self):
+        for name, (count, total, worst) in self.latency.items():
+            if count:
+                print(f"[grey]{name}: {count} calls, mean {total / count * 1e3:.2f} ms, max {worst * 1e3:.2f} ms[/grey]")
+
+def hexfunc(pidevice, maxRate=20.0, refreshInterval=1.0):
+    #only the interactive loop needs the global keyboard hooks
+    import keyboard
     axes = ["X", "Y", "Z", "U", "V", "W"]
-    inc = 0.001 #default
-   
+    jog = JogEngine(pidevice, maxRate, refreshInterval)
+    jog.start()
+
     while True:
         try:
             #hit either 1,2,3,4,5,6 for corresponding axes
@@ -22,31 +121,41 @@ def hexfunc():
                 continue
             #print axis selected for confirmation
             print(f"[bold blue]Selected axis: {axes[ax]}[/bold blue]")
+            jog.select_axis(axes[ax])
 
-            while True:
-                pos = pidevice.qPOS(axes[ax])
-                dict_pos = pos[axes[ax]]
-               
-                if keyboard.is_pressed("up"):
-                    #if up key is pressed add specfici increment to axis position it was just in
-                    new_pos = dict_pos + inc
-                    pidevice.MOV(axes[ax], new_pos)
-                    #print current position for all axes
-                    print(pidevice.qPOS())                
-                elif keyboard.is_pressed("down"):
-                    new_neg_pos = dict_pos - inc
-                    pidevice.MOV(axes[ax], new_neg_pos)
-                    print(pidevice.qPOS())
-                elif keyboard.is_pressed("right"):
-                    inc += 0.001
-                    print(f"[grey]Increment: {inc}[/grey]")
-                elif keyboard.is_pressed("left"):
-                    inc -= 0.001
-                    print(f"[grey]Increment: {inc}[/grey]")
-                elif keyboard.is_pressed("space"):
-                    #restart function basically to user input for axis
-                    break
+            #key events drive the jog thread, this thread just waits for spacebar
+            hooks = [
+                keyboard.on_press_key("up", lambda e: jog.press(1)),
+                keyboard.on_release_key("up", lambda e: jog.release(1)),
+                keyboard.on_press_key("down", lambda e: jog.press(-1)),
+                keyboard.on_release_key("down", lambda e: jog.release(-1)),
+                keyboard.on_press_key("right", lambda e: jog.change_increment(0.001)),
+                keyboard.on_press_key("left", lambda e: jog.change_increment(-0.001)),
+                #restart function basically to user input for axis
+                keyboard.on_press_key("space", lambda e: jog.reselect.set()),
+            ]
+            jog.reselect.wait()
+            jog.reselect.clear()
+            for hook in hooks:
+                keyboard.unhook(hook)
+            jog.direction = 0
+            jog.report()
         except ValueError:
             print("[red]Please enter a valid number.[/red]")
 
-hexfunc()
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Jog the C-887 hexapod from the keyboard")
+    parser.add_argument("--rate", type=float, default=20.0, help="maximum MOV commands per second while a key is held")
+    parser.add_argument("--refresh", type=float, default=1.0, help="seconds between background position reads while idle")
+    parser.add_argument("--simulate", action="store_true", help="use the simulated controller instead of the C-887")
+    parser.add_argument("--instrument", action="store_true", help="record per-stage latency histograms, written to json on exit")
+    return parser.parse_args(args[1:])
+
+if __name__ == "__main__":
+    options = parse_args(sys.argv)
+    pidevice = gcs_device_class()('C-887')
+    pidevice.InterfaceSetupDlg()
+    print(pidevice.qIDN())
+    print(pidevice.qPOS())
+    print("[yellow]Use the up & down arrows to change the hexapod, hit the right and left arrows to change the increment, hit spacebar to reset and choose a new axis.[/yellow]")
+    hexfunc(pidevice, options.rate, options.refresh)
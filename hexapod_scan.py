@@ -0,0 +1,169 @@
+import sys
+import csv
+import time
+import queue
+import argparse
+import threading
+import numpy as np
+from devices import gcs_device_class
+import instrumentation
+
+AXES = ["X", "Y", "Z", "U", "V", "W"]
+
+def load_waypoints(path):
+    #csv with a header naming any of X,Y,Z,U,V,W, one waypoint per row; blank cells leave that axis alone
+    waypoints = []
+    with open(path, newline='') as csvfile:
+        for row in csv.DictReader(csvfile):
+            waypoint = {axis: float(row[axis]) for axis in AXES if (row.get(axis) or "").strip()}
+            if waypoint:
+                waypoints.append(waypoint)
+    return waypoints
+
+def parse_raster(specs):
+    #"X=-1:1:11" -> axis X from -1 to 1 in 11 steps
+    raster = []
+    for spec in specs:
+        axis, values = spec.split("=")
+        start, stop, steps = values.split(":")
+        raster.append((axis.strip().upper(), np.linspace(float(start), float(stop), int(steps))))
+    return raster
+
+def raster_waypoints(raster, base=None):
+    #serpentine order: every other line of an inner axis runs backwards so the hexapod never flies back
+    base = dict(base or {})
+    waypoints = [dict(base)]
+    for axis, values in reversed(raster):
+        expanded = []
+        for i, value in enumerate(values):
+            line = waypoints if i % 2 == 0 else waypoints[::-1]
+            for waypoint in line:
+                point = dict(waypoint)
+                point[axis] = float(value)
+                expanded.append(point)
+        waypoints = expanded
+    return waypoints
+
+class ScanLog:
+    #rows are handed to a writer thread so file I/O never delays the next move
+    def __init__(self, path):
+        self.rows = queue.Queue()
+        self.file = open(path, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(["time", "index", "settle_s"] + [f"target_{a}" for a in AXES] + [f"pos_{a}" for a in AXES] + ["value"])
+        self.thread = threading.Thread(target=self.run, name="scan log", daemon=True)
+        self.thread.start()
+
+    def add(self, row):
+        self.rows.put(row)
+
+    def run(self):
+        while True:
+            row = self.rows.get()
+            if row is None:
+                break
+            self.writer.writerow(row)
+        self.file.close()
+
+    def close(self):
+        self.rows.put(None)
+        self.thread.join()
+
+class ScanEngine:
+    def __init__(self, pidevice, minPoll=0.001, maxPoll=0.05, backoff=1.5, settleTimeout=30.0):
+        self.pidevice = pidevice
+        #controller calls go through these so they show up in the instrumentation when it is on
+        self.MOV = instrumentation.timed("hexapod.MOV", pidevice.MOV)
+        self.qPOS = instrumentation.timed("hexapod.qPOS", pidevice.qPOS)
+        self.qONT = instrumentation.timed("hexapod.qONT", pidevice.qONT)
+        self.minPoll = minPoll
+        self.maxPoll = maxPoll
+        self.backoff = backoff
+        self.settleTimeout = settleTimeout
+        self.speed = None #learned distance per second, used to sleep through most of a move without polling
+        self.polls = 0
+
+    def plan(self, waypoints, start):
+        #build every combined MOV up front, with the largest travel per move, so the loop only talks to the controller
+        target = dict(start)
+        commands = []
+        for waypoint in waypoints:
+            axes = list(waypoint)
+            values = [waypoint[axis] for axis in axes]
+            distance = max((abs(value - target[axis]) for axis, value in zip(axes, values)), default=0.0)
+            target.update(waypoint)
+            commands.append((axes, values, distance, dict(target)))
+        return commands
+
+    def wait_on_target(self, axes, distance):
+        start = time.perf_counter()
+        if self.speed and distance > 0:
+            #skip most of the expected travel time, then poll
+            time.sleep(0.8 * distance / self.speed)
+        interval = self.minPoll
+        while True:
+            self.polls += 1
+            if all(self.qONT(axes).values()):
+                break
+            if time.perf_counter() - start > self.settleTimeout:
+                raise TimeoutError(f"Axes {axes} not on target after {self.settleTimeout} s")
+            time.sleep(interval)
+            #poll quickly right after the move, back off the longer the settle takes
+            interval = min(interval * self.backoff, self.maxPoll)
+        elapsed = time.perf_counter() - start
+        if distance > 0 and elapsed > 0:
+            measured = distance / elapsed
+            self.speed = measured if self.speed is None else 0.7 * self.speed + 0.3 * measured
+        return elapsed
+
+    def run(self, waypoints, log=None, dwell=0.0, measure=None):
+        commands = self.plan(waypoints, self.qPOS())
+        results = []
+        for index, (axes, values, distance, target) in enumerate(commands):
+            #every axis of the waypoint in one combined MOV
+            self.MOV(axes, values)
+            settle = self.wait_on_target(axes, distance)
+            if dwell:
+                time.sleep(dwell)
+            reached = dict(self.qPOS())
+            value = measure(index, reached) if measure is not None else ""
+            stamp = time.time()
+            results.append((stamp, index, settle, target, reached, value))
+            if log is not None:
+                log.add([f"{stamp:.6f}", index, f"{settle:.4f}"] + [target.get(a, "") for a in AXES] + [reached.get(a, "") for a in AXES] + [value])
+        return results
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Run waypoint or raster scans on the C-887 hexapod")
+    parser.add_argument("--waypoints", help="csv of waypoints with X,Y,Z,U,V,W columns")
+    parser.add_argument("--raster", nargs="+", metavar="AXIS=START:STOP:STEPS", help="raster axes, the first one is the slowest")
+    parser.add_argument("--log", default="scan_log.csv", help="csv file for reached positions and time stamps")
+    parser.add_argument("--dwell", type=float, default=0.0, help="seconds to wait at each waypoint once on target")
+    parser.add_argument("--simulate", action="store_true", help="use the simulated controller instead of the C-887")
+    parser.add_argument("--instrument", action="store_true", help="record per-stage latency histograms, written to json on exit")
+    return parser.parse_args(args[1:])
+
+def main(args):
+    options = parse_args(args)
+    if options.waypoints:
+        waypoints = load_waypoints(options.waypoints)
+    elif options.raster:
+        waypoints = raster_waypoints(parse_raster(options.raster))
+    else:
+        print("Give --waypoints or --raster")
+        return
+    pidevice = gcs_device_class()('C-887')
+    pidevice.InterfaceSetupDlg()
+    print(pidevice.qIDN())
+    engine = ScanEngine(pidevice)
+    log = ScanLog(options.log)
+    start = time.perf_counter()
+    try:
+        engine.run(waypoints, log, options.dwell)
+    finally:
+        log.close()
+    elapsed = time.perf_counter() - start
+    print(f"{len(waypoints)} waypoints in {elapsed:.1f} s ({len(waypoints) / elapsed:.2f} per second, {engine.polls} on-target polls), log in {options.log}")
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,166 @@
+import numpy as np
+
+class _Level:
+    #ring of completed buckets for one zoom level, plus the bucket still being filled
+    def __init__(self, nChannels, capacity, factor, raw=False):
+        self.capacity = capacity
+        self.factor = factor
+        self.raw = raw
+        self.times = np.full(capacity, np.nan)
+        self.lo = np.full((capacity, nChannels), np.nan)
+        #raw samples are their own min and max, so level 0 only keeps one copy
+        self.hi = self.lo if raw else np.full((capacity, nChannels), np.nan)
+        self.written = 0
+        self.partialCount = 0
+        self.partialTime = np.nan
+        self.partialLo = np.full(nChannels, np.inf)
+        self.partialHi = np.full(nChannels, -np.inf)
+
+    def _store(self, times, lo, hi):
+        n = len(times)
+        if n > self.capacity:
+            times, lo, hi = times[-self.capacity:], lo[-self.capacity:], hi[-self.capacity:]
+            self.written += n - self.capacity
+            n = self.capacity
+        idx = (self.written + np.arange(n)) % self.capacity
+        self.times[idx] = times
+        self.lo[idx] = lo
+        if not self.raw:
+            self.hi[idx] = hi
+        self.written += n
+
+    def add(self, times, lo, hi):
+        #takes items from the level below and returns the buckets this call completed
+        if self.raw:
+            self._store(times, lo, hi)
+            return times, lo, hi
+        n = len(times)
+        need = self.factor - self.partialCount
+        if n < need:
+            self._merge_partial(times, lo, hi)
+            return times[:0], lo[:0], hi[:0]
+        self._merge_partial(times[:need], lo[:need], hi[:need])
+        firstTime, firstLo, firstHi = self.partialTime, self.partialLo.copy(), self.partialHi.copy()
+        self._reset_partial()
+        full = (n - need) // self.factor
+        end = need + full * self.factor
+        shape = (full, self.factor, lo.shape[1])
+        doneTimes = np.concatenate(([firstTime], times[need:end:self.factor]))
+        doneLo = np.vstack((firstLo, lo[need:end].reshape(shape).min(axis=1)))
+        doneHi = np.vstack((firstHi, hi[need:end].reshape(shape).max(axis=1)))
+        if end < n:
+            self._merge_partial(times[end:], lo[end:], hi[end:])
+        self._store(doneTimes, doneLo, doneHi)
+        return doneTimes, doneLo, doneHi
+
+    def _merge_partial(self, times, lo, hi):
+        if len(times) == 0:
+            return
+        if self.partialCount == 0:
+            self.partialTime = times[0]
+        np.minimum(self.partialLo, lo.min(axis=0), out=self.partialLo)
+        np.maximum(self.partialHi, hi.max(axis=0), out=self.partialHi)
+        self.partialCount += len(times)
+
+    def _reset_partial(self):
+        self.partialCount = 0
+        self.partialTime = np.nan
+        self.partialLo.fill(np.inf)
+        self.partialHi.fill(-np.inf)
+
+    def oldest(self):
+        return max(0, self.written - self.capacity)
+
+    def search(self, t, side='left'):
+        #logical index of the first retained item at or after t (after t with side='right'), without unrolling the ring
+        first = self.oldest()
+        n = self.written - first
+        start = first % self.capacity
+        if start + n <= self.capacity:
+            return first + int(np.searchsorted(self.times[start:start + n], t, side))
+        head = self.times[start:]
+        if t < head[-1] or (side == 'left' and t == head[-1]):
+            return first + int(np.searchsorted(head, t, side))
+        return first + len(head) + int(np.searchsorted(self.times[:start + n - self.capacity], t, side))
+
+    def take(self, i, j):
+        idx = np.arange(i, j) % self.capacity
+        return self.times[idx], self.lo[idx], self.hi[idx]
+
+class MinMaxPyramid:
+    def __init__(self, nChannels, capacity, factor=4, minBuckets=64):
+        self.nChannels = nChannels
+        self.factor = factor
+        self.levels = [_Level(nChannels, capacity, 1, raw=True)]
+        size = capacity // factor
+        while size >= minBuckets:
+            self.levels.append(_Level(nChannels, size + 1, factor))
+            size //= factor
+
+    def append(self, times, values):
+        #each level only sees the buckets completed by the one below it, so updates stay incremental
+        lo = hi = values
+        for level in self.levels:
+            times, lo, hi = level.add(times, lo, hi)
+            if len(times) == 0:
+                break
+
+    def time_range(self):
+        level = self.levels[0]
+        if level.written == 0:
+            return np.nan, np.nan
+        first = level.oldest()
+        return level.times[first % level.capacity], level.times[(level.written - 1) % level.capacity]
+
+    def _collect(self, k, t0, t1, out):
+        level = self.levels[k]
+        i = max(level.search(t0), level.oldest())
+        #[t0, t1] is closed, so a query ending on the newest stamp still gets that sample
+        j = level.search(t1, 'right') if t1 is not None else level.written
+        if j > i:
+            out.append((level.raw,) + level.take(i, j))
+        #the newest samples aren't in a completed bucket yet, fill that tail in from the finer level
+        if k > 0 and j == level.written:
+            finer = self.levels[k - 1]
+            tailStart = level.written * self.factor
+            if tailStart < finer.written:
+                tailTime = finer.times[max(tailStart, finer.oldest()) % finer.capacity]
+                self._collect(k - 1, max(t0, tailTime), t1, out)
+
+    def query(self, t0, t1, maxPoints):
+        #finest level that needs no more than maxPoints items for [t0, t1], e.g. one per horizontal pixel
+        k = 0
+        for k, level in enumerate(self.levels):
+            if level.written == 0:
+                break
+            if level.search(t1, 'right') - max(level.search(t0), level.oldest()) <= maxPoints:
+                break
+        pieces = []
+        self._collect(k, t0, t1, pieces)
+        if not pieces:
+            return np.empty(0), np.empty((0, self.nChannels))
+        xs, ys = [], []
+        for raw, times, lo, hi in pieces:
+            if raw:
+                xs.append(times)
+                ys.append(lo)
+            else:
+                #draw each bucket as its min and max at the bucket time
+                xs.append(np.repeat(times, 2))
+                y = np.empty((2 * len(times), self.nChannels))
+                y[0::2] = lo
+                y[1::2] = hi
+                ys.append(y)
+        return np.concatenate(xs), np.vstack(ys)
+
+    def extrema(self, channels=None):
+        #min/max over everything retained, read from the coarsest level and its unfinished tail
+        pieces = []
+        self._collect(len(self.levels) - 1, -np.inf, None, pieces)
+        if not pieces:
+            return np.nan, np.nan
+        lo = np.vstack([p[2] for p in pieces])
+        hi = np.vstack([p[3] for p in pieces])
+        if channels is not None:
+            lo, hi = lo[:, channels], hi[:, channels]
+        return np.nanmin(lo), np.nanmax(hi)
@@ -0,0 +1,146 @@
+import os
+import sys
+import json
+import time
+import atexit
+
+#per-stage latency histograms for the hot paths, switched on with SUMMER_INSTRUMENT=1 or --instrument;
+#when off, call sites only pay for one `if ENABLED` check and timed() hands back the function untouched
+ENABLED = os.environ.get("SUMMER_INSTRUMENT", "") not in ("", "0") or "--instrument" in sys.argv
+
+now = time.perf_counter_ns
+
+#HDR-style buckets: exact below 64 ns, then 32 linear sub-buckets per power of two (~3% resolution)
+SUB_BUCKETS = 32
+N_BUCKETS = (64 - 5) * SUB_BUCKETS
+
+def bucket_index(ns):
+    if ns < 2 * SUB_BUCKETS:
+        return ns
+    shift = ns.bit_length() - 6
+    return (shift + 1) * SUB_BUCKETS + (ns >> shift) - SUB_BUCKETS
+
+def bucket_value(index):
+    #lowest latency (ns) that lands in a bucket
+    if index < 2 * SUB_BUCKETS:
+        return index
+    shift = index // SUB_BUCKETS - 1
+    return (index % SUB_BUCKETS + SUB_BUCKETS) << shift
+
+class LatencyHistogram:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * N_BUCKETS
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def record(self, ns):
+        #called from the acquisition, worker and GUI threads without a lock; a rare lost count is acceptable
+        #for a diagnostic and keeps the recording cost to a few list operations
+        if ns < 0:
+            ns = 0
+        self.counts[bucket_index(ns)] += 1
+        self.count += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+        if self.min is None or ns < self.min:
+            self.min = ns
+
+    def percentile(self, p):
+        if self.count == 0:
+            return 0
+        target = p / 100.0 * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= target:
+                return min(bucket_value(index), self.max)
+        return self.max
+
+    def summary(self):
+        count = self.count
+        return {
+            "count": count,
+            "mean_us": self.total / count / 1e3 if count else 0.0,
+            "min_us": (self.min or 0) / 1e3,
+            "p50_us": self.percentile(50) / 1e3,
+            "p90_us": self.percentile(90) / 1e3,
+            "p99_us": self.percentile(99) / 1e3,
+            "p999_us": self.percentile(99.9) / 1e3,
+            "max_us": self.max / 1e3,
+        }
+
+stages = {}
+counters = {}
+
+def histogram(stage):
+    hist = stages.get(stage)
+    if hist is None:
+        hist = stages[stage] = LatencyHistogram()
+    return hist
+
+def record(stage, start):
+    #start is a now() taken before the stage ran
+    histogram(stage).record(now() - start)
+
+def count(name, n=1):
+    counters[name] = counters.get(name, 0) + n
+
+def timed(stage, func):
+    #wrap a callable (e.g. a driver's Send) so every call lands in the stage's histogram
+    if not ENABLED:
+        return func
+    hist = histogram(stage)
+
+    def wrapper(*args, **kwargs):
+        start = now()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            hist.record(now() - start)
+    return wrapper
+
+def enable(flag=True):
+    #only affects call sites reached afterwards; functions already passed through timed() stay as they are
+    global ENABLED
+    ENABLED = flag
+    if flag:
+        _register_dump()
+
+def reset():
+    for hist in stages.values():
+        hist.reset()
+    counters.clear()
+
+def snapshot():
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "stages": {stage: hist.summary() for stage, hist in sorted(stages.items())},
+        "counters": dict(counters),
+    }
+
+def dump(path=None):
+    path = path or os.environ.get("SUMMER_INSTRUMENT_FILE") or time.strftime("instrumentation-%Y%m%d-%H%M%S.json")
+    with open(path, "w") as file:
+        json.dump(snapshot(), file, indent=2)
+    return path
+
+_dumpRegistered = False
+
+def _dump_at_exit():
+    if stages:
+        print(f"Instrumentation written to {dump()}")
+
+def _register_dump():
+    global _dumpRegistered
+    if not _dumpRegistered:
+        _dumpRegistered = True
+        atexit.register(_dump_at_exit)
+
+if ENABLED:
+    _register_dump()
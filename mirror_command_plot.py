@@ -7,6 +7,8 @@ from PyQt5.QtWidgets import QVBoxLayout, QWidget
 from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from PyQt5.QtCore import Qt
+import instrumentation
+from mirror_geometry import square_positions
 
 class PlotView(QWidget):
     def __init__(self):
@@ -16,6 +18,7 @@ class PlotView(QWidget):
         #figure
         self.figure, self.ax = plt.subplots()
         self.canvas = FigureCanvas(self.figure)
+        self.background = None
 
         #navigation toolbar
         self.toolbar = NavigationToolbar(self.canvas, self)
@@ -27,6 +30,9 @@ class PlotView(QWidget):
         layout.addWidget(self.toolbar)
         self.setLayout(layout)
 
+        #grab a clean background after every full draw (first show, resize, zoom) for blitting
+        self.canvas.mpl_connect('draw_event', self.onDraw)
+
         #plot the squares in the circle
         self.plot_circular_squares()
 
@@ -36,13 +42,13 @@ class PlotView(QWidget):
         #generate the squares
         positions = self.generate_square_positions(self)
 
-        #plot squares
-        self.patches = []
-        colors = np.linspace(0.5, 0.5, len(positions))
-        for pos, color in zip(positions, colors):
-            square = Rectangle((pos[0] - 0.5, pos[1] - 0.5), 1, 1, edgecolor='black', facecolor=plt.cm.viridis(color))
-            self.ax.add_patch(square)
-            self.patches.append(square)
+        #one collection holds every actuator square, later updates only touch its color array
+        self.patches = [Rectangle((pos[0] - 0.5, pos[1] - 0.5), 1, 1) for pos in positions]
+        self.collection = PatchCollection(self.patches, cmap=plt.cm.viridis, edgecolor='black')
+        self.collection.set_array(np.zeros(len(positions)))
+        self.collection.set_clim(-1, 1)
+        self.collection.set_animated(True)
+        self.ax.add_collection(self.collection)
 
         #set limits to center around squares
         min_x = min(pos[0] - 0.5 for pos in positions)
@@ -70,21 +76,29 @@ class PlotView(QWidget):
         ax.outline.set_visible(False)
 
         self.canvas.draw()
+
+    def onDraw(self, event):
+        self.background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self.ax.draw_artist(self.collection)
+
+    def update_colors(self, values):
+        #same per-frame min/max normalisation the squares have always been colored with
+        start = instrumentation.now() if instrumentation.ENABLED else 0
+        values = np.asarray(values)
+        self.collection.set_array(values)
+        self.collection.set_clim(values.min(), values.max())
+        if self.background is None:
+            self.canvas.draw()
+        else:
+            self.canvas.restore_region(self.background)
+            self.ax.draw_artist(self.collection)
+            self.canvas.blit(self.ax.bbox)
+        if start:
+            instrumentation.record("render.mirror_map", start)
+
     @staticmethod
     def generate_square_positions(self):
-        positions = []
-        num_squares = [5, 7, 9, 11, 11, 11, 11, 11, 9, 7, 5]
-        num_rows = len(num_squares)
-        max_num_squares = max(num_squares)
-        square_spacing = 1.2  #padding as well
-
-        for row, num in enumerate(num_squares):
-            for i in range(num):
-                x = (i - num / 2 + 0.5) * square_spacing
-                y = (num_rows - row - 1) * square_spacing
-                positions.append((x, y))
-
-        return positions
+        return square_positions()
 
     def _get_patches(self):
         return self.patches
@@ -0,0 +1,20 @@
+#actuator layout of the 97 actuator mirror, shared by the Qt plot view and the headless renderer
+NUM_SQUARES = [5, 7, 9, 11, 11, 11, 11, 11, 9, 7, 5]
+SQUARE_SPACING = 1.2  #padding as well
+
+#actuator layout never changes, so it is only computed the first time it is asked for
+_square_positions = None
+
+def square_positions():
+    global _square_positions
+    if _square_positions is not None:
+        return _square_positions
+    positions = []
+    num_rows = len(NUM_SQUARES)
+    for row, num in enumerate(NUM_SQUARES):
+        for i in range(num):
+            x = (i - num / 2 + 0.5) * SQUARE_SPACING
+            y = (num_rows - row - 1) * SQUARE_SPACING
+            positions.append((x, y))
+    _square_positions = tuple(positions)
+    return _square_positions
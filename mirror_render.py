@@ -0,0 +1,169 @@
+import os
+import sys
+import time
+import zlib
+import struct
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from mirror_geometry import square_positions
+
+#headless version of the mirror command plot: every actuator frame is rasterised by indexing a per-frame
+#palette with a precomputed pixel -> actuator map, no Qt, no figure, no display
+EDGE = 0
+BACKGROUND = 1
+EDGE_COLOR = (0, 0, 0)
+BACKGROUND_COLOR = (255, 255, 255)
+
+def viridis_lut(size=256):
+    #taken from matplotlib once per run, workers get the table and never import matplotlib themselves
+    from matplotlib import colormaps
+    return (colormaps["viridis"](np.linspace(0, 1, size))[:, :3] * 255 + 0.5).astype(np.uint8)
+
+def index_map(scale=16, padding=1.0):
+    #(height, width) array of palette entries: 0 square edge, 1 background, 2 + i actuator i;
+    #same squares, 1 unit wide with black edges, and the same padding as PlotView
+    positions = np.array(square_positions())
+    x0 = positions[:, 0].min() - 0.5 - padding
+    x1 = positions[:, 0].max() + 0.5 + padding
+    y0 = positions[:, 1].min() - 0.5 - padding
+    y1 = positions[:, 1].max() + 0.5 + padding
+    width = int(round((x1 - x0) * scale))
+    height = int(round((y1 - y0) * scale))
+    pixels = np.full((height, width), BACKGROUND, dtype=np.int16)
+    for i, (x, y) in enumerate(positions):
+        left = int(round((x - 0.5 - x0) * scale))
+        right = int(round((x + 0.5 - x0) * scale))
+        #image rows count down from the top, the plot's y axis counts up
+        top = int(round((y1 - y - 0.5) * scale))
+        bottom = int(round((y1 - y + 0.5) * scale))
+        pixels[top:bottom, left:right] = EDGE
+        pixels[top + 1:bottom - 1, left + 1:right - 1] = 2 + i
+    return pixels
+
+def render_frames(frames, pixels, lut, fixed=False):
+    #(frames, actuators) -> (frames, height, width, 3) uint8 in one gather
+    frames = np.atleast_2d(np.asarray(frames, dtype=np.float64))
+    if fixed:
+        low, high = np.full(len(frames), -1.0), np.full(len(frames), 1.0)
+    else:
+        #same per-frame min/max normalisation as PlotView.update_colors
+        low, high = frames.min(axis=1), frames.max(axis=1)
+    span = np.where(high > low, high - low, 1.0)
+    levels = np.clip((frames - low[:, None]) / span[:, None], 0, 1)
+    colors = lut[(levels * (len(lut) - 1) + 0.5).astype(np.intp)]
+    palettes = np.empty((len(frames), 2 + frames.shape[1], 3), dtype=np.uint8)
+    palettes[:, EDGE] = EDGE_COLOR
+    palettes[:, BACKGROUND] = BACKGROUND_COLOR
+    palettes[:, 2:] = colors
+    return palettes[np.arange(len(frames))[:, None, None], pixels[None]]
+
+def write_png(path, image):
+    #8-bit RGB png with only the standard library: filter byte 0 on every row, one zlib stream
+    image = np.ascontiguousarray(image, dtype=np.uint8)
+    height, width = image.shape[:2]
+    raw = np.zeros((height, 1 + width * 3), dtype=np.uint8)
+    raw[:, 1:] = image.reshape(height, width * 3)
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+    with open(path, 'wb') as file:
+        file.write(b"\x89PNG\r\n\x1a\n")
+        file.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+        file.write(chunk(b"IDAT", zlib.compress(raw.tobytes(), 6)))
+        file.write(chunk(b"IEND", b""))
+
+def tile(images, cols, gap=2):
+    #contact sheet, row-major, with a white gap between frames
+    n, height, width = images.shape[:3]
+    rows = (n + cols - 1) // cols
+    sheet = np.full((rows * (height + gap) - gap, cols * (width + gap) - gap, 3), 255, dtype=np.uint8)
+    for k in range(n):
+        r, c = divmod(k, cols)
+        sheet[r * (height + gap):r * (height + gap) + height, c * (width + gap):c * (width + gap) + width] = images[k]
+    return sheet
+
+#per-process state for the pool, set once by the initializer so each task only carries its own frames
+_worker = {}
+
+def _init_worker(pixels, lut, fixed):
+    _worker.update(pixels=pixels, lut=lut, fixed=fixed)
+
+def _render_sheet(args):
+    frames, path, cols = args
+    write_png(path, tile(render_frames(frames, _worker["pixels"], _worker["lut"], _worker["fixed"]), cols))
+    return path
+
+def _render_stack_chunk(args):
+    frames, stackPath, start = args
+    stack = np.load(stackPath, mmap_mode='r+')
+    stack[start:start + len(frames)] = render_frames(frames, _worker["pixels"], _worker["lut"], _worker["fixed"])
+    stack.flush()
+    return len(frames)
+
+def render_sheets(frames, folder, cols=10, rows=10, scale=8, fixed=False, workers=None):
+    #one png per cols x rows frames, rendered across a process pool
+    os.makedirs(folder, exist_ok=True)
+    pixels = index_map(scale)
+    perSheet = cols * rows
+    tasks = [(np.asarray(frames[start:start + perSheet]), os.path.join(folder, f"sheet_{start // perSheet:05d}.png"), cols)
+             for start in range(0, len(frames), perSheet)]
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(pixels, viridis_lut(), fixed)) as pool:
+        return list(pool.map(_render_sheet, tasks))
+
+def render_stack(frames, path, scale=8, fixed=False, workers=None, chunkFrames=256):
+    #every frame into one (frames, height, width, 3) uint8 .npy, each worker writes its own slice of the memmap
+    pixels = index_map(scale)
+    stack = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=(len(frames),) + pixels.shape + (3,))
+    del stack
+    tasks = [(np.asarray(frames[start:start + chunkFrames]), path, start) for start in range(0, len(frames), chunkFrames)]
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(pixels, viridis_lut(), fixed)) as pool:
+        return sum(pool.map(_render_stack_chunk, tasks))
+
+def load_frames(path, serialName=None, configDir='./config'):
+    #compiled bank (.npy), DM journal (.djr) or a pattern table projected with the mirror's Z2C
+    if path.endswith(".npy"):
+        return np.load(path, mmap_mode='r')
+    if path.endswith(".djr"):
+        from dm_journal import DMJournal
+        return DMJournal(path).ordered()["actuators"]
+    if serialName is None:
+        raise ValueError("Pattern tables need --serial to find the Z2C matrix")
+    from z2c_store import load_z2c
+    from pattern_stream import iter_pattern_blocks, iter_actuator_blocks
+    blocks = list(iter_actuator_blocks(load_z2c(serialName, configDir), iter_pattern_blocks(path)))
+    return np.concatenate(blocks) if blocks else np.empty((0, 97))
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Render DM actuator frames to png contact sheets or an image stack without a display")
+    parser.add_argument("source", help="compiled bank .npy, journal .djr, or pattern csv/.zpat (with --serial)")
+    parser.add_argument("--sheets", help="folder for the png contact sheets")
+    parser.add_argument("--stack", help=".npy file for the (frames, height, width, 3) image stack")
+    parser.add_argument("--serial", help="mirror serial, for projecting pattern tables")
+    parser.add_argument("--config", default="./config", help="folder with the <serial>-Z2C.csv files")
+    parser.add_argument("--scale", type=int, default=8, help="pixels per actuator pitch unit")
+    parser.add_argument("--cols", type=int, default=10)
+    parser.add_argument("--rows", type=int, default=10)
+    parser.add_argument("--fixed", action="store_true", help="color on a fixed [-1,1] scale instead of per-frame min/max")
+    parser.add_argument("--workers", type=int, help="processes in the pool (default one per cpu)")
+    return parser.parse_args(args[1:])
+
+def main(args):
+    options = parse_args(args)
+    if not options.sheets and not options.stack:
+        print("Give --sheets and/or --stack")
+        return
+    frames = load_frames(options.source, options.serial, options.config)
+    start = time.perf_counter()
+    if options.sheets:
+        sheets = render_sheets(frames, options.sheets, options.cols, options.rows, options.scale, options.fixed, options.workers)
+        print(f"{len(frames)} frames on {len(sheets)} sheets in {options.sheets}")
+    if options.stack:
+        render_stack(frames, options.stack, options.scale, options.fixed, options.workers)
+        print(f"{len(frames)} frames stacked in {options.stack}")
+    elapsed = time.perf_counter() - start
+    print(f"{elapsed:.2f} s, {len(frames) / elapsed:.0f} frames per second")
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,165 @@
+import os
+import sys
+import csv
+import json
+import queue
+import struct
+import argparse
+import itertools
+import threading
+import numpy as np
+from zernike_modes import parse_range
+
+#binary pattern layout, like the PSU recordings: 8 byte magic, uint32 header size, json metadata padded to the
+#header size (a multiple of 512), then the normalised coefficients as rows of one float per mode
+MAGIC = b"ZPATTRN1"
+PATTERN_EXTENSION = ".zpat"
+
+def is_binary_pattern(path):
+    return path.endswith(PATTERN_EXTENSION)
+
+def read_csv_header(file):
+    #first row: mode names, second row: "[min,max]" per mode
+    names, ranges = itertools.islice(csv.reader(file), 2)
+    return names, np.array([parse_range(cell) for cell in ranges])
+
+def write_binary_header(file, names, ranges, dtype):
+    meta = json.dumps({
+        "version": 1,
+        "dtype": np.dtype(dtype).str,
+        "modes": len(ranges),
+        "names": list(names),
+        "ranges": np.asarray(ranges, dtype=float).tolist(),
+    }).encode()
+    headerSize = (len(meta) + 12 + 511) // 512 * 512
+    file.write(MAGIC + struct.pack("<I", headerSize) + meta.ljust(headerSize - 12))
+
+def read_binary_header(file):
+    if file.read(8) != MAGIC:
+        raise ValueError("Not a binary pattern file")
+    headerSize, = struct.unpack("<I", file.read(4))
+    meta = json.loads(file.read(headerSize - 12).decode())
+    meta["header_size"] = headerSize
+    return meta
+
+def open_binary_pattern(path):
+    #memory-mapped (frames x modes) view, nothing is read until rows are touched
+    with open(path, 'rb') as file:
+        meta = read_binary_header(file)
+    dtype = np.dtype(meta["dtype"])
+    nRows = (os.path.getsize(path) - meta["header_size"]) // (dtype.itemsize * meta["modes"])
+    return meta, np.memmap(path, dtype=dtype, mode='r', offset=meta["header_size"], shape=(nRows, meta["modes"]))
+
+def pattern_info(path):
+    if is_binary_pattern(path):
+        meta, data = open_binary_pattern(path)
+        return meta["names"], np.array(meta["ranges"]), len(data)
+    with open(path, newline='') as file:
+        names, ranges = read_csv_header(file)
+        return names, ranges, None
+
+def iter_pattern_blocks(path, blockRows=4096):
+    #yields (rows x modes) float64 blocks already divided by each mode's max; memory stays at one block
+    #however long the file is, and the first block is ready as soon as it has been parsed
+    if is_binary_pattern(path):
+        meta, data = open_binary_pattern(path)
+        for start in range(0, len(data), blockRows):
+            yield np.asarray(data[start:start + blockRows], dtype=np.float64)
+        return
+    with open(path, newline='') as file:
+        names, ranges = read_csv_header(file)
+        scale = 1.0 / ranges[:, 1]
+        while True:
+            lines = list(itertools.islice(file, blockRows))
+            if not lines:
+                break
+            block = np.loadtxt(lines, delimiter=",", ndmin=2, dtype=np.float64)
+            if len(block):
+                block *= scale
+                yield block
+
+def iter_actuator_blocks(Z2C, coefficientBlocks):
+    #project block by block with the same rescale as the compiled bank
+    from dm_pattern import compile_pattern_bank
+    for block in coefficientBlocks:
+        yield compile_pattern_bank(Z2C, block)
+
+def prefetch(blocks, depth=2):
+    #parse on a helper thread so the next block is ready when playback reaches it; the bounded queue
+    #keeps memory at a few blocks and stalls the parser when playback is slower than parsing
+    slots = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def fill():
+        try:
+            for block in blocks:
+                if stop.is_set():
+                    return
+                slots.put(block)
+            slots.put(done)
+        except Exception as error:
+            slots.put(error)
+
+    thread = threading.Thread(target=fill, name="pattern prefetch", daemon=True)
+    thread.start()
+    try:
+        while True:
+            block = slots.get()
+            if block is done:
+                break
+            if isinstance(block, Exception):
+                raise block
+            yield block
+    finally:
+        stop.set()
+        #unblock the filler if it is waiting on a full queue
+        while thread.is_alive():
+            try:
+                slots.get_nowait()
+            except queue.Empty:
+                thread.join(0.01)
+
+def write_binary_pattern(path, names, ranges, blocks, dtype=np.float32):
+    frames = 0
+    with open(path, 'wb') as file:
+        write_binary_header(file, names, ranges, dtype)
+        for block in blocks:
+            file.write(np.ascontiguousarray(block, dtype=np.dtype(dtype).newbyteorder('<')).tobytes())
+            frames += len(block)
+    return frames
+
+def write_csv_pattern(path, names, ranges, blocks):
+    frames = 0
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(names)
+        writer.writerow([f"[{low:g},{high:g}]" for low, high in ranges])
+        for block in blocks:
+            np.savetxt(file, block * ranges[:, 1], delimiter=",", fmt="%.9g")
+            frames += len(block)
+    return frames
+
+def convert_pattern(sourcePath, destinationPath, blockRows=4096, dtype=np.float32):
+    #csv -> .zpat or .zpat -> csv, one block at a time
+    names, ranges, _ = pattern_info(sourcePath)
+    blocks = iter_pattern_blocks(sourcePath, blockRows)
+    if is_binary_pattern(destinationPath):
+        return write_binary_pattern(destinationPath, names, ranges, blocks, dtype)
+    return write_csv_pattern(destinationPath, names, ranges, blocks)
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Convert Zernike pattern tables between csv and the binary .zpat format")
+    parser.add_argument("source")
+    parser.add_argument("destination")
+    parser.add_argument("--block-rows", type=int, default=4096)
+    parser.add_argument("--float64", action="store_true", help="store double precision instead of float32")
+    return parser.parse_args(args[1:])
+
+def main(args):
+    options = parse_args(args)
+    frames = convert_pattern(options.source, options.destination, options.block_rows, np.float64 if options.float64 else np.float32)
+    print(f"{frames} frames written to {options.destination}")
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,84 @@
+import json
+import time
+import struct
+import threading
+import numpy as np
+import instrumentation
+
+#file layout: 8 byte magic, uint32 header size, json metadata padded with spaces up to the header size,
+#then float64 rows of [time, channel values...] appended until the run stops, so it memory-maps directly
+MAGIC = b"PSUREC1\0"
+HEADER_SIZE = 512
+
+def write_header(file, channels, rate, startTime):
+    meta = json.dumps({
+        "version": 1,
+        "dtype": "<f8",
+        "channels": [int(c) for c in channels],
+        "columns": ["time"] + [f"Channel {c}" for c in channels],
+        "rate": float(rate),
+        "start": float(startTime),
+    }).encode()
+    if len(meta) > HEADER_SIZE - 12:
+        raise ValueError("Too many channels for the recording header")
+    file.write(MAGIC + struct.pack("<I", HEADER_SIZE) + meta.ljust(HEADER_SIZE - 12))
+
+def read_header(file):
+    magic = file.read(8)
+    if magic != MAGIC:
+        raise ValueError("Not a PSU recording")
+    headerSize, = struct.unpack("<I", file.read(4))
+    meta = json.loads(file.read(headerSize - 12).decode())
+    meta["header_size"] = headerSize
+    return meta
+
+class StreamRecorder:
+    def __init__(self, path, ring, channels, rate, flushInterval=0.25, chunkRows=4096):
+        self.path = path
+        self.ring = ring
+        self.channels = np.asarray(channels, dtype=int)
+        self.rate = rate
+        self.flushInterval = flushInterval
+        self.rowBytes = 8 * (1 + len(self.channels))
+        self.rows = 0 #rows written to disk so far
+        self.lost = 0 #samples the ring overwrote before the writer got to them
+        self._cursor = ring.written
+        self._running = False
+        self._thread = None
+        #the file object buffers whole chunks, so small drains don't each hit the disk
+        self._file = open(path, 'wb', buffering=chunkRows * self.rowBytes)
+        write_header(self._file, self.channels, rate, time.time())
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="recorder", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._drain()
+        self._file.close()
+
+    def _run(self):
+        while self._running:
+            time.sleep(self.flushInterval)
+            self._drain()
+
+    def _drain(self):
+        times, values, self._cursor, lost = self.ring.read_from(self._cursor)
+        self.lost += lost
+        n = len(times)
+        if n == 0:
+            return
+        block = np.empty((n, 1 + len(self.channels)))
+        block[:, 0] = times
+        block[:, 1:] = values[:, self.channels]
+        start = instrumentation.now() if instrumentation.ENABLED else 0
+        self._file.write(block.tobytes())
+        if start:
+            instrumentation.record("recorder.write", start)
+            instrumentation.count("recorder.rows", n)
+        self.rows += n
@@ -0,0 +1,185 @@
+import os
+import re
+import sys
+import glob
+import pickle
+import argparse
+import numpy as np
+from recorder import read_header, write_header
+
+class Recording:
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            self.meta = read_header(file)
+        self.channels = self.meta["channels"]
+        self.rate = self.meta["rate"]
+        nCols = 1 + len(self.channels)
+        nRows = (os.path.getsize(path) - self.meta["header_size"]) // (8 * nCols)
+        #nothing is read here, pages are only pulled in when a slice is touched
+        self.data = np.memmap(path, dtype=self.meta["dtype"], mode='r', offset=self.meta["header_size"], shape=(nRows, nCols))
+        self.times = self.data[:, 0]
+
+    def __len__(self):
+        return len(self.data)
+
+    def row_range(self, start=None, stop=None):
+        #time column is monotonic, so a time window is two binary searches
+        first = 0 if start is None else int(np.searchsorted(self.times, start, side='left'))
+        last = len(self.data) if stop is None else int(np.searchsorted(self.times, stop, side='right'))
+        return first, last
+
+    def columns(self, channels=None):
+        if channels is None:
+            return list(range(1, 1 + len(self.channels)))
+        return [1 + self.channels.index(c) for c in channels]
+
+    def select(self, start=None, stop=None, channels=None):
+        first, last = self.row_range(start, stop)
+        return self.times[first:last], self.data[first:last, self.columns(channels)]
+
+    def iter_chunks(self, start=None, stop=None, channels=None, chunkRows=1 << 20):
+        first, last = self.row_range(start, stop)
+        columns = self.columns(channels)
+        for i in range(first, last, chunkRows):
+            j = min(i + chunkRows, last)
+            yield self.times[i:j], self.data[i:j, columns]
+
+    def stats(self, start=None, stop=None, channels=None, chunkRows=1 << 20):
+        nCh = len(self.columns(channels))
+        count = 0
+        mean = np.zeros(nCh)
+        m2 = np.zeros(nCh)
+        lo = np.full(nCh, np.inf)
+        hi = np.full(nCh, -np.inf)
+        for _, values in self.iter_chunks(start, stop, channels, chunkRows):
+            n = len(values)
+            chunkMean = values.mean(axis=0)
+            chunkM2 = ((values - chunkMean) ** 2).sum(axis=0)
+            #merge chunk moments into the running ones (Chan et al.) so long runs stay numerically stable
+            delta = chunkMean - mean
+            total = count + n
+            mean += delta * n / total
+            m2 += chunkM2 + delta ** 2 * count * n / total
+            count = total
+            np.minimum(lo, values.min(axis=0), out=lo)
+            np.maximum(hi, values.max(axis=0), out=hi)
+        std = np.sqrt(m2 / count) if count else np.full(nCh, np.nan)
+        return {"count": count, "min": lo, "max": hi, "mean": mean, "std": std}
+
+    def psd(self, channel, start=None, stop=None, nperseg=1024):
+        #Welch estimate: average the Hann-windowed periodograms of half-overlapping segments
+        window = np.hanning(nperseg)
+        scale = 1.0 / (self.rate * (window ** 2).sum())
+        step = nperseg // 2
+        first, last = self.row_range(start, stop)
+        column = self.columns([channel])[0]
+        total = np.zeros(nperseg // 2 + 1)
+        nSeg = 0
+        blockRows = step * 1024
+        for i in range(first, last - nperseg + 1, blockRows):
+            j = min(i + blockRows + nperseg - step, last)
+            block = np.asarray(self.data[i:j, column])
+            if len(block) < nperseg:
+                break
+            segments = np.lib.stride_tricks.sliding_window_view(block, nperseg)[::step]
+            segments = (segments - segments.mean(axis=1, keepdims=True)) * window
+            total += (np.abs(np.fft.rfft(segments, axis=1)) ** 2).sum(axis=0)
+            nSeg += len(segments)
+        freqs = np.fft.rfftfreq(nperseg, 1.0 / self.rate)
+        power = total * scale / max(nSeg, 1)
+        power[1:-1] *= 2 #one-sided
+        return freqs, power
+
+    def threshold_crossings(self, channel, level, direction='both', start=None, stop=None, chunkRows=1 << 20):
+        found = []
+        previous = None
+        for times, values in self.iter_chunks(start, stop, [channel], chunkRows):
+            above = values[:, 0] > level
+            if previous is not None:
+                #carry the last sample of the previous chunk so boundary crossings aren't missed
+                above = np.concatenate(([previous], above))
+                times = np.concatenate(([np.nan], times))
+            changes = np.flatnonzero(above[1:] != above[:-1]) + 1
+            if direction == 'rising':
+                changes = changes[above[changes]]
+            elif direction == 'falling':
+                changes = changes[~above[changes]]
+            found.append(times[changes])
+            previous = above[-1]
+        return np.concatenate(found) if found else np.empty(0)
+
+def convert_pickles(directory, outPath, channels=None, rate=0.0):
+    #old recordings are <base>_NNN.pkl windows holding a time row followed by one row per recorded channel
+    files = sorted(glob.glob(os.path.join(directory, "*_[0-9][0-9][0-9].pkl")), key=lambda f: int(re.search(r"_(\d+)\.pkl$", f).group(1)))
+    if not files:
+        raise FileNotFoundError(f"No _NNN.pkl windows in {directory}")
+    windows = []
+    for fileName in files:
+        with open(fileName, 'rb') as file:
+            windows.append(np.asarray(pickle.load(file), dtype=np.float64).T)
+    rows = np.concatenate(windows)
+    rows = rows[~np.isnan(rows[:, 0])]
+    #windows can overlap at their edges, keep each time stamp once in time order
+    _, keep = np.unique(rows[:, 0], return_index=True)
+    rows = rows[keep]
+    if channels is None:
+        channels = list(range(rows.shape[1] - 1))
+    if not rate and len(rows) > 1:
+        rate = 1.0 / np.median(np.diff(rows[:, 0]))
+    with open(outPath, 'wb') as file:
+        write_header(file, channels, rate, 0.0)
+        file.write(np.ascontiguousarray(rows).tobytes())
+    return len(rows)
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Inspect PSU recordings without loading them into memory")
+    commands = parser.add_subparsers(dest="command", required=True)
+    for name in ("info", "stats", "psd", "crossings"):
+        command = commands.add_parser(name)
+        command.add_argument("recording")
+        command.add_argument("--start", type=float, help="start time in seconds")
+        command.add_argument("--stop", type=float, help="stop time in seconds")
+        command.add_argument("--channels", type=int, nargs="+", help="recorded channel numbers")
+    commands.choices["psd"].add_argument("--nperseg", type=int, default=1024)
+    commands.choices["crossings"].add_argument("--level", type=float, required=True)
+    commands.choices["crossings"].add_argument("--direction", choices=["both", "rising", "falling"], default="both")
+    convert = commands.add_parser("convert", help="join a directory of old _NNN.pkl windows into one recording")
+    convert.add_argument("directory")
+    convert.add_argument("output")
+    convert.add_argument("--channels", type=int, nargs="+", help="channel numbers the pickles were recorded from")
+    convert.add_argument("--rate", type=float, default=0.0)
+    return parser.parse_args(args[1:])
+
+def main(args):
+    options = parse_args(args)
+    if options.command == "convert":
+        n = convert_pickles(options.directory, options.output, options.channels, options.rate)
+        print(f"wrote {n} samples to {options.output}")
+        return
+    recording = Recording(options.recording)
+    channels = options.channels or recording.channels
+    if options.command == "info":
+        first, last = recording.row_range(options.start, options.stop)
+        span = recording.times[last - 1] - recording.times[first] if last > first else 0.0
+        print(f"{recording.path}: {len(recording)} samples, channels {recording.channels}, {recording.rate:g} Hz")
+        print(f"selected {last - first} samples over {span:.3f} s")
+    elif options.command == "stats":
+        stats = recording.stats(options.start, options.stop, channels)
+        print(f"{stats['count']} samples")
+        for i, channel in enumerate(channels):
+            print(f"Channel {channel:2d}: min {stats['min'][i]: .6f}  max {stats['max'][i]: .6f}  mean {stats['mean'][i]: .6f}  std {stats['std'][i]:.6f}")
+    elif options.command == "psd":
+        for channel in channels:
+            freqs, power = recording.psd(channel, options.start, options.stop, options.nperseg)
+            peak = np.argmax(power[1:]) + 1
+            print(f"Channel {channel:2d}: peak {power[peak]:.3e} V^2/Hz at {freqs[peak]:.3f} Hz, total power {power.sum() * (freqs[1] - freqs[0]):.3e} V^2")
+    elif options.command == "crossings":
+        for channel in channels:
+            times = recording.threshold_crossings(channel, options.level, options.direction, options.start, options.stop)
+            print(f"Channel {channel:2d}: {len(times)} crossings of {options.level:g} V")
+            if len(times):
+                print("  first at " + ", ".join(f"{t:.4f}" for t in times[:10]) + (" ..." if len(times) > 10 else ""))
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,134 @@
+import os
+import time
+import random
+import numpy as np
+
+#stand-ins for asdk.DM, dashboard.device.Device and pipython.GCSDevice so the tools and benchmarks
+#run without hardware; per-call latency and jitter (seconds) come from the environment or the constructor
+def _env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+def _delay(latency, jitter):
+    delay = latency + (random.uniform(-jitter, jitter) if jitter else 0.0)
+    if delay > 0:
+        time.sleep(delay)
+
+class SimulatedDM:
+    def __init__(self, serialName, nbAct=97, latency=None, jitter=None):
+        self.serialName = serialName
+        self.nbAct = nbAct
+        self.latency = _env_float("SUMMER_SIM_DM_LATENCY", 0.0) if latency is None else latency
+        self.jitter = _env_float("SUMMER_SIM_DM_JITTER", 0.0) if jitter is None else jitter
+        self.values = np.zeros(nbAct)
+        self.sent = 0
+        print(f"Simulated DM {serialName} with {nbAct} actuators")
+
+    def Get(self, key):
+        if key == 'NBOfActuator':
+            return float(self.nbAct)
+        raise KeyError(key)
+
+    def Send(self, values):
+        _delay(self.latency, self.jitter)
+        self.values[:] = values
+        self.sent += 1
+
+    def Reset(self):
+        self.values[:] = 0.0
+
+class SimulatedDevice:
+    def __init__(self, path, nChannels=16, latency=None, jitter=None, bulk=False):
+        self.path = path
+        self.nChannels = nChannels
+        self.latency = _env_float("SUMMER_SIM_DAQ_LATENCY", 0.0) if latency is None else latency
+        self.jitter = _env_float("SUMMER_SIM_DAQ_JITTER", 0.0) if jitter is None else jitter
+        self.start = time.perf_counter()
+        #each channel is a slow sine around its own offset with a little noise, like the PSU rails
+        self.offsets = np.linspace(0.5, 15.5, nChannels)
+        self.rng = np.random.default_rng()
+        self.mirror = None
+        self.coupling = None
+        if bulk:
+            self.analog_read_all = self._read_all
+
+    def couple(self, mirror, coupling):
+        #make the channels respond to a SimulatedDM through a (channels, actuators) matrix, for influence measurements
+        self.mirror = mirror
+        self.coupling = np.asarray(coupling, dtype=np.float64)
+
+    def analog_read(self, channel):
+        _delay(self.latency, self.jitter)
+        t = time.perf_counter() - self.start
+        value = self.offsets[channel] + 0.1 * np.sin(0.5 * t + channel) + 0.005 * self.rng.standard_normal()
+        if self.mirror is not None:
+            value += self.coupling[channel] @ self.mirror.values
+        return float(value)
+
+    def _read_all(self):
+        _delay(self.latency, self.jitter)
+        t = time.perf_counter() - self.start
+        values = self.offsets + 0.1 * np.sin(0.5 * t + np.arange(self.nChannels)) + 0.005 * self.rng.standard_normal(self.nChannels)
+        if self.mirror is not None:
+            values += self.coupling @ self.mirror.values
+        return values
+
+class SimulatedGCSDevice:
+    axes = ["X", "Y", "Z", "U", "V", "W"]
+
+    def __init__(self, name='C-887', latency=None, jitter=None, velocity=10.0):
+        self.name = name
+        self.latency = _env_float("SUMMER_SIM_GCS_LATENCY", 0.0) if latency is None else latency
+        self.jitter = _env_float("SUMMER_SIM_GCS_JITTER", 0.0) if jitter is None else jitter
+        self.velocity = velocity #mm (or deg) per second, every axis moves in a straight line to its target
+        self.origin = {axis: 0.0 for axis in self.axes}
+        self.target = dict(self.origin)
+        self.moveStart = time.perf_counter()
+        self.moveTime = 0.0
+
+    def _axes(self, axes):
+        if axes is None:
+            return list(self.axes)
+        return [axes] if isinstance(axes, str) else list(axes)
+
+    def _now_positions(self):
+        if self.moveTime <= 0:
+            return dict(self.target)
+        fraction = min(1.0, (time.perf_counter() - self.moveStart) / self.moveTime)
+        return {axis: self.origin[axis] + fraction * (self.target[axis] - self.origin[axis]) for axis in self.axes}
+
+    def InterfaceSetupDlg(self, *args, **kwargs):
+        pass
+
+    def CloseConnection(self):
+        pass
+
+    def qIDN(self):
+        _delay(self.latency, self.jitter)
+        return f"Simulated {self.name}"
+
+    def qPOS(self, axes=None):
+        _delay(self.latency, self.jitter)
+        positions = self._now_positions()
+        return {axis: positions[axis] for axis in self._axes(axes)}
+
+    def qONT(self, axes=None):
+        _delay(self.latency, self.jitter)
+        done = time.perf_counter() - self.moveStart >= self.moveTime
+        return {axis: done for axis in self._axes(axes)}
+
+    def MOV(self, axes, values=None):
+        _delay(self.latency, self.jitter)
+        if isinstance(axes, dict):
+            axes, values = list(axes.keys()), list(axes.values())
+        axes = self._axes(axes)
+        if not isinstance(values, (list, tuple, np.ndarray)):
+            values = [values]
+        self.origin = self._now_positions()
+        for axis, value in zip(axes, values):
+            self.target[axis] = float(value)
+        distance = max(abs(self.target[axis] - self.origin[axis]) for axis in self.axes)
+        self.moveStart = time.perf_counter()
+        self.moveTime = distance / self.velocity
@@ -0,0 +1,59 @@
+from PyQt5.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QLabel, QTableWidget, QTableWidgetItem, QHeaderView
+from PyQt5.QtCore import QTimer
+import instrumentation
+
+COLUMNS = ["count", "mean_us", "p50_us", "p99_us", "p999_us", "max_us"]
+
+class StatsPanel(QWidget):
+    #table of the instrumentation histograms, refreshed on a timer, with dump and reset buttons
+    def __init__(self, interval=1000):
+        super(StatsPanel, self).__init__()
+        self.setWindowTitle("Latency Stats")
+        self.table = QTableWidget(0, len(COLUMNS))
+        self.table.setHorizontalHeaderLabels(["count", "mean (us)", "p50 (us)", "p99 (us)", "p99.9 (us)", "max (us)"])
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
+        self.rows = {}
+        dumpButton = QPushButton("Dump JSON")
+        dumpButton.clicked.connect(self.dumpStats)
+        resetButton = QPushButton("Reset")
+        resetButton.clicked.connect(self.resetStats)
+        self.status = QLabel("" if instrumentation.ENABLED else "Instrumentation is off, start with --instrument")
+        buttonLayout = QHBoxLayout()
+        buttonLayout.addWidget(dumpButton)
+        buttonLayout.addWidget(resetButton)
+        buttonLayout.addWidget(self.status)
+        layout = QVBoxLayout()
+        layout.addWidget(self.table)
+        layout.addLayout(buttonLayout)
+        self.setLayout(layout)
+        self.timer = QTimer()
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start(interval)
+
+    def refresh(self):
+        for stage, hist in sorted(instrumentation.stages.items()):
+            row = self.rows.get(stage)
+            if row is None:
+                #new stages show up as soon as their first sample is recorded
+                row = self.rows[stage] = self.table.rowCount()
+                self.table.insertRow(row)
+                self.table.setVerticalHeaderItem(row, QTableWidgetItem(stage))
+                for column in range(len(COLUMNS)):
+                    self.table.setItem(row, column, QTableWidgetItem(""))
+            summary = hist.summary()
+            for column, key in enumerate(COLUMNS):
+                text = str(summary[key]) if key == "count" else f"{summary[key]:.1f}"
+                item = self.table.item(row, column)
+                if item.text() != text:
+                    item.setText(text)
+
+    def dumpStats(self):
+        self.status.setText(f"Saved {instrumentation.dump()}")
+
+    def resetStats(self):
+        instrumentation.reset()
+        self.refresh()
+
+    def closeEvent(self, event):
+        self.timer.stop()
+        super(StatsPanel, self).closeEvent(event)
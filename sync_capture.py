@@ -0,0 +1,313 @@
+import os
+import sys
+import time
+import argparse
+import numpy as np
+from multiprocessing import shared_memory
+
+#CLOCK_MONOTONIC is the same clock in every process on the machine, so DM sends stamped in one program and
+#analog samples stamped in another can be lined up directly
+now_ns = time.monotonic_ns
+
+DM_RING = "summer_dm_events"
+ANALOG_RING = "summer_analog"
+HEADER_BYTES = 64
+
+def attach_shared_memory(name):
+    #attach to a block another process created; before Python 3.13 the attaching process also registers it
+    #with its resource tracker, which would unlink it under the owner when this process exits
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, "shared_memory")
+    except (ImportError, AttributeError, KeyError):
+        pass
+    return shm
+
+def process_alive(pid):
+    if pid <= 0:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class SharedRing:
+    #single-writer ring of (monotonic ns, float64 row) in shared memory; header holds [written, capacity, columns, writer pid]
+    def __init__(self, name, nColumns=0, capacity=0, create=False):
+        self.name = name
+        if create:
+            size = HEADER_BYTES + capacity * 8 * (1 + nColumns)
+            try:
+                self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            except FileExistsError:
+                #only a block whose writer has gone (a crashed run) is reclaimed, a live one is an error
+                stale = attach_shared_memory(name)
+                owner = int(np.ndarray((4,), dtype=np.int64, buffer=stale.buf)[3]) if stale.size >= 32 else 0
+                stale.close()
+                if process_alive(owner):
+                    raise FileExistsError(f"Shared ring {name} is already written by process {owner}")
+                stale = shared_memory.SharedMemory(name=name)
+                stale.close()
+                stale.unlink()
+                self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        else:
+            self.shm = attach_shared_memory(name)
+        self.header = np.ndarray((4,), dtype=np.int64, buffer=self.shm.buf)
+        if create:
+            self.header[:] = [0, capacity, nColumns, os.getpid()]
+        self.owner = create
+        self.capacity = int(self.header[1])
+        self.nColumns = int(self.header[2])
+        self.times = np.ndarray((self.capacity,), dtype=np.int64, buffer=self.shm.buf, offset=HEADER_BYTES)
+        self.values = np.ndarray((self.capacity, self.nColumns), dtype=np.float64, buffer=self.shm.buf, offset=HEADER_BYTES + 8 * self.capacity)
+
+    @property
+    def written(self):
+        return int(self.header[0])
+
+    def push(self, t, row):
+        written = int(self.header[0])
+        i = written % self.capacity
+        self.times[i] = t
+        self.values[i] = row
+        #publish only after the slot is complete
+        self.header[0] = written + 1
+
+    def latest(self, n):
+        written = self.written
+        n = min(n, written, self.capacity)
+        idx = np.arange(written - n, written) % self.capacity
+        return self.times[idx], self.values[idx]
+
+    def window(self, t0, t1, rate):
+        #samples stamped in [t0, t1] ns; only the tail the window can reach is copied
+        span = (self.written and (now_ns() - t0)) / 1e9
+        times, values = self.latest(int(span * rate * 1.5) + 64)
+        keep = (times >= t0) & (times <= t1)
+        return times[keep], values[keep]
+
+    def rate(self, n=256):
+        times, _ = self.latest(n)
+        if len(times) < 2:
+            return 0.0
+        return (len(times) - 1) / ((times[-1] - times[0]) / 1e9)
+
+    def close(self):
+        del self.times, self.values, self.header
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+class TimedDM:
+    #drop-in wrapper around a DM that stamps every Send on the shared clock: [frame number, send duration in s]
+    def __init__(self, dm, ring):
+        self.dm = dm
+        self.ring = ring
+        self.frame = 0
+        self.row = np.zeros(2)
+
+    def Get(self, key):
+        return self.dm.Get(key)
+
+    def Reset(self):
+        self.dm.Reset()
+
+    def Send(self, values):
+        start = now_ns()
+        self.dm.Send(values)
+        self.row[0] = self.frame
+        self.row[1] = (now_ns() - start) / 1e9
+        self.ring.push(start, self.row)
+        self.frame += 1
+        return start
+
+class SyncCapture:
+    def __init__(self, dm, analogRing, rate=None, timeout=0.1):
+        self.dm = dm
+        self.analogRing = analogRing
+        self.rate = rate or analogRing.rate() or 1000.0
+        self.timeout = timeout #seconds past the window (plus a few sample periods) before giving up on the reader
+
+    def capture(self, frame, preMs, postMs):
+        #send one frame and return the analog samples from preMs before to postMs after it, times in ms from the send
+        sent = self.dm.Send(frame)
+        t1 = sent + int(postMs * 1e6)
+        #a stopped analog reader would otherwise hang the run; allow a few sample periods past the window
+        deadline = t1 + int((10 / self.rate + self.timeout) * 1e9)
+        while self.analogRing.written == 0 or self.analogRing.latest(1)[0][0] < t1:
+            if now_ns() > deadline:
+                raise TimeoutError(f"No analog samples {postMs:g} ms after the frame, is the analog reader still running?")
+            time.sleep(min(0.001, postMs / 1e3 / 10 + 1e-4))
+        times, values = self.analogRing.window(sent - int(preMs * 1e6), t1, self.rate)
+        return (times - sent) / 1e6, values
+
+class FrameWatcher:
+    #the other direction: frames another process stamped in DM_RING (the GUI, dm_pattern or dm_server run with
+    #--share-clock), each handed out with its analog window once the analog ring has gone past the window's end
+    def __init__(self, dmRing, analogRing, preMs, postMs, rate=None):
+        self.dmRing = dmRing
+        self.analogRing = analogRing
+        self.pre = int(preMs * 1e6)
+        self.post = int(postMs * 1e6)
+        self.rate = rate or analogRing.rate() or 1000.0
+        self.cursor = dmRing.written
+        self.lost = 0 #frames the DM ring overwrote before we got to them
+
+    def poll(self):
+        #list of (frame number, send stamp ns, times in ms from the send, analog rows)
+        written = self.dmRing.written
+        lost = max(0, written - self.cursor - self.dmRing.capacity)
+        self.lost += lost
+        self.cursor += lost
+        if written == self.cursor or self.analogRing.written == 0:
+            return []
+        idx = np.arange(self.cursor, written) % self.dmRing.capacity
+        stamps = self.dmRing.times[idx].copy()
+        frames = self.dmRing.values[idx, 0].astype(int)
+        latest = self.analogRing.latest(1)[0][0]
+        windows = []
+        for frame, stamp in zip(frames, stamps):
+            if stamp + self.post > latest:
+                break
+            times, values = self.analogRing.window(stamp - self.pre, stamp + self.post, self.rate)
+            windows.append((frame, stamp, (times - stamp) / 1e6, values))
+            self.cursor += 1
+        return windows
+
+def watch(watcher, seconds, interval=0.01):
+    windows = []
+    end = time.perf_counter() + seconds
+    try:
+        while time.perf_counter() < end:
+            windows.extend(watcher.poll())
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    return windows
+
+def measure_influence(capture, nAct, amplitude, channels, preMs=50.0, postMs=200.0, settleMs=50.0):
+    #poke each actuator up and down around flat, response = mean after settling minus mean before the step
+    frames = np.zeros((2 * nAct, nAct))
+    frames[0::2][np.arange(nAct), np.arange(nAct)] = amplitude
+    frames[1::2][np.arange(nAct), np.arange(nAct)] = -amplitude
+    flat = np.zeros(nAct)
+    influence = np.zeros((nAct, len(channels)))
+    steps = []
+    for i in range(nAct):
+        responses = []
+        for frame in (frames[2 * i], frames[2 * i + 1]):
+            t, values = capture.capture(frame, preMs, postMs)
+            values = values[:, channels]
+            before = values[t < 0].mean(axis=0)
+            after = values[t >= settleMs].mean(axis=0)
+            responses.append(after - before)
+            steps.append((t, values))
+            #back to flat long enough that the next pre-trigger window is settled again
+            capture.capture(flat, 0.0, preMs + settleMs)
+        #push-pull removes any drift that is common to both pokes
+        influence[i] = (responses[0] - responses[1]) / (2 * amplitude)
+    return influence, steps
+
+def settling_time(t, values, settleFraction=0.05):
+    #ms after the step until every channel stays within settleFraction of its final step size
+    before = values[t < 0].mean(axis=0)
+    final = values[-max(1, len(values) // 10):].mean(axis=0)
+    band = np.abs(final - before) * settleFraction + 1e-12
+    outside = np.abs(values - final) > band
+    after = t >= 0
+    settled = np.zeros(values.shape[1])
+    for c in range(values.shape[1]):
+        late = np.flatnonzero(outside[:, c] & after)
+        settled[c] = t[late[-1]] if len(late) else 0.0
+    return settled
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Synchronised DM / analog capture and influence-matrix measurement")
+    parser.add_argument("--amplitude", type=float, default=0.2, help="poke amplitude on the [-1,1] actuator scale")
+    parser.add_argument("--channels", type=int, nargs="+", default=list(range(16)))
+    parser.add_argument("--pre", type=float, default=50.0, help="ms recorded before each frame")
+    parser.add_argument("--post", type=float, default=200.0, help="ms recorded after each frame")
+    parser.add_argument("--settle", type=float, default=50.0, help="ms after the frame before the response is averaged")
+    parser.add_argument("--rate", type=float, default=1000.0, help="analog rate when this process does the acquisition")
+    parser.add_argument("--output", default="influence.npz")
+    parser.add_argument("--watch", type=float, metavar="SECONDS", help="don't drive the DM, cut --pre/--post windows around the frames other programs stamp with --share-clock")
+    parser.add_argument("--simulate", action="store_true", help="simulated DM and DAQ, acquired in this process")
+    parser.add_argument("--instrument", action="store_true", help="record per-stage latency histograms, written to json on exit")
+    return parser.parse_args(args[1:])
+
+def main_watch(options):
+    try:
+        dmRing = SharedRing(DM_RING)
+        analogRing = SharedRing(ANALOG_RING)
+    except FileNotFoundError:
+        print("Start the analog reader and the DM program (GUI, dm_pattern or dm_server) with --share-clock first")
+        return
+    watcher = FrameWatcher(dmRing, analogRing, options.pre, options.post, analogRing.rate() or options.rate)
+    print(f"Watching DM frames for {options.watch:g} s (Ctrl-C stops early)")
+    windows = watch(watcher, options.watch)
+    #windows differ in length, so they are stored end to end with offsets
+    lengths = [len(w[2]) for w in windows]
+    np.savez(options.output, frames=np.array([w[0] for w in windows], dtype=np.int64), stamps_ns=np.array([w[1] for w in windows], dtype=np.int64),
+             offsets=np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64),
+             t_ms=np.concatenate([w[2] for w in windows]) if windows else np.empty(0),
+             values=np.concatenate([w[3][:, options.channels] for w in windows]) if windows else np.empty((0, len(options.channels))),
+             channels=options.channels)
+    print(f"{len(windows)} frame windows saved to {options.output}, {watcher.lost} frames missed")
+    analogRing.close()
+    dmRing.close()
+
+def main(args):
+    options = parse_args(args)
+    if options.watch is not None:
+        main_watch(options)
+        return
+    from devices import dm_class, daq_device_class
+    print("Please enter the S/N within the following format BXXYYY (see DM backside): ")
+    serialName = input().strip()
+    dmRing = SharedRing(DM_RING, 2, 1 << 16, create=True)
+    dm = None
+    engine = None
+    analogRing = None
+    try:
+        dm = TimedDM(dm_class()(serialName), dmRing)
+        nbAct = int(dm.Get('NBOfActuator'))
+        if options.simulate:
+            from acquisition import AcquisitionEngine
+            analogRing = SharedRing(ANALOG_RING, 16, 1 << 18, create=True)
+            device = daq_device_class()('/dev/comedi0')
+            #a random but fixed coupling so the measured matrix can be checked against something
+            device.couple(dm.dm, np.random.default_rng(0).normal(0.0, 0.5, (16, nbAct)))
+            engine = AcquisitionEngine(device, 16, options.rate)
+            engine.sharedRing = analogRing
+            engine.start()
+        else:
+            #the analog reader has to be running with --share-clock so its samples land in the shared ring
+            try:
+                analogRing = SharedRing(ANALOG_RING)
+            except FileNotFoundError:
+                print("No analog samples: start the analog reader with --share-clock")
+                return
+        time.sleep(0.2)
+        capture = SyncCapture(dm, analogRing)
+        start = time.perf_counter()
+        influence, steps = measure_influence(capture, nbAct, options.amplitude, options.channels, options.pre, options.post, options.settle)
+        elapsed = time.perf_counter() - start
+        settle = np.array([settling_time(t, values) for t, values in steps[0::2]])
+        np.savez(options.output, influence=influence, channels=options.channels, settling_ms=settle, amplitude=options.amplitude)
+        print(f"{nbAct} actuators measured in {elapsed:.1f} s, influence matrix saved to {options.output}")
+    finally:
+        #a failed measurement still leaves the mirror flat and the rings released
+        if dm is not None:
+            dm.Reset()
+        if engine is not None:
+            engine.stop()
+        if analogRing is not None:
+            analogRing.close()
+        dmRing.close()
+
+if __name__ == "__main__":
+    main(sys.argv)
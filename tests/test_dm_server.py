@@ -0,0 +1,84 @@
+import os
+import tempfile
+import threading
+import time
+import numpy as np
+from dm_server import DMServer, DMClient
+from simulated_devices import SimulatedDM
+
+def start_server(dm, **options):
+    path = os.path.join(tempfile.mkdtemp(prefix="summer-test-"), "dm.sock")
+    server = DMServer(dm, path, **options)
+    server.start()
+    return server, path
+
+def run(target, *args):
+    result = {}
+    def call():
+        try:
+            result["reply"] = target(*args)
+        except Exception as error:
+            result["error"] = error
+    thread = threading.Thread(target=call, daemon=True)
+    thread.start()
+    return thread, result
+
+def test_higher_priority_job_arriving_during_the_last_frame():
+    #the sender drops its lock while a frame goes out; a job pushed on top of the heap meanwhile must not be
+    #popped in place of the one that just finished
+    dm = SimulatedDM("TEST", nbAct=4, latency=0.05)
+    server, path = start_server(dm, framePeriod=0.0)
+    low = DMClient(path, "low", priority=0)
+    high = DMClient(path, "high", priority=10)
+    try:
+        batch, batchResult = run(low.send_batch, np.zeros((2, 4)))
+        time.sleep(0.075) #second frame of the batch is in the driver
+        single, singleResult = run(high.Send, np.ones(4))
+        batch.join(2.0)
+        single.join(2.0)
+        assert not batch.is_alive() and not single.is_alive()
+        assert batchResult["reply"]["sent"] == 2
+        assert singleResult["reply"]["sent"] == 1
+        assert dm.sent == 3
+        #the sender thread survived and still serves new work
+        assert high.Send(np.full(4, 0.5))["ok"]
+        assert server.sender.is_alive()
+        assert not server.jobs
+    finally:
+        #the server first: stopping it releases any request still parked on a job
+        server.stop()
+        low.close()
+        high.close()
+
+class FailingDM(SimulatedDM):
+    #raises on the chosen sends, as a driver error would
+    def __init__(self, failOn):
+        super().__init__("TEST", nbAct=4)
+        self.failOn = failOn
+        self.calls = 0
+
+    def Send(self, values):
+        self.calls += 1
+        if self.calls in self.failOn:
+            raise OSError("driver error")
+        super().Send(values)
+
+def test_driver_error_fails_the_job_and_keeps_the_sender():
+    dm = FailingDM({3})
+    server, path = start_server(dm, framePeriod=0.0)
+    client = DMClient(path, "script")
+    try:
+        assert client.Send(np.zeros(4))["ok"]
+        try:
+            client.send_batch(np.zeros((3, 4)))
+        except RuntimeError as error:
+            assert "driver error" in str(error)
+        else:
+            raise AssertionError("the failed batch was reported as sent")
+        assert server.sender.is_alive()
+        assert client.Send(np.ones(4))["ok"]
+        assert not server.jobs and server.pending == 0
+        assert client.stats()["failed"] == 1
+    finally:
+        server.stop()
+        client.close()
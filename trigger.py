@@ -0,0 +1,239 @@
+import os
+import time
+import threading
+import numpy as np
+from acquisition import SampleRing
+from recorder import write_header
+
+#triggered capture: every block the acquisition ring hands over is checked with whole-array comparisons,
+#a short pre-trigger history is kept in its own ring, and only [pre + post] segments reach the disk
+KINDS = ["level", "edge", "window", "deviation"]
+EDGES = ["rising", "falling", "both"]
+
+class Trigger:
+    #level: value above `level` (below when `above` is False)
+    #edge: crosses `level` between two samples, in the `edge` direction
+    #window: leaves [low, high]
+    #deviation: further than `level` from the mean of the previous `window` samples, or further than
+    #`sigma` standard deviations when sigma is given
+    def __init__(self, kind, channel, level=0.0, low=None, high=None, edge="rising", above=True, window=1000, sigma=None):
+        if kind not in KINDS:
+            raise ValueError(f"Unknown trigger kind {kind}")
+        if edge not in EDGES:
+            raise ValueError(f"Unknown edge {edge}")
+        if kind == "window" and (low is None or high is None or low >= high):
+            raise ValueError("Window triggers need low < high")
+        self.kind = kind
+        self.channel = int(channel)
+        self.level = float(level)
+        self.low = low
+        self.high = high
+        self.edge = edge
+        self.above = above
+        self.window = int(window)
+        self.sigma = sigma
+
+    def describe(self):
+        if self.kind == "level":
+            return f"channel {self.channel} {'>' if self.above else '<'} {self.level:g}"
+        if self.kind == "edge":
+            return f"channel {self.channel} {self.edge} edge through {self.level:g}"
+        if self.kind == "window":
+            return f"channel {self.channel} outside [{self.low:g}, {self.high:g}]"
+        limit = f"{self.sigma:g} sigma" if self.sigma is not None else f"{self.level:g}"
+        return f"channel {self.channel} {limit} from its {self.window} sample mean"
+
+class RollingStats:
+    #mean and variance over the last `window` samples of every channel; each new sample adds itself and
+    #subtracts the one leaving the window, so a block costs O(block) whatever the window length
+    def __init__(self, nChannels, window, resync=1 << 20):
+        self.window = window
+        self.buffer = np.zeros((window, nChannels))
+        self.sum = np.zeros(nChannels)
+        self.sumSq = np.zeros(nChannels)
+        self.count = 0
+        self.resync = resync
+        self._sinceResync = 0
+
+    def update(self, block):
+        #returns (mean, std, ready) of the window *before* each row of the block, then takes the block in
+        n = len(block)
+        N = self.window
+        pos = self.count % N
+        #the sample each row pushes out: buffered ones first, then earlier rows of the same block;
+        #the buffer starts as zeros, so while it fills the sums only hold real samples
+        leaving = np.empty_like(block)
+        head = min(n, N)
+        leaving[:head] = self.buffer[(pos + np.arange(head)) % N]
+        if n > N:
+            leaving[N:] = block[:n - N]
+        delta = np.cumsum(block - leaving, axis=0)
+        deltaSq = np.cumsum(block * block - leaving * leaving, axis=0)
+        sums = np.empty_like(block)
+        sumsSq = np.empty_like(block)
+        sums[0] = self.sum
+        sumsSq[0] = self.sumSq
+        sums[1:] = self.sum + delta[:-1]
+        sumsSq[1:] = self.sumSq + deltaSq[:-1]
+        filled = np.minimum(self.count + np.arange(n), N)
+        ready = filled >= N
+        counts = np.maximum(filled, 1)[:, None]
+        mean = sums / counts
+        std = np.sqrt(np.maximum(sumsSq / counts - mean * mean, 0.0))
+        self.sum += delta[-1]
+        self.sumSq += deltaSq[-1]
+        tail = block[-N:]
+        self.buffer[(pos + max(0, n - N) + np.arange(len(tail))) % N] = tail
+        self.count += n
+        self._sinceResync += n
+        if self._sinceResync >= self.resync:
+            #running sums drift with rounding over hours; rebuild them from the window now and then
+            self._sinceResync = 0
+            self.sum = self.buffer.sum(axis=0)
+            self.sumSq = (self.buffer * self.buffer).sum(axis=0)
+        return mean, std, ready
+
+class TriggerEngine:
+    def __init__(self, ring, triggers, rate, folder="./triggers", preSeconds=1.0, postSeconds=1.0, holdoff=0.0,
+                 channels=None, pollInterval=0.05, onCapture=None):
+        #holdoff: seconds after a trigger before the next one may fire; triggers during a post-trigger
+        #segment are always ignored
+        self.ring = ring
+        self.triggers = list(triggers)
+        self.rate = rate
+        self.folder = folder
+        self.preSamples = max(1, int(round(preSeconds * rate)))
+        self.postSamples = max(1, int(round(postSeconds * rate)))
+        self.holdoff = holdoff
+        self.channels = np.arange(ring.nChannels) if channels is None else np.asarray(channels, dtype=int)
+        self.pollInterval = pollInterval
+        self.onCapture = onCapture
+        self.history = SampleRing(ring.nChannels, self.preSamples)
+        #one rolling window per distinct length, shared by the deviation triggers using it
+        self.stats = {t.window: RollingStats(ring.nChannels, t.window) for t in self.triggers if t.kind == "deviation"}
+        self.previous = None #last row of the previous block, for edges across block boundaries
+        self.captures = [] #(trigger time, description, path)
+        self.lost = 0
+        self.checked = 0
+        self._pending = None #segment still collecting its post-trigger samples
+        self._rearm = -np.inf
+        self._cursor = ring.written
+        self._running = False
+        self._thread = None
+        os.makedirs(folder, exist_ok=True)
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="trigger", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.poll()
+        if self._pending is not None:
+            #write whatever post-trigger data arrived rather than dropping the capture
+            self._finish()
+
+    def _run(self):
+        while self._running:
+            time.sleep(self.pollInterval)
+            self.poll()
+
+    def poll(self):
+        times, values, self._cursor, lost = self.ring.read_from(self._cursor)
+        self.lost += lost
+        if len(times):
+            self.process(times, values)
+
+    def masks(self, values):
+        #(rows, triggers) hits for one block, all comparisons on whole columns
+        hits = np.zeros((len(values), len(self.triggers)), dtype=bool)
+        if not self.triggers:
+            return hits
+        nan = np.isnan(values)
+        if nan.any():
+            #a failed read must not poison the running sums: carry the last good sample forward
+            rows = np.where(nan, 0, np.arange(len(values))[:, None])
+            np.maximum.accumulate(rows, axis=0, out=rows)
+            values = values[rows, np.arange(values.shape[1])]
+            first = np.isnan(values)
+            values[first] = np.broadcast_to(np.nan_to_num(self.previous) if self.previous is not None else 0.0, values.shape)[first]
+        stats = {window: rolling.update(values) for window, rolling in self.stats.items()}
+        previous = values[0] if self.previous is None else self.previous
+        for k, t in enumerate(self.triggers):
+            column = values[:, t.channel]
+            if t.kind == "level":
+                hits[:, k] = column > t.level if t.above else column < t.level
+            elif t.kind == "window":
+                hits[:, k] = (column < t.low) | (column > t.high)
+            elif t.kind == "edge":
+                before = np.empty_like(column)
+                before[0] = previous[t.channel]
+                before[1:] = column[:-1]
+                rising = (before < t.level) & (column >= t.level)
+                falling = (before > t.level) & (column <= t.level)
+                hits[:, k] = rising if t.edge == "rising" else falling if t.edge == "falling" else rising | falling
+            else:
+                mean, std, ready = stats[t.window]
+                limit = t.sigma * std[:, t.channel] if t.sigma is not None else t.level
+                hits[:, k] = ready & (np.abs(column - mean[:, t.channel]) > limit)
+        #nan samples (a failed read) never trigger
+        hits &= ~nan[:, [t.channel for t in self.triggers]]
+        self.previous = values[-1].copy()
+        return hits
+
+    def process(self, times, values):
+        hits = self.masks(values)
+        self.checked += len(times)
+        start = 0
+        while start < len(times):
+            if self._pending is not None:
+                start = self._collect(times, values, start)
+                continue
+            #first row at or after `start` where any trigger fired and the holdoff has passed
+            rows = np.flatnonzero(hits[start:].any(axis=1) & (times[start:] >= self._rearm))
+            if len(rows) == 0:
+                break
+            row = start + rows[0]
+            #pre-trigger segment: the ring holds everything before this block, the block supplies the rest
+            preTimes, preValues = self.history.latest(self.preSamples)
+            preTimes = np.concatenate([preTimes, times[:row]])[-self.preSamples:]
+            preValues = np.concatenate([preValues, values[:row]])[-self.preSamples:]
+            fired = int(np.flatnonzero(hits[row])[0])
+            self._pending = {"time": times[row], "trigger": self.triggers[fired],
+                             "times": [preTimes], "values": [preValues], "post": 0}
+            start = row
+        self.history.extend(times, values)
+
+    def _collect(self, times, values, start):
+        pending = self._pending
+        take = min(self.postSamples - pending["post"], len(times) - start)
+        pending["times"].append(times[start:start + take])
+        pending["values"].append(values[start:start + take])
+        pending["post"] += take
+        if pending["post"] >= self.postSamples:
+            self._finish()
+        return start + take
+
+    def _finish(self):
+        pending, self._pending = self._pending, None
+        times = np.concatenate(pending["times"])
+        values = np.concatenate(pending["values"])
+        trigger = pending["trigger"]
+        path = os.path.join(self.folder, f"trigger_{len(self.captures):04d}_{trigger.kind}_ch{trigger.channel}_"
+                                         f"{time.strftime('%Y%m%d-%H%M%S')}.rec")
+        #same layout as a StreamRecorder file, so recording_reader opens captures like any recording
+        block = np.empty((len(times), 1 + len(self.channels)))
+        block[:, 0] = times
+        block[:, 1:] = values[:, self.channels]
+        with open(path, 'wb') as file:
+            write_header(file, self.channels, self.rate, time.time())
+            file.write(block.tobytes())
+        self._rearm = pending["time"] + self.holdoff
+        self.captures.append((float(pending["time"]), trigger.describe(), path))
+        if self.onCapture is not None:
+            self.onCapture(pending["time"], trigger, path)
+        return path
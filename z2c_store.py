@@ -0,0 +1,71 @@
+import os
+import csv
+import numpy as np
+import instrumentation
+
+#process-wide cache of parsed Z2C matrices, keyed by csv path -> (csv mtime, matrix)
+_cache = {}
+
+def z2c_path(serialName, configDir='./config'):
+    return os.path.join(configDir, serialName + '-Z2C.csv')
+
+def parse_z2c_csv(csvPath):
+    #same layout the vendor tools write: one mode per row, comma separated actuator values
+    Z2C = []
+    with open(csvPath, newline='') as csvfile:
+        csvrows = csv.reader(csvfile, delimiter=' ')
+        for row in csvrows:
+            if not row:
+                continue
+            x = row[0].split(",")
+            Z2C.append([float(value) for value in x])
+    return np.ascontiguousarray(Z2C, dtype=np.float64)
+
+def _load_sidecar(csvPath, csvMtime):
+    #the .npy sidecar is only trusted if it was written after the csv last changed
+    npyPath = os.path.splitext(csvPath)[0] + '.npy'
+    try:
+        if os.stat(npyPath).st_mtime >= csvMtime:
+            return np.load(npyPath, mmap_mode='r')
+    except (OSError, ValueError):
+        pass
+    Z2C = parse_z2c_csv(csvPath)
+    try:
+        np.save(npyPath, Z2C)
+    except OSError:
+        pass #read-only config folder, keep the parsed matrix in memory only
+    return Z2C
+
+def load_z2c(serialName, configDir='./config'):
+    #raises FileNotFoundError like the old inline parsers did when the csv is missing
+    start = instrumentation.now() if instrumentation.ENABLED else 0
+    csvPath = z2c_path(serialName, configDir)
+    csvMtime = os.stat(csvPath).st_mtime
+    cached = _cache.get(csvPath)
+    if cached is not None and cached[0] == csvMtime:
+        if start:
+            instrumentation.record("z2c.load", start)
+        return cached[1]
+    Z2C = _load_sidecar(csvPath, csvMtime)
+    _cache[csvPath] = (csvMtime, Z2C)
+    if start:
+        instrumentation.record("z2c.load", start)
+        instrumentation.count("z2c.reload")
+    return Z2C
+
+def clear_cache():
+    _cache.clear()
+
+def zernike_to_actuators(Z2C, zernike_values):
+    #takes the rows and transposes them so that they can all be multiplied by their specific zernike values
+    start = instrumentation.now() if instrumentation.ENABLED else 0
+    actuator_values = Z2C[:len(zernike_values)].T @ zernike_values
+    if start:
+        instrumentation.record("zernike.projection", start)
+        start = instrumentation.now()
+    if (np.max(actuator_values)>1) or (np.min(actuator_values) < -1):
+        actuator_values = (actuator_values - actuator_values.min()) / (actuator_values.max() - actuator_values.min())  #scales to [0,1]
+        actuator_values = 2 * actuator_values - 1  #scales to [-1,1]
+    if start:
+        instrumentation.record("zernike.rescale", start)
+    return actuator_values
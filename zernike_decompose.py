@@ -0,0 +1,58 @@
+import os
+import numpy as np
+from z2c_store import load_z2c, z2c_path
+
+#in-process cache of decomposers keyed by (csv path, mode count, rcond) -> (csv mtime, decomposer)
+_cache = {}
+
+def svd_cache_path(serialName, nModes, configDir='./config'):
+    return os.path.join(configDir, f"{serialName}-Z2C-svd-{nModes}.npz")
+
+class ZernikeDecomposer:
+    #least-squares inverse of the Z2C projection: actuators = Z2C[:n].T @ coeffs  ->  coeffs = pinv @ actuators
+    #built from a truncated SVD so poorly conditioned modes don't blow up the fit
+    def __init__(self, U, s, Vt, rcond=1e-6):
+        keep = s > rcond * s.max()
+        self.rank = int(keep.sum())
+        self.pinv = np.ascontiguousarray((Vt[keep].T / s[keep]) @ U[:, keep].T)
+        self.nModes, self.nAct = self.pinv.shape
+
+    def decompose(self, actuators):
+        #one vector (nAct,) or a batch (frames, nAct) in a single matrix product
+        actuators = np.asarray(actuators, dtype=np.float64)
+        return actuators @ self.pinv.T
+
+def _compute_svd(Z2C, nModes):
+    return np.linalg.svd(np.asarray(Z2C[:nModes], dtype=np.float64).T, full_matrices=False)
+
+def load_decomposer(serialName, nModes, configDir='./config', rcond=1e-6):
+    csvPath = z2c_path(serialName, configDir)
+    csvMtime = os.stat(csvPath).st_mtime
+    key = (csvPath, nModes, rcond)
+    cached = _cache.get(key)
+    if cached is not None and cached[0] == csvMtime:
+        return cached[1]
+    cachePath = svd_cache_path(serialName, nModes, configDir)
+    factors = None
+    try:
+        with np.load(cachePath) as stored:
+            #the factors on disk are only reused if they were computed from the current csv
+            if float(stored["csv_mtime"]) == csvMtime:
+                factors = stored["U"], stored["s"], stored["Vt"]
+    except (OSError, KeyError, ValueError):
+        pass
+    if factors is None:
+        factors = _compute_svd(load_z2c(serialName, configDir), nModes)
+        try:
+            np.savez(cachePath, U=factors[0], s=factors[1], Vt=factors[2], csv_mtime=csvMtime)
+        except OSError:
+            pass
+    decomposer = ZernikeDecomposer(*factors, rcond=rcond)
+    _cache[key] = (csvMtime, decomposer)
+    return decomposer
+
+def load_actuator_file(path):
+    #a single command or a batch of commands, one per row, as .npy or comma separated text
+    if path.endswith(".npy"):
+        return np.load(path, mmap_mode='r')
+    return np.loadtxt(path, delimiter=",", ndmin=2)
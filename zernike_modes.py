@@ -0,0 +1,20 @@
+#names of the Noll-ordered modes on the sliders (piston left out), importable without Qt or matplotlib
+Noll_Zernikes = ["Tilt Y", "Tilt X", "Power", "Astig 45", "Astig X", "Coma X", "Coma Y", "Trefoil Y", "Trefoil 45", "Primary Spherical", "Secondary Astig Y", "Secondary Astig 45", "Quadrafoil Y", "Quadrafoil 45", "Secondary Coma X", "Secondary Coma Y", "Secondary Trefoil 45", "Secondary Trefoil Y", "Pentafoil 45", "Pentafoil Y", "Secondary Spherical", "Tertiary Astig 45", "Tertiary Astig Y"]
+Noll_Zernikes.extend([f"Mode {i+24}" for i in range(96 - len(Noll_Zernikes))])
+
+MAX_MODES = len(Noll_Zernikes)
+
+def parse_range(cell):
+    #"[-50,50]" -> (-50.0, 50.0)
+    low, high = cell.strip().strip('"').strip("[]").split(",")
+    return float(low), float(high)
+
+def load_pattern_percentages(path):
+    #whole pattern table (csv or .zpat) as (frames x modes), each mode divided by its max,
+    #the "[min,max]" header row gives the max; use pattern_stream.iter_pattern_blocks for long sequences
+    import numpy as np
+    from pattern_stream import iter_pattern_blocks, pattern_info
+    blocks = list(iter_pattern_blocks(path))
+    if not blocks:
+        return np.empty((0, len(pattern_info(path)[1])))
+    return np.concatenate(blocks)
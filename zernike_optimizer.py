@@ -0,0 +1,318 @@
+import sys
+import json
+import time
+import argparse
+import numpy as np
+from dm_pattern import compile_pattern_bank
+from dm_journal import DMJournal, session_path, SOURCE_SCRIPT
+from sync_capture import now_ns
+import instrumentation
+
+#closed-loop shape search: candidate coefficient vectors are projected through Z2C a batch at a time, sent to
+#the mirror one after another and scored by the mean of one analog channel after each has settled
+ALGORITHMS = ["sweep", "spgd", "nelder-mead"]
+#passes for the sweep, iterations for the other two
+DEFAULT_ITERATIONS = {"sweep": 3, "spgd": 200, "nelder-mead": 200}
+
+class Stopped(Exception):
+    #raised from inside a batch when the stop flag is set, so a run ends without waiting for the batch
+    pass
+
+class ChannelObjective:
+    #scores a batch of actuator frames from a SharedRing of analog samples (sync_capture's clock):
+    #frame k is held for settleMs, the next one goes out as soon as the ring holds `samples` rows past the
+    #settle point, and the mean of window k is cut from the ring while frame k+1 settles
+    def __init__(self, dm, analogRing, channel, settleMs=20.0, samples=10, journal=None, pollInterval=0.0005,
+                 timeout=1.0, stop=None):
+        self.dm = dm
+        self.send = instrumentation.timed("dm.send", dm.Send)
+        self.ring = analogRing
+        self.channel = channel
+        self.settle = int(settleMs * 1e6)
+        self.samples = samples
+        self.journal = journal
+        self.pollInterval = pollInterval
+        self.timeout = timeout #seconds past the expected end of a window before the reader counts as gone
+        self.stop = stop
+        self.frames = 0
+
+    def _check_stop(self):
+        if self.stop is not None and self.stop():
+            raise Stopped()
+
+    def _wait_until(self, stamp):
+        #sleeps in short slices so a stop request is seen during long settle times
+        while True:
+            self._check_stop()
+            remaining = (stamp - now_ns()) / 1e9
+            if remaining <= 0:
+                return
+            time.sleep(min(remaining, 0.05))
+
+    def _wait_written(self, count):
+        rate = self.ring.rate() or 1000.0
+        deadline = time.perf_counter() + (count - self.ring.written) / rate + self.timeout
+        while self.ring.written < count:
+            self._check_stop()
+            if time.perf_counter() > deadline:
+                raise TimeoutError("No new analog samples, is the analog reader still running with --share-clock?")
+            time.sleep(self.pollInterval)
+
+    def _mean(self, first, settled):
+        #rows from index `first` on, keeping the first `samples` stamped after the settle point
+        idx = np.arange(first, first + self.samples + 1) % self.ring.capacity
+        times = self.ring.times[idx]
+        values = self.ring.values[idx, self.channel]
+        kept = values[times >= settled][:self.samples]
+        if len(kept) == 0:
+            #the slots were already overwritten (ring lapped while we were away), go by time stamps instead
+            times, rows = self.ring.window(settled, now_ns(), self.ring.rate() or 1000.0)
+            kept = rows[:self.samples, self.channel]
+            if len(kept) == 0:
+                raise RuntimeError("No analog samples after the settle point")
+        return kept.mean()
+
+    def __call__(self, frames, coefficients=None):
+        scores = np.empty(len(frames))
+        previous = None
+        for k, frame in enumerate(frames):
+            self.send(frame)
+            settled = now_ns() + self.settle
+            if self.journal is not None:
+                self.journal.append(SOURCE_SCRIPT, frame, None if coefficients is None else coefficients[k])
+            if previous is not None:
+                #the last window is already in the ring, average it while this frame settles
+                scores[k - 1] = self._mean(*previous)
+            self._wait_until(settled)
+            first = self.ring.written
+            self._wait_written(first + self.samples + 1)
+            previous = (first, settled)
+        if previous is not None:
+            scores[-1] = self._mean(*previous)
+        self.frames += len(frames)
+        return scores
+
+class Search:
+    #search space: the coefficients of `modes` (0-based Noll order) on the [-1,1] slider scale, every other
+    #mode stays where x0 has it; scores are flipped for minimising so the algorithms always maximise
+    def __init__(self, Z2C, objective, x0, modes, maximise=True):
+        self.Z2C = Z2C
+        self.objective = objective
+        self.base = np.asarray(x0, dtype=np.float64).copy()
+        self.modes = np.asarray(modes, dtype=int)
+        self.sign = 1.0 if maximise else -1.0
+        self.evaluations = 0
+        self.best = self.base[self.modes].copy()
+        self.bestScore = -np.inf
+        self.history = [] #best score after every batch
+        self.start = time.perf_counter()
+
+    def coefficients(self, points):
+        full = np.repeat(self.base[None], len(points), axis=0)
+        full[:, self.modes] = np.clip(points, -1, 1)
+        return full
+
+    def evaluate(self, points):
+        points = np.clip(np.atleast_2d(points), -1, 1)
+        coefficients = self.coefficients(points)
+        start = instrumentation.now() if instrumentation.ENABLED else 0
+        frames = compile_pattern_bank(self.Z2C, coefficients)
+        if start:
+            instrumentation.record("optimizer.projection", start)
+        scores = self.sign * self.objective(frames, coefficients)
+        self.evaluations += len(points)
+        k = int(np.argmax(scores))
+        if scores[k] > self.bestScore:
+            self.bestScore = scores[k]
+            self.best = points[k].copy()
+        self.history.append(self.sign * self.bestScore)
+        return scores
+
+    def apply_best(self):
+        #send the best shape without measuring it again, e.g. after a stop
+        send = getattr(self.objective, "send", None)
+        if send is not None and np.isfinite(self.bestScore):
+            send(compile_pattern_bank(self.Z2C, self.best_coefficients()[None])[0])
+
+    def best_coefficients(self):
+        return self.coefficients(self.best[None])[0]
+
+    def report(self):
+        elapsed = time.perf_counter() - self.start
+        return {"evaluations": self.evaluations, "seconds": elapsed,
+                "evaluations_per_s": self.evaluations / elapsed if elapsed > 0 else 0.0,
+                "best_value": float(self.sign * self.bestScore), "best_coefficients": self.best_coefficients().tolist()}
+
+def coordinate_sweep(search, span=0.5, steps=9, passes=3, stop=None):
+    #one batch per mode: `steps` values across +-span around the current best, move to the best of them;
+    #every pass halves the span
+    x = search.best.copy()
+    for _ in range(passes):
+        for i in range(len(x)):
+            if stop is not None and stop():
+                return
+            points = np.repeat(x[None], steps, axis=0)
+            points[:, i] = np.clip(x[i] + np.linspace(-span, span, steps), -1, 1)
+            scores = search.evaluate(points)
+            x[i] = points[int(np.argmax(scores)), i]
+        span /= 2
+
+def spgd(search, iterations=200, perturbation=0.05, gain=0.02, pairs=1, stop=None):
+    #stochastic parallel gradient descent: +-perturbation on every mode at once, `pairs` two-sided
+    #perturbations per batch; the step is normalised by a running |dJ| so the gain does not depend on
+    #the channel's units
+    rng = np.random.default_rng()
+    x = search.best.copy()
+    scale = None
+    for _ in range(iterations):
+        if stop is not None and stop():
+            return
+        delta = perturbation * rng.choice([-1.0, 1.0], size=(pairs, len(x)))
+        scores = search.evaluate(np.concatenate([x + delta, x - delta]))
+        dJ = scores[:pairs] - scores[pairs:]
+        scale = np.abs(dJ).mean() if scale is None else 0.9 * scale + 0.1 * np.abs(dJ).mean()
+        if scale > 0:
+            x = np.clip(x + gain / perturbation * (dJ / scale) @ delta / pairs, -1, 1)
+
+def nelder_mead(search, iterations=200, step=0.2, tolerance=1e-4, stop=None):
+    #maximising version of the usual simplex (reflect 1, expand 2, contract 0.5, shrink 0.5);
+    #the first simplex and every shrink are sent as one batch
+    n = len(search.best)
+    simplex = np.repeat(search.best[None], n + 1, axis=0)
+    simplex[1:] += step * np.eye(n)
+    simplex = np.clip(simplex, -1, 1)
+    scores = search.evaluate(simplex)
+    for _ in range(iterations):
+        if stop is not None and stop():
+            return
+        order = np.argsort(-scores)
+        simplex, scores = simplex[order], scores[order]
+        if np.abs(scores[0] - scores[-1]) <= tolerance * (np.abs(scores[0]) + 1e-12):
+            return
+        centroid = simplex[:-1].mean(axis=0)
+        reflected = np.clip(centroid + (centroid - simplex[-1]), -1, 1)
+        reflectedScore = search.evaluate(reflected)[0]
+        if reflectedScore > scores[0]:
+            expanded = np.clip(centroid + 2 * (centroid - simplex[-1]), -1, 1)
+            expandedScore = search.evaluate(expanded)[0]
+            if expandedScore > reflectedScore:
+                simplex[-1], scores[-1] = expanded, expandedScore
+            else:
+                simplex[-1], scores[-1] = reflected, reflectedScore
+        elif reflectedScore > scores[-2]:
+            simplex[-1], scores[-1] = reflected, reflectedScore
+        else:
+            contracted = centroid + 0.5 * (simplex[-1] - centroid)
+            contractedScore = search.evaluate(contracted)[0]
+            if contractedScore > scores[-1]:
+                simplex[-1], scores[-1] = contracted, contractedScore
+            else:
+                simplex[1:] = simplex[0] + 0.5 * (simplex[1:] - simplex[0])
+                scores[1:] = search.evaluate(simplex[1:])
+
+def optimise(search, algorithm, iterations=None, step=0.2, stop=None):
+    #step: sweep half-span, SPGD perturbation or initial simplex size, on the [-1,1] scale
+    if iterations is None:
+        iterations = DEFAULT_ITERATIONS.get(algorithm, 200)
+    if algorithm not in ALGORITHMS:
+        raise ValueError(f"Unknown algorithm {algorithm}")
+    try:
+        if algorithm == "sweep":
+            coordinate_sweep(search, span=step, passes=max(1, iterations), stop=stop)
+        elif algorithm == "spgd":
+            spgd(search, iterations, perturbation=step, stop=stop)
+        else:
+            nelder_mead(search, iterations, step, stop=stop)
+        #leave the mirror on the best shape found rather than the last candidate
+        search.evaluate(search.best[None])
+    except Stopped:
+        search.apply_best()
+    return search.report()
+
+def parse_modes(text, count):
+    #Noll indices as "2-10" or "4,5,6", returned 0-based
+    modes = []
+    for part in text.split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            modes.extend(range(int(first), int(last) + 1))
+        elif part.strip():
+            modes.append(int(part))
+    if not modes or min(modes) < 1 or max(modes) > count:
+        raise ValueError(f"Modes must be Noll indices between 1 and {count}")
+    return [m - 1 for m in modes]
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Search Zernike coefficients that maximise or minimise an analog channel")
+    parser.add_argument("--channel", type=int, default=0, help="analog channel to optimise")
+    parser.add_argument("--algorithm", choices=ALGORITHMS, default="nelder-mead")
+    parser.add_argument("--minimise", action="store_true", help="minimise the channel instead of maximising it")
+    parser.add_argument("--modes", default="2-10", help="Noll indices to search, e.g. 2-10 or 4,5,6")
+    parser.add_argument("--settle", type=float, default=20.0, help="ms after each send before the channel is read")
+    parser.add_argument("--samples", type=int, default=10, help="analog rows averaged per candidate")
+    parser.add_argument("--iterations", type=int, help="iterations (SPGD, Nelder-Mead, default 200) or passes (sweep, default 3)")
+    parser.add_argument("--step", type=float, default=0.2, help="sweep span, SPGD perturbation or simplex size on the [-1,1] scale")
+    parser.add_argument("--config", default="./config", help="folder with the <serial>-Z2C.csv files")
+    parser.add_argument("--output", default="optimised_coefficients.json")
+    parser.add_argument("--journal", help="journal file for the frames sent (default journal/<serial>-<date>.djr)")
+    parser.add_argument("--no-journal", action="store_true", help="don't record the frames sent to the mirror")
+    parser.add_argument("--rate", type=float, default=1000.0, help="analog rate when this process does the acquisition")
+    parser.add_argument("--simulate", action="store_true", help="simulated DM and DAQ, acquired in this process")
+    parser.add_argument("--instrument", action="store_true", help="record per-stage latency histograms, written to json on exit")
+    return parser.parse_args(args[1:])
+
+def main(args):
+    options = parse_args(args)
+    from devices import daq_device_class
+    from dm_server import connect_or_open
+    from z2c_store import load_z2c
+    from sync_capture import SharedRing, ANALOG_RING
+    print("Please enter the S/N within the following format BXXYYY (see DM backside): ")
+    serialName = input().strip()
+    Z2C = load_z2c(serialName, options.config)
+    dm = connect_or_open(serialName, name="optimizer")
+    engine = None
+    analogRing = None
+    journal = None
+    try:
+        if options.simulate:
+            from acquisition import AcquisitionEngine
+            analogRing = SharedRing(ANALOG_RING, 16, 1 << 18, create=True)
+            device = daq_device_class()('/dev/comedi0')
+            device.couple(dm, np.random.default_rng(0).normal(0.0, 0.5, (16, Z2C.shape[1])))
+            engine = AcquisitionEngine(device, 16, options.rate)
+            engine.sharedRing = analogRing
+            engine.start()
+        else:
+            #the analog reader has to be running with --share-clock so its samples land in the shared ring
+            try:
+                analogRing = SharedRing(ANALOG_RING)
+            except FileNotFoundError:
+                print("No analog samples: start the analog reader with --share-clock")
+                return
+        #through a DM server the candidates land in the server's journal instead
+        if not options.no_journal and not hasattr(dm, "send_batch"):
+            journal = DMJournal(options.journal or session_path(serialName), int(dm.Get('NBOfActuator')), serialName=serialName)
+        time.sleep(0.2)
+        modes = parse_modes(options.modes, Z2C.shape[0])
+        objective = ChannelObjective(dm, analogRing, options.channel, options.settle, options.samples, journal)
+        search = Search(Z2C, objective, np.zeros(max(modes) + 1), modes, not options.minimise)
+        report = optimise(search, options.algorithm, options.iterations, options.step)
+    finally:
+        if engine is not None:
+            engine.stop()
+        if analogRing is not None:
+            analogRing.close()
+        if journal is not None:
+            journal.close()
+            print(f"Journal: {journal.path}")
+        if hasattr(dm, "close"):
+            dm.close()
+    report.update(serial=serialName, channel=options.channel, algorithm=options.algorithm, modes=[m + 1 for m in modes])
+    with open(options.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"{report['evaluations']} evaluations in {report['seconds']:.2f} s ({report['evaluations_per_s']:.1f} per second)")
+    print(f"best channel {options.channel}: {report['best_value']:.6g}, coefficients in {options.output}")
+
+if __name__ == "__main__":
+    main(sys.argv)